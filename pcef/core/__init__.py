@@ -19,17 +19,22 @@ import os
 from pcef.core import constants
 from pcef.core.constants import PanelPosition
 from pcef.core.decoration import TextDecoration
+from pcef.core.decoration_manager import DecorationLayer
+from pcef.core.decoration_manager import DecorationManager
 from pcef.core.editor import QCodeEdit
+from pcef.core.lexing import CompiledLexer
 from pcef.core.mode import Mode
 from pcef.core.modes import AutoIndentMode
 from pcef.core.modes import CaretLineHighlighterMode
 from pcef.core.panel import Panel
 from pcef.core.modes import PygmentsHighlighterMode
 from pcef.core.modes import RightMarginMode
+from pcef.core.modes import RuleHighlighterMode
 from pcef.core.modes import ZoomMode
 from pcef.core.panels import LineNumberPanel
 from pcef.core.panels import SearchAndReplacePanel
 from pcef.core.properties import PropertyRegistry
+from pcef.core.search import SearchEngine
 from pcef.core.system import TextStyle
 from pcef.core.system import JobRunner
 from pcef.core.system import DelayJobRunner
@@ -88,6 +93,8 @@ __all__ = ["__version__", "constants", "Mode", "Panel", "QCodeEdit",
            "LineNumberPanel", "SearchAndReplacePanel",
            "CaretLineHighlighterMode", "RightMarginMode", "ZoomMode",
            "PygmentsHighlighterMode", "AutoIndentMode", "PanelPosition",
-           "TextDecoration", "PropertyRegistry", "TextStyle",
+           "RuleHighlighterMode",
+           "TextDecoration", "DecorationManager", "CompiledLexer",
+           "DecorationLayer", "PropertyRegistry", "SearchEngine", "TextStyle",
            "QGenericCodeEdit", "JobRunner", "DelayJobRunner",
            "getUiDirectory", "getRcDirectory"]
@@ -68,6 +68,11 @@ DEFAULT_STYLES = {
     'numbers': TextStyle('#000080 nbold nitalic nunderlined'),
     'predefined': TextStyle('#B200B2 nbold nitalic nunderlined'),
     'docstringTag': TextStyle('#0000FF bold nitalic underlined'),
+    'logError': TextStyle('#CC0000 bold nitalic nunderlined'),
+    'logWarning': TextStyle('#C07000 nbold nitalic nunderlined'),
+    'logInfo': TextStyle('#000080 nbold nitalic nunderlined'),
+    'logDebug': TextStyle('#808080 nbold nitalic nunderlined'),
+    'logTimestamp': TextStyle('#800080 nbold nitalic nunderlined'),
 }
 
 DEFAULT_DARK_STYLES = {
@@ -85,7 +90,12 @@ DEFAULT_DARK_STYLES = {
     'self': TextStyle('#94558D nbold italic nunderlined'),
     'numbers': TextStyle('#6897B3 nbold nitalic nunderlined'),
     'predefined': TextStyle('#B200B2 nbold nitalic nunderlined'),
-    'docstringTag': TextStyle('#427735 bold nitalic underlined')
+    'docstringTag': TextStyle('#427735 bold nitalic underlined'),
+    'logError': TextStyle('#FF6B68 bold nitalic nunderlined'),
+    'logWarning': TextStyle('#FFC66D nbold nitalic nunderlined'),
+    'logInfo': TextStyle('#6897B3 nbold nitalic nunderlined'),
+    'logDebug': TextStyle('#808080 nbold nitalic nunderlined'),
+    'logTimestamp': TextStyle('#9876AA nbold nitalic nunderlined'),
 }
 
 #
@@ -21,6 +21,12 @@ class TextDecoration(QtGui.QTextEdit.ExtraSelection):
 
     In addition to the helper methods, a tooltip can be added to a decoration.
     Usefull for errors marks and so on...
+
+    .. note:: Decorations are stored in a compact form by the editor
+              decoration layers (offsets + shared format), the decoration
+              cursor is only used to compute the range when the decoration
+              is added. Producers of large sets of decorations should use
+              DecorationLayer.addRange/setRanges directly.
     """
 
     def __init__(self, cursorOrBlockOrDoc, startPos=None, endPos=None,
@@ -49,7 +55,11 @@ class TextDecoration(QtGui.QTextEdit.ExtraSelection):
 
     def containsCursor(self, textCursor):
         assert isinstance(textCursor, QtGui.QTextCursor)
-        return self.cursor.selectionStart() <= textCursor.position() < \
+        return self.containsPosition(textCursor.position())
+
+    def containsPosition(self, position):
+        """ Checks if the decoration contains the given document position """
+        return self.cursor.selectionStart() <= position < \
             self.cursor.selectionEnd()
 
     def setBold(self):
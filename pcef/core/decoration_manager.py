@@ -0,0 +1,896 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCEF - Python/Qt Code Editing Framework
+# Copyright 2013, Colin Duquesnoy <colin.duquesnoy@gmail.com>
+#
+# This software is released under the LGPLv3 license.
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+This module contains the decoration manager used by the QCodeEdit to keep
+track of the text decorations and push them to Qt as extra selections.
+"""
+import bisect
+import weakref
+from array import array
+from pcef.qt import QtCore, QtGui
+
+
+def _formatKey(fmt):
+    """
+    Returns a hashable key of a text format: its serialized type and
+    properties (properties are serialized sorted by id, equal formats have
+    the same key).
+    """
+    data = QtCore.QByteArray()
+    stream = QtCore.QDataStream(data, QtCore.QIODevice.WriteOnly)
+    stream << fmt
+    return data.data()
+
+
+class DecorationLayer(object):
+    """
+    A named group of decorations owned by a mode or a panel (search
+    occurrences, caret line, diagnostics,...).
+
+    Layers are painted in the order of their draw order, the decorations of a
+    layer are painted in position order (the draw_order attribute of the
+    decorations is ignored). This way, replacing or clearing the whole set of
+    decorations of a mode is a single operation and the global list of
+    decorations never needs to be re-sorted.
+
+    Decorations are stored in a compact form: their start and end offsets
+    are kept in arrays (sorted by start offset) along with the id of a format
+    shared through the manager format table (see
+    :meth:`DecorationManager.registerFormat`). The offsets are shifted when
+    the document content changes and the real ExtraSelection/QTextCursor
+    objects are only created for the decorations that are pushed to Qt.
+
+    Layers are created by the :class:`DecorationManager`::
+
+        layer = editor.decorations.layer("search", drawOrder=1)
+        formatId = editor.decorations.registerFormat(fmt)
+        layer.setRanges(starts, ends, formatId)
+        layer.clear()
+
+    :class:`pcef.TextDecoration` instances are also accepted (they are
+    converted to the compact form, their cursor is not used to track the
+    decoration position).
+    """
+
+    @property
+    def manager(self):
+        """
+        Returns the decoration manager that owns the layer
+
+        :rtype: pcef.core.DecorationManager
+        """
+        return self.__manager()
+
+    def __init__(self, manager, name, drawOrder=0):
+        """
+        :param manager: The decoration manager that owns the layer
+
+        :param name: The layer name
+
+        :param drawOrder: The layer draw order
+        """
+        self.__manager = weakref.ref(manager)
+        #: The layer name
+        self.name = name
+        #: The layer draw order, layers with a lower draw order are painted
+        #: first
+        self.drawOrder = drawOrder
+        self.__nextHandle = 0
+        self.__tooltipCount = 0
+        self.__reset()
+
+    def __len__(self):
+        return len(self.__starts)
+
+    def __iter__(self):
+        """
+        Iterates over the decorations as tuple(start, end, format id, tooltip)
+        """
+        return iter(list(zip(self.__starts, self.__ends, self.__formatIds,
+                             self.__tooltips)))
+
+    def __contains__(self, decoration):
+        entry = self.__decorationHandles.get(id(decoration))
+        return entry is not None and entry[0] is decoration
+
+    def addRange(self, start, end, formatId, tooltip=None):
+        """
+        Adds a decoration in its compact form.
+
+        :param start: Start offset
+        :param end: End offset
+        :param formatId: Id of the decoration format (see
+                         DecorationManager.registerFormat)
+        :param tooltip: Optional tooltip
+
+        :return: The decoration handle (used to remove the decoration)
+        """
+        index = bisect.bisect_right(self.__starts, start)
+        handle = self.__nextHandle
+        self.__nextHandle += 1
+        if self.__indexes is not None:
+            if index == len(self.__starts):
+                # appended, the indexes of the other handles do not move
+                self.__indexes[handle] = index + len(self.__removedIndexes)
+            else:
+                self.__indexes = None
+        self.__starts.insert(index, start)
+        self.__ends.insert(index, end)
+        self.__formatIds.insert(index, formatId)
+        self.__handles.insert(index, handle)
+        self.__tooltips.insert(index, tooltip)
+        if tooltip:
+            self.__tooltipCount += 1
+        self.__changed(index)
+        return handle
+
+    def removeRange(self, handle):
+        """
+        Removes a decoration by handle.
+
+        :param handle: The handle returned by addRange
+
+        :return: False if the decoration was not found, True otherwise.
+        """
+        indexes = self.__handleIndexes()
+        try:
+            original = indexes.pop(handle)
+        except KeyError:
+            return False
+        removed = self.__removedIndexes
+        index = original - bisect.bisect_left(removed, original)
+        bisect.insort(removed, original)
+        if self.__tooltips[index]:
+            self.__tooltipCount -= 1
+        del self.__starts[index]
+        del self.__ends[index]
+        del self.__formatIds[index]
+        del self.__handles[index]
+        del self.__tooltips[index]
+        self.__changed(index)
+        return True
+
+    def setRanges(self, starts, ends, formatId, tooltips=None):
+        """
+        Replaces all the decorations of the layer by a set of ranges that
+        share the same format.
+
+        :param starts: Start offsets, sorted
+        :param ends: End offsets
+        :param formatId: Id of the decorations format
+        :param tooltips: Optional list of tooltips
+        """
+        self.__reset()
+        self.__starts = array("l", starts)
+        self.__ends = array("l", ends)
+        count = len(self.__starts)
+        assert len(self.__ends) == count
+        self.__formatIds = array("l", [formatId]) * count
+        self.__handles = array("l", range(self.__nextHandle,
+                                          self.__nextHandle + count))
+        self.__nextHandle += count
+        if tooltips is not None:
+            self.__tooltips = list(tooltips)
+            self.__tooltipCount = len([t for t in self.__tooltips if t])
+        else:
+            self.__tooltips = [None] * count
+        self.__changed(0)
+
+    def replaceRanges(self, start, end, starts, ends, formatId):
+        """
+        Replaces the decorations that start in the range [start, end[ by a
+        set of ranges that share the same format (the other decorations are
+        left untouched).
+
+        :param start: Start offset of the replaced range
+        :param end: End offset of the replaced range
+        :param starts: Start offsets of the new ranges, sorted, in the
+                       replaced range
+        :param ends: End offsets of the new ranges
+        :param formatId: Id of the new ranges format
+        """
+        first = bisect.bisect_left(self.__starts, start)
+        last = bisect.bisect_left(self.__starts, end)
+        count = len(starts)
+        if first == last and not count:
+            return
+        removed = set(self.__handles[first:last])
+        self.__tooltipCount -= len([t for t in self.__tooltips[first:last]
+                                    if t])
+        self.__starts[first:last] = array("l", starts)
+        self.__ends[first:last] = array("l", ends)
+        self.__formatIds[first:last] = array("l", [formatId]) * count
+        self.__handles[first:last] = array("l", range(
+            self.__nextHandle, self.__nextHandle + count))
+        self.__nextHandle += count
+        self.__tooltips[first:last] = [None] * count
+        if removed and self.__decorationHandles:
+            self.__decorationHandles = dict(
+                (key, entry) for key, entry in
+                self.__decorationHandles.items() if entry[1] not in removed)
+        self.__indexes = None
+        self.__changed(first)
+
+    def append(self, decoration):
+        """
+        Adds a text decoration to the layer
+
+        :param decoration: Text decoration
+        :type decoration: pcef.TextDecoration
+        """
+        if decoration in self:
+            return
+        start, end, formatId, tooltip = self.__compact(decoration)
+        self.__decorationHandles[id(decoration)] = (
+            decoration, self.addRange(start, end, formatId, tooltip))
+
+    def remove(self, decoration):
+        """
+        Removes a text decoration from the layer
+
+        :param decoration: The decoration to remove
+        :type decoration: pcef.TextDecoration
+
+        :return: False if the decoration was not found, True otherwise.
+        """
+        if decoration not in self:
+            return False
+        decoration, handle = self.__decorationHandles.pop(id(decoration))
+        return self.removeRange(handle)
+
+    def clear(self):
+        """
+        Removes all the decorations of the layer
+        """
+        if len(self):
+            self.__reset()
+            self.__changed(0)
+
+    def setDecorations(self, decorations):
+        """
+        Replaces all the decorations of the layer
+
+        :param decorations: The new decorations
+        :type decorations: list of pcef.TextDecoration
+        """
+        ranges = sorted((self.__compact(d) + (d, ) for d in decorations),
+                        key=lambda r: r[0])
+        self.__reset()
+        for start, end, formatId, tooltip, decoration in ranges:
+            handle = self.__nextHandle
+            self.__nextHandle += 1
+            self.__starts.append(start)
+            self.__ends.append(end)
+            self.__formatIds.append(formatId)
+            self.__handles.append(handle)
+            self.__tooltips.append(tooltip)
+            if tooltip:
+                self.__tooltipCount += 1
+            self.__decorationHandles[id(decoration)] = (decoration, handle)
+        self.__changed(0)
+
+    def shift(self, position, charsRemoved, charsAdded):
+        """
+        Shifts the decorations offsets after a document change (the offsets
+        move the same way a QTextCursor would). The decorations that lie
+        entirely inside the removed text are dropped (they would otherwise
+        cover the added text), even if as many characters were added.
+
+        The changes that only touch the text formats (e.g. syntax
+        highlighting) must not be passed to this method, see
+        :meth:`DecorationManager.isFormatChange`.
+
+        :param position: Position of the change
+        :param charsRemoved: Number of removed characters
+        :param charsAdded: Number of added characters
+        """
+        if not len(self):
+            return
+        delta = charsAdded - charsRemoved
+        limit = position + charsRemoved
+        if charsRemoved:
+            self.__dropInside(position, limit)
+        # starts are sorted, only the tail moves
+        first = bisect.bisect_left(self.__starts, position)
+        self.__starts[first:] = array("l", [
+            s + delta if s >= limit else position
+            for s in self.__starts[first:]])
+        # ends of decorations that all end before position are untouched
+        first = bisect.bisect_left(self.__runningMaxEnds(), position)
+        self.__ends[first:] = array("l", [
+            e + delta if e >= limit else (position if e > position else e)
+            for e in self.__ends[first:]])
+        del self.__maxEnds[first:]
+
+    def __dropInside(self, position, limit):
+        """
+        Removes the decorations that lie in the removed range ]position,
+        limit] (an empty decoration at position is kept, like a cursor).
+        """
+        first = bisect.bisect_left(self.__starts, position)
+        last = bisect.bisect_left(self.__starts, limit)
+        ends = self.__ends
+        dropped = set(i for i in range(first, last)
+                      if position < ends[i] <= limit)
+        if not dropped:
+            return
+        keep = [i for i in range(first, len(ends)) if i not in dropped]
+        droppedHandles = set(self.__handles[i] for i in dropped)
+        self.__tooltipCount -= len([i for i in dropped if self.__tooltips[i]])
+        self.__starts[first:] = array("l", [self.__starts[i] for i in keep])
+        self.__ends[first:] = array("l", [ends[i] for i in keep])
+        self.__formatIds[first:] = array("l", [self.__formatIds[i]
+                                               for i in keep])
+        self.__handles[first:] = array("l", [self.__handles[i] for i in keep])
+        self.__tooltips[first:] = [self.__tooltips[i] for i in keep]
+        self.__decorationHandles = dict(
+            (key, entry) for key, entry in self.__decorationHandles.items()
+            if entry[1] not in droppedHandles)
+        self.__indexes = None
+        self.__changed(min(dropped))
+
+    def selectionsInRange(self, start, end):
+        """
+        Creates the ExtraSelection of the decorations of the layer that
+        overlap the range [start, end].
+
+        :param start: Start position
+        :param end: End position
+        :return: list of QTextEdit.ExtraSelection
+        """
+        manager = self.manager
+        doc = manager.editor.document()
+        last = max(0, doc.characterCount() - 1)
+        selections = []
+        for i in self.__overlapping(start, end):
+            selection = QtGui.QTextEdit.ExtraSelection()
+            cursor = QtGui.QTextCursor(doc)
+            cursor.setPosition(min(self.__starts[i], last))
+            if self.__ends[i] != self.__starts[i]:
+                cursor.setPosition(min(self.__ends[i], last),
+                                   QtGui.QTextCursor.KeepAnchor)
+            selection.cursor = cursor
+            selection.format = manager.format(self.__formatIds[i])
+            selections.append(selection)
+        return selections
+
+    def tooltipAt(self, position):
+        """
+        Returns the tooltip of the first decoration of the layer that contains
+        the given position.
+
+        :param position: Document position
+        :return: The tooltip or None
+        """
+        if not self.__tooltipCount:
+            return None
+        for i in self.__overlapping(position, position):
+            if self.__tooltips[i] and \
+                    self.__starts[i] <= position < self.__ends[i]:
+                return self.__tooltips[i]
+        return None
+
+    def hasTooltipsInRange(self, start, end):
+        """
+        Checks if a decoration with a tooltip overlaps the range [start, end]
+        """
+        if not self.__tooltipCount:
+            return False
+        for i in self.__overlapping(start, end):
+            if self.__tooltips[i]:
+                return True
+        return False
+
+    def __overlapping(self, start, end):
+        """
+        Returns the indexes of the decorations that overlap [start, end].
+
+        Decorations are sorted by start offset and we keep the running maximum
+        of the end offsets, this allows to bisect both bounds of the query: the
+        decorations that start after the end of the range and the decorations
+        that all end before the start of the range are never visited.
+        """
+        hi = bisect.bisect_right(self.__starts, end)
+        lo = bisect.bisect_left(self.__runningMaxEnds(), start, 0, hi)
+        ends = self.__ends
+        return [i for i in range(lo, hi) if ends[i] >= start]
+
+    def __runningMaxEnds(self):
+        """
+        Returns the running maximum of the end offsets (the list is updated
+        lazily from the first index that changed).
+        """
+        maxEnds = self.__maxEnds
+        count = len(self.__ends)
+        if len(maxEnds) < count:
+            maxEnd = maxEnds[-1] if maxEnds else -1
+            for end in self.__ends[len(maxEnds):]:
+                if end > maxEnd:
+                    maxEnd = end
+                maxEnds.append(maxEnd)
+        return maxEnds
+
+    def __compact(self, decoration):
+        """
+        Returns the compact form of a TextDecoration: tuple(start, end,
+        format id, tooltip)
+        """
+        cursor = decoration.cursor
+        return (cursor.selectionStart(), cursor.selectionEnd(),
+                self.manager.registerFormat(decoration.format),
+                decoration.tooltip)
+
+    def __reset(self):
+        self.__starts = array("l")
+        self.__ends = array("l")
+        self.__formatIds = array("l")
+        self.__handles = array("l")
+        self.__tooltips = []
+        self.__maxEnds = []
+        self.__tooltipCount = 0
+        #: Maps TextDecoration ids to tuple(decoration, handle), the
+        #: decoration is kept so that its id cannot be reused by another
+        #: object
+        self.__decorationHandles = {}
+        #: Maps handles to their index, built on demand (None if outdated)
+        self.__indexes = None
+        #: Indexes (in __indexes) of the decorations removed since
+        #: __indexes was built, sorted
+        self.__removedIndexes = []
+
+    def __handleIndexes(self):
+        """
+        Returns the map handle -> index of the decorations (the indexes of
+        the decorations that follow a removed decoration are corrected with
+        __removedIndexes, so that removing decorations one by one does not
+        rebuild the map).
+        """
+        if self.__indexes is None:
+            self.__indexes = dict(zip(self.__handles,
+                                      range(len(self.__handles))))
+            self.__removedIndexes = []
+        return self.__indexes
+
+    def __changed(self, index):
+        """
+        Invalidates the running max of the end offsets from index and
+        schedules a commit.
+        """
+        del self.__maxEnds[index:]
+        manager = self.manager
+        if manager is not None:
+            manager.requestCommit()
+
+
+class DecorationManager(object):
+    """
+    Keeps the editor text decorations and commits them to the editor
+    (setExtraSelections).
+
+    Decorations are grouped into named layers (see :class:`DecorationLayer`)
+    owned by modes or panels. Decorations added through the manager (or
+    QCodeEdit.addDecoration) go to an anonymous layer per draw order.
+
+    Commits are deferred to the next event loop turn so that any number of
+    add/remove calls made in a row ends up in a single setExtraSelections.
+
+    Bulk producers may also batch their changes explicitly::
+
+        editor.decorations.beginUpdate()
+        try:
+            for deco in decorations:
+                editor.decorations.append(deco)
+        finally:
+            editor.decorations.endUpdate()
+
+    When there are more than **cullingThreshold** decorations, only the
+    decorations that intersect the visible blocks (plus **margin** lines
+    above and below) are pushed to Qt. The pushed window is updated when the
+    editor is scrolled or resized.
+
+    Decorations follow the document changes (see
+    :meth:`DecorationLayer.shift`), except the changes that only touch the
+    text formats (see :meth:`isFormatChange`).
+    """
+
+    @property
+    def editor(self):
+        """
+        Returns the editor instance
+
+        :rtype: pcef.QCodeEdit
+        """
+        return self.__editor()
+
+    def __init__(self, editor):
+        """
+        :param editor: The editor that owns the decorations
+        :type editor: pcef.QCodeEdit
+        """
+        self.__editor = weakref.ref(editor)
+        #: Layers sorted by draw order (creation order is kept for layers
+        #: that share the same draw order)
+        self.__layers = []
+        #: Sort keys of __layers: tuple(draw order, creation sequence)
+        self.__keys = []
+        #: Maps layer names to layers
+        self.__layersByName = {}
+        #: The shared format table (format id -> QTextCharFormat)
+        self.__formats = []
+        #: Maps the format keys (see _formatKey) to their id
+        self.__formatsByKey = {}
+        self.__sequence = 0
+        self.__updateDepth = 0
+        self.__formatChangeDepth = 0
+        #: (change, result) of the last isFormatChange call, the change is
+        #: tuple(position, removed, added, document revision)
+        self.__lastChange = (None, False)
+        #: (undo steps, redo steps) of the document after the last change
+        self.__undoSteps = (0, 0)
+        self.__dirty = False
+        self.__commitScheduled = False
+        #: Number of lines above and below the viewport whose decorations are
+        #: pushed to Qt when culling is active.
+        self.margin = 100
+        #: Decorations are culled to the viewport only if there are more
+        #: decorations than this threshold.
+        self.cullingThreshold = 500
+        #: Block range (first, last) of the last culled commit, None if the
+        #: last commit pushed every decoration
+        self.__window = None
+        editor.verticalScrollBar().valueChanged.connect(self.updateViewport)
+        editor.document().contentsChange.connect(self.__onContentsChange)
+        editor.blockCountChanged.connect(self.__onBlockCountChanged)
+
+    def __len__(self):
+        return sum(len(layer) for layer in self.__layers)
+
+    def __contains__(self, decoration):
+        for layer in self.__layers:
+            if decoration in layer:
+                return True
+        return False
+
+    def registerFormat(self, fmt):
+        """
+        Registers a decoration format in the shared format table and returns
+        its id. Registering an equal format twice returns the same id: formats
+        are looked up by their properties, the table only grows with distinct
+        formats.
+
+        :param fmt: QTextCharFormat
+        :return: The format id
+        """
+        key = _formatKey(fmt)
+        try:
+            return self.__formatsByKey[key]
+        except KeyError:
+            formatId = len(self.__formats)
+            self.__formats.append(QtGui.QTextCharFormat(fmt))
+            self.__formatsByKey[key] = formatId
+            return formatId
+
+    def format(self, formatId):
+        """
+        Returns the format registered with the given id
+
+        :rtype: QtGui.QTextCharFormat
+        """
+        return self.__formats[formatId]
+
+    def layer(self, name, drawOrder=0):
+        """
+        Gets a layer by name, the layer is created if it does not exist yet.
+
+        :param name: The layer name
+
+        :param drawOrder: The layer draw order (only used if the layer has to
+                          be created)
+
+        :rtype: pcef.core.DecorationLayer
+        """
+        try:
+            return self.__layersByName[name]
+        except KeyError:
+            layer = DecorationLayer(self, name, drawOrder)
+            key = (drawOrder, self.__sequence)
+            self.__sequence += 1
+            index = bisect.bisect_right(self.__keys, key)
+            self.__keys.insert(index, key)
+            self.__layers.insert(index, layer)
+            self.__layersByName[name] = layer
+            return layer
+
+    def removeLayer(self, name):
+        """
+        Removes a layer and all its decorations
+
+        :param name: The layer name
+        """
+        layer = self.__layersByName.pop(name, None)
+        if layer is not None:
+            index = self.__layers.index(layer)
+            del self.__layers[index]
+            del self.__keys[index]
+            self.requestCommit()
+
+    def layers(self):
+        """
+        Returns the list of layers, sorted by draw order
+        """
+        return list(self.__layers)
+
+    def append(self, decoration):
+        """
+        Adds a decoration to the anonymous layer of its draw order.
+
+        :param decoration: Text decoration
+        :type decoration: pcef.TextDecoration
+        """
+        drawOrder = decoration.draw_order
+        self.layer(self.__drawOrderLayerName(drawOrder),
+                   drawOrder).append(decoration)
+
+    def remove(self, decoration):
+        """
+        Removes a decoration (whatever its layer).
+
+        :param decoration: The decoration to remove
+        :type decoration: pcef.TextDecoration
+
+        :return: False if the decoration was not found, True otherwise.
+        """
+        layer = self.__layersByName.get(
+            self.__drawOrderLayerName(decoration.draw_order))
+        if layer is not None and layer.remove(decoration):
+            return True
+        for layer in self.__layers:
+            if layer.remove(decoration):
+                return True
+        return False
+
+    def clear(self):
+        """
+        Removes all decorations (of every layer)
+        """
+        self.beginUpdate()
+        for layer in self.__layers:
+            layer.clear()
+        self.endUpdate()
+
+    def beginUpdate(self):
+        """
+        Starts a batch of changes, nothing is pushed to Qt until the matching
+        endUpdate. Calls may be nested.
+        """
+        self.__updateDepth += 1
+
+    def endUpdate(self):
+        """
+        Ends a batch of changes and commits them at once (if this closes the
+        outer most batch).
+        """
+        assert self.__updateDepth > 0, "endUpdate without beginUpdate"
+        self.__updateDepth -= 1
+        if not self.__updateDepth and self.__dirty:
+            self.commit()
+
+    @property
+    def formatChanging(self):
+        """
+        True between beginFormatChange and endFormatChange: the document
+        changes only touch the text formats
+        """
+        return self.__formatChangeDepth > 0
+
+    def beginFormatChange(self):
+        """
+        Starts a change of the text formats only (e.g. a syntax highlighting
+        pass): the decorations do not move until the matching
+        endFormatChange. Calls may be nested.
+
+        Format changes are recognized without these calls when the document
+        has an undo stack (see isFormatChange).
+        """
+        self.__formatChangeDepth += 1
+
+    def endFormatChange(self):
+        """
+        Ends a change of the text formats only.
+        """
+        assert self.__formatChangeDepth > 0, \
+            "endFormatChange without beginFormatChange"
+        self.__formatChangeDepth -= 1
+
+    def isFormatChange(self, position, charsRemoved, charsAdded):
+        """
+        Checks if a document change (contentsChange signal) only touched the
+        text formats.
+
+        Qt reports the formatting of a range (e.g. a syntax highlighting pass,
+        whoever runs it) as a change of its content, of the same length. The
+        text of the range did not change if none of its blocks has been
+        edited by the last edit (an edited block gets the revision of the
+        document) and if the undo stack did not move (undo and redo restore
+        older block revisions). Documents without an undo stack keep no block
+        revisions: only the changes made between beginFormatChange and
+        endFormatChange are format changes for them.
+
+        The result is computed once per change: every contentsChange
+        listener may call this method.
+
+        :param position: Position of the change
+        :param charsRemoved: Number of removed characters
+        :param charsAdded: Number of added characters
+        """
+        doc = self.editor.document()
+        change = (position, charsRemoved, charsAdded, doc.revision())
+        if change != self.__lastChange[0]:
+            undoSteps = (doc.availableUndoSteps(), doc.availableRedoSteps())
+            result = self.__formatChangeDepth > 0 or (
+                charsRemoved == charsAdded and doc.isUndoRedoEnabled() and
+                undoSteps == self.__undoSteps and
+                not self.__hasEditedBlock(doc, position, charsAdded))
+            self.__undoSteps = undoSteps
+            self.__lastChange = (change, result)
+        return self.__lastChange[1]
+
+    @staticmethod
+    def __hasEditedBlock(doc, position, length):
+        """
+        Checks if a block of a range has been edited by the last edit of the
+        document.
+        """
+        revision = doc.revision()
+        block = doc.findBlock(position)
+        while block.isValid() and block.position() <= position + length:
+            if block.revision() == revision:
+                return True
+            block = block.next()
+        return False
+
+    def requestCommit(self):
+        """
+        Marks the decorations as dirty and schedules a commit on the next
+        event loop turn (unless we are inside a beginUpdate/endUpdate block).
+        """
+        self.__dirty = True
+        if not self.__updateDepth and not self.__commitScheduled:
+            self.__commitScheduled = True
+            QtCore.QTimer.singleShot(0, self.__onCommitTimeout)
+
+    def commit(self):
+        """
+        Pushes the decorations to the editor right now (setExtraSelections).
+
+        Commits are automatically scheduled, you only need to call this method
+        if you need the extra selections to be up to date immediately.
+        """
+        self.__commitScheduled = False
+        if self.__updateDepth:
+            return
+        editor = self.editor
+        if editor is None:
+            return
+        self.__dirty = False
+        if len(self) <= self.cullingThreshold:
+            self.__window = None
+            start, end = 0, editor.document().characterCount()
+        else:
+            first, last = self.__visibleBlockRange()
+            self.__window = (max(0, first - self.margin), last + self.margin)
+            start, end = self.__blockRangePositions(*self.__window)
+        editor.setExtraSelections(self.selectionsInRange(start, end))
+
+    def selectionsInRange(self, start, end):
+        """
+        Creates the ExtraSelection of the decorations that overlap the range
+        [start, end], sorted by draw order.
+
+        :param start: Start position
+        :param end: End position
+        """
+        selections = []
+        for layer in self.__layers:
+            selections.extend(layer.selectionsInRange(start, end))
+        return selections
+
+    def tooltipAt(self, position):
+        """
+        Returns the tooltip of the decoration found at the given position (the
+        decoration with the lowest draw order wins).
+
+        :param position: Document position
+        :return: The tooltip or None
+        """
+        for layer in self.__layers:
+            tooltip = layer.tooltipAt(position)
+            if tooltip:
+                return tooltip
+        return None
+
+    def hasVisibleTooltips(self):
+        """
+        Checks if any decoration with a tooltip intersects the visible blocks.
+        This is used to skip the cursor lookup on mouse moves.
+        """
+        start = end = None
+        for layer in self.__layers:
+            if start is None:
+                start, end = self.__blockRangePositions(
+                    *self.__visibleBlockRange())
+            if layer.hasTooltipsInRange(start, end):
+                return True
+        return False
+
+    def updateViewport(self, *args):
+        """
+        Re-commits the decorations if the viewport moved out of the window
+        that was pushed to Qt by the last culled commit.
+        """
+        if self.__window is None or self.__updateDepth:
+            return
+        first, last = self.__visibleBlockRange()
+        if first < self.__window[0] or last > self.__window[1]:
+            self.commit()
+
+    def __drawOrderLayerName(self, drawOrder):
+        """
+        Returns the name of the anonymous layer used for the decorations that
+        are added without an explicit layer.
+        """
+        return "drawOrder%d" % drawOrder
+
+    def __visibleBlockRange(self):
+        """
+        Returns the (first, last) visible block numbers
+        """
+        editor = self.editor
+        first = editor.firstVisibleBlock().blockNumber()
+        lineHeight = max(1, editor.fontMetrics().height())
+        return first, first + editor.viewport().height() // lineHeight + 1
+
+    def __blockRangePositions(self, first, last):
+        """
+        Returns the document positions range that spans the blocks between
+        first and last.
+        """
+        doc = self.editor.document()
+        start = doc.findBlockByNumber(first).position()
+        block = doc.findBlockByNumber(last)
+        if block.isValid():
+            end = block.position() + block.length()
+        else:
+            end = doc.characterCount()
+        return start, end
+
+    def __onContentsChange(self, position, charsRemoved, charsAdded):
+        """
+        Shifts the decorations offsets of every layer.
+        """
+        if self.isFormatChange(position, charsRemoved, charsAdded):
+            # the text did not change
+            return
+        for layer in self.__layers:
+            layer.shift(position, charsRemoved, charsAdded)
+
+    def __onBlockCountChanged(self, count):
+        """
+        Lines were inserted/removed, decorations may have moved in or out of
+        the culled window.
+        """
+        if self.__window is not None:
+            self.requestCommit()
+
+    def __onCommitTimeout(self):
+        if self.__commitScheduled and self.__dirty:
+            self.commit()
+        self.__commitScheduled = False
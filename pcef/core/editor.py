@@ -1,11 +1,14 @@
 """
 This module contains the definition of the QCodeEdit
 """
+import bisect
+import hashlib
 import logging
 import sys
 from pcef.core import constants
 from pcef.core.constants import PanelPosition
 from pcef.core.constants import CODE_EDIT_STYLESHEET
+from pcef.core.decoration_manager import DecorationManager
 from pcef.core.properties import PropertyRegistry
 from pcef.qt import QtGui, QtCore
 
@@ -60,7 +63,10 @@ class QCodeEdit(QtGui.QPlainTextEdit):
     @property
     def dirty(self):
         """
-        Gets the dirty flag
+        Gets the dirty flag.
+
+        The flag follows the document modification state which is maintained
+        by the undo stack (undoing back to the saved state clears the flag).
         """
         return self.__dirty
 
@@ -74,6 +80,7 @@ class QCodeEdit(QtGui.QPlainTextEdit):
 
         :param value: The new value
         """
+        self.document().setModified(value)
         if self.__dirty != value:
             self.__dirty = value
             self.dirtyChanged.emit(value)
@@ -138,6 +145,10 @@ class QCodeEdit(QtGui.QPlainTextEdit):
         QtGui.QPlainTextEdit.__init__(self, parent)
         #: The list of visible blocks, update every paintEvent
         self.__blocks = []
+        #: Sorted top positions and line numbers of the visible blocks, used
+        #: to bisect the y-position index (see linePos and lineNumber)
+        self.__blockTops = []
+        self.__blockLines = []
 
         #: The custom context menu
         self.contextMenu = QtGui.QMenu()
@@ -156,8 +167,9 @@ class QCodeEdit(QtGui.QPlainTextEdit):
         self.__filePath = None
         #: Encoding of the current file
         self.__fileEncoding = None
-        #: Original text, used to compute the control flag
-        self.__originalText = ""
+        #: Hash of the original content (last opened/saved text), only used
+        #: at explicit compare points (see isContentModified)
+        self.__originalHash = self.__hashText("")
 
         #: Dirty flag; tells if the widget text content is different from the
         #: file content
@@ -166,12 +178,14 @@ class QCodeEdit(QtGui.QPlainTextEdit):
         self.__initSettings()
         self.__initStyle()
 
-        #: The list of active extra-selections (TextDecoration)
-        self.__selections = []
+        #: The decoration manager, holds the active extra-selections
+        #: (TextDecoration). Use it directly to batch bulk changes
+        #: (beginUpdate/endUpdate).
+        self.decorations = DecorationManager(self)
 
         # connect slots
         self.blockCountChanged.connect(self.__updateViewportMargins)
-        self.textChanged.connect(self.__ontextChanged)
+        self.modificationChanged.connect(self.__onModificationChanged)
         self.updateRequest.connect(self.__updatePanels)
 
     @QtCore.Slot()
@@ -295,11 +309,26 @@ class QCodeEdit(QtGui.QPlainTextEdit):
             content = self.__encodePlainText(self.getDefaultEncoding())
         with open(filePath, "wb") as f:
             f.write(content)
+        self.__originalHash = self.__hashText(self.toPlainText())
         self.textSaved.emit(filePath)
         self.dirty = False
         self.__filePath = filePath
         return True
 
+    def isContentModified(self):
+        """
+        Checks if the current content differs from the last opened/saved
+        content by comparing content hashes.
+
+        Unlike the dirty flag, which is cheap and updated on every edit, this
+        hashes the whole document and is meant to be called at explicit
+        compare points only (e.g. to detect that the user manually reverted
+        all their changes).
+
+        :return: True if the content differs from the original content
+        """
+        return self.__hashText(self.toPlainText()) != self.__originalHash
+
     def installMode(self, mode):
         """
         Installs a mode
@@ -368,13 +397,13 @@ class QCodeEdit(QtGui.QPlainTextEdit):
         """
         Adds a text decoration
 
+        .. note:: The extra selections are updated on the next event loop
+                  turn, see :class:`pcef.core.DecorationManager`.
+
         :param decoration: Text decoration
         :type decoration: pcef.TextDecoration
         """
-        self.__selections.append(decoration)
-        self.__selections = sorted(self.__selections,
-                                   key=lambda sel: sel.draw_order)
-        self.setExtraSelections(self.__selections)
+        self.decorations.append(decoration)
 
     def removeDecoration(self, decoration):
         """
@@ -383,18 +412,13 @@ class QCodeEdit(QtGui.QPlainTextEdit):
         :param decoration: The decoration to remove
         :type decoration: pcef.TextDecoration
         """
-        try:
-            self.__selections.remove(decoration)
-            self.setExtraSelections(self.__selections)
-        except ValueError:
-            pass
+        self.decorations.remove(decoration)
 
     def clearDecorations(self):
         """
         Clears all text decorations
         """
-        self.__selections[:] = []
-        self.setExtraSelections(self.__selections)
+        self.decorations.clear()
 
     def selectFullLines(self, start, end, applySelection=True):
         """
@@ -460,10 +484,9 @@ class QCodeEdit(QtGui.QPlainTextEdit):
 
         :rtype int or None
         """
-        height = self.fontMetrics().height()
-        for top, l in self.__blocks:
-            if l == line_number:
-                return top + height / 2.0
+        i = bisect.bisect_left(self.__blockLines, line_number)
+        if i < len(self.__blockLines) and self.__blockLines[i] == line_number:
+            return self.__blockTops[i] + self.fontMetrics().height() / 2.0
         return None
 
     def lineNumber(self, y_pos):
@@ -473,9 +496,9 @@ class QCodeEdit(QtGui.QPlainTextEdit):
         :param y_pos: Y pos in the QCodeEdit
         """
         height = self.fontMetrics().height()
-        for top, l in self.__blocks:
-            if top <= y_pos <= top + height:
-                return l
+        i = bisect.bisect_right(self.__blockTops, y_pos) - 1
+        if i >= 0 and y_pos <= self.__blockTops[i] + height:
+            return self.__blockLines[i]
         return None
 
     def resetZoom(self):
@@ -662,6 +685,7 @@ class QCodeEdit(QtGui.QPlainTextEdit):
         """
         QtGui.QPlainTextEdit.resizeEvent(self, e)
         self.__resizePanels()
+        self.decorations.updateViewport()
 
     def paintEvent(self, e):
         """
@@ -766,12 +790,12 @@ class QCodeEdit(QtGui.QPlainTextEdit):
         Overrides mouseMovedEvent to display any decoration tooltip and emits
         the mouseMoved event.
         """
-        c = self.cursorForPosition(event.pos())
-        for sel in self.__selections:
-            if sel.containsCursor(c) and sel.tooltip:
+        if self.decorations.hasVisibleTooltips():
+            c = self.cursorForPosition(event.pos())
+            tooltip = self.decorations.tooltipAt(c.position())
+            if tooltip:
                 QtGui.QToolTip.showText(
-                    self.mapToGlobal(event.pos()), sel.tooltip, self)
-                break
+                    self.mapToGlobal(event.pos()), tooltip, self)
         self.mouseMoved.emit(event)
         QtGui.QPlainTextEdit.mouseMoveEvent(self, event)
 
@@ -782,14 +806,16 @@ class QCodeEdit(QtGui.QPlainTextEdit):
 
     def setPlainText(self, txt):
         """
-        Overrides the setPlainText method to keep track of the original text.
+        Overrides the setPlainText method to keep track of the original text
+        hash and reset the modification state.
 
         Emits the newTextSet signal.
 
         :param txt: The new text to set.
         """
         QtGui.QPlainTextEdit.setPlainText(self, txt)
-        self.__originalText = txt
+        self.__originalHash = self.__hashText(txt)
+        self.dirty = False
         self.__onSettingsChanged("", "", "")
         self.newTextSet.emit()
         self.redoAvailable.emit(False)
@@ -900,21 +926,41 @@ class QCodeEdit(QtGui.QPlainTextEdit):
             content = unicode(self.toPlainText()).encode(encoding)
         return content
 
+    def __hashText(self, txt):
+        """
+        Returns a digest of txt, used to compare content at save/compare
+        points.
+        """
+        if sys.version_info[0] == 3:
+            data = txt.encode("utf-8")
+        else:
+            data = unicode(txt).encode("utf-8")
+        return hashlib.md5(data).digest()
+
     def __updateVisibleBlocks(self, event):
         """
         Update the list of visible blocks/lines position.
 
+        The walk stops at the bottom of the viewport so that the cost of a
+        paint event depends on the viewport height, not on the document
+        length.
+
         :param event: paint event
         """
         self.__blocks[:] = []
+        self.__blockTops[:] = []
+        self.__blockLines[:] = []
         block = self.firstVisibleBlock()
         blockNumber = block.blockNumber()
         top = int(self.blockBoundingGeometry(block).translated(
             self.contentOffset()).top())
         bottom = top + int(self.blockBoundingRect(block).height())
-        while block.isValid():
+        viewportBottom = self.viewport().height()
+        while block.isValid() and top <= viewportBottom:
             if block.isVisible():
                 self.__blocks.append((top, blockNumber+1))
+                self.__blockTops.append(top)
+                self.__blockLines.append(blockNumber+1)
             block = block.next()
             top = bottom
             bottom = top + int(self.blockBoundingRect(block).height())
@@ -1026,12 +1072,11 @@ class QCodeEdit(QtGui.QPlainTextEdit):
         if rect.contains(self.viewport().rect()):
             self.__updateViewportMargins()
 
-    def __ontextChanged(self):
+    def __onModificationChanged(self, modified):
         """
-        Updates dirty flag on text changed.
+        Updates dirty flag when the document modification state changed.
         """
-        txt = self.toPlainText()
-        self.dirty = (txt != self.__originalText)
+        self.dirty = modified
 
     def __updateViewportMargins(self):
         """
@@ -0,0 +1,858 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCEF - Python/Qt Code Editing Framework
+# Copyright 2013, Colin Duquesnoy <colin.duquesnoy@gmail.com>
+#
+# This software is released under the LGPLv3 license.
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+This module contains a compiled lexing engine for pygments RegexLexer.
+
+Pygments tries the rules of the current state one after the other at each
+position. The engine compiles the rules of each state into a single
+alternation regex (python's alternation tries the branches in order, which is
+exactly the pygments rule order) so that a token costs one regex match.
+
+The lexer state stack is an argument and a result of :func:`lex`: lexers are
+never mutated, so a lexer can be shared by many editors and used from many
+threads.
+
+The module also contains the Qt free parts of the highlighters: the lexing of
+long blocks by chunks (:func:`lex_block`), the per line token cache
+(:class:`TokenCache`), the coalescing of the token runs into format ranges
+(:func:`format_ranges`) and the format descriptions of the styles
+(:class:`FormatDescriptions`).
+
+This module does not depend on Qt so it can be used from worker processes.
+"""
+import json
+import re
+import time
+from collections import OrderedDict
+from pygments.filter import apply_filters
+from pygments.lexer import ExtendedRegexLexer, RegexLexer
+from pygments.token import _TokenType, Error, Token, Whitespace
+from pygments.token import string_to_tokentype
+
+
+#: Patterns that cannot be combined with other patterns (group references)
+_UNSUPPORTED = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+#: Global inline flags at the start of a pattern
+_GLOBAL_FLAGS = re.compile(r'\(\?([aiLmsux]+)\)')
+
+#: Flags that can be scoped to a group (see _scoped)
+_SCOPABLE_FLAGS = ((re.IGNORECASE, "i"), (re.MULTILINE, "m"),
+                   (re.DOTALL, "s"), (re.VERBOSE, "x"))
+
+#: Compiled lexers, per token table id (the compiled lexer keeps a reference
+#: to its table so the id cannot be reused)
+_COMPILED_LEXERS = {}
+
+
+def _scoped(regex):
+    """
+    Returns the pattern of a compiled regex wrapped in a group that carries
+    its scopable flags, so that it can be combined with patterns compiled with
+    other flags.
+    """
+    pattern = regex.pattern
+    m = _GLOBAL_FLAGS.match(pattern)
+    while m:
+        # already accounted for in regex.flags
+        pattern = pattern[m.end():]
+        m = _GLOBAL_FLAGS.match(pattern)
+    on = "".join(c for flag, c in _SCOPABLE_FLAGS if regex.flags & flag)
+    off = "".join(c for flag, c in _SCOPABLE_FLAGS
+                  if not regex.flags & flag and c != "x")
+    if "x" in on:
+        # a trailing comment would swallow the closing parenthesis
+        pattern += "\n"
+    return "(?%s%s:%s)" % (on, "-" + off if off else "", pattern)
+
+
+def _unscopedFlags(regex):
+    """
+    Returns the flags of a compiled regex that cannot be scoped to a group
+    (ascii, locale, unicode...): they must be given to the combined regex.
+    """
+    flags = regex.flags
+    for flag, c in _SCOPABLE_FLAGS:
+        flags &= ~flag
+    return flags
+
+
+def _acceptsStack(function):
+    """
+    Checks if a get_tokens_unprocessed override accepts an initial stack.
+    """
+    code = getattr(function, "__code__", None)
+    return code is not None and "stack" in code.co_varnames[
+        :code.co_argcount]
+
+
+def lex(lexer, text, stack=('root',)):
+    """
+    Lexes a text from a given lexer state stack. This function is reentrant:
+    neither the lexer nor any shared object is modified.
+
+    RegexLexer are lexed with their :class:`CompiledLexer`. Lexers that post
+    process the RegexLexer tokens with a get_tokens_unprocessed override that
+    accepts a stack are lexed by pygments from the given stack, the final
+    stack is computed by the compiled lexer (see CompiledLexer.postProcessed
+    for the overrides that do not accept a stack). The filters of the lexer
+    are applied. Other lexers are stateless: the text is lexed from scratch
+    and the final stack is always the root stack.
+
+    :param lexer: The pygments lexer
+    :param text: The text to lex
+    :param stack: The lexer state stack at the start of the text
+
+    :return: tuple(tokens, stack): tokens is a list of (token type, value)
+             and stack is the state stack at the end of the text.
+    """
+    compiled = CompiledLexer.forLexer(lexer)
+    if compiled is None:
+        return list(lexer.get_tokens(text)), ('root',)
+    text = compiled.preprocess(lexer, text)
+    tokens, finalStack, pos = compiled.lexRange(lexer, text, stack)
+    if compiled.postProcessed:
+        tokens = [(token, value) for _, token, value in
+                  lexer.get_tokens_unprocessed(text, stack)]
+    if lexer.filters:
+        tokens = list(apply_filters(tokens, lexer.filters, lexer))
+    return tokens, finalStack
+
+
+class CompiledLexer(object):
+    """
+    Lexes text with the rules of a pygments RegexLexer class, using one
+    combined regex per lexer state.
+
+    Compiled lexers are shared by all the lexers that use the same token
+    table (see :meth:`forLexer`): usually all the lexers of a class, but some
+    lexers build their table per instance, depending on their options (e.g.
+    the unicodelevel option of the C# lexer). The states are compiled the
+    first time they are used.
+    States that cannot be combined (rules with group references or that fail
+    to compile together) are lexed rule by rule, as pygments does.
+
+    The tokens are identical to the tokens produced by the rules of the
+    pygments lexer (before post processing and filters, see :func:`lex`).
+    """
+
+    @staticmethod
+    def forLexer(lexer):
+        """
+        Returns the compiled lexer for a pygments lexer instance, or None if
+        the lexer is not supported (not a RegexLexer, ExtendedRegexLexer or no
+        token table).
+
+        :param lexer: pygments lexer instance
+        """
+        lexerClass = type(lexer)
+        if (not isinstance(lexer, RegexLexer) or
+                isinstance(lexer, ExtendedRegexLexer)):
+            return None
+        # the table of the instance: some lexers build it in __init__
+        tokendefs = getattr(lexer, "_tokens", None)
+        if tokendefs is None:
+            return None
+        try:
+            compiled = _COMPILED_LEXERS[id(tokendefs)]
+        except KeyError:
+            compiled = CompiledLexer(lexerClass, tokendefs)
+            _COMPILED_LEXERS[id(tokendefs)] = compiled
+        return compiled
+
+    def __init__(self, lexerClass, tokendefs):
+        """
+        :param lexerClass: The pygments lexer class
+        :param tokendefs: The processed token table of the lexer (_tokens)
+        """
+        #: The pygments lexer class
+        self.lexerClass = lexerClass
+        override = lexerClass.get_tokens_unprocessed
+        #: True if the lexer class post processes the RegexLexer tokens with
+        #: a get_tokens_unprocessed override that accepts a stack. The
+        #: overrides that do not accept a stack cannot lex a text from the
+        #: state where the previous text ended: they are skipped, these
+        #: lexers are lexed with their rules only (their state is carried
+        #: but the tokens that the override would change are left as is)
+        self.postProcessed = (override is not
+                              RegexLexer.get_tokens_unprocessed and
+                              _acceptsStack(override))
+        self.__tokendefs = tokendefs
+        #: state name -> (combined match, rule of group, rules)
+        self.__states = {}
+
+    def isCombined(self, state):
+        """
+        Checks if a state is lexed with a single combined regex.
+
+        :param state: State name
+        """
+        return self.__state(state)[0] is not None
+
+    def __state(self, name):
+        try:
+            return self.__states[name]
+        except KeyError:
+            rules = self.__tokendefs[name]
+            match, ruleOfGroup = self.__combine(rules)
+            state = (match, ruleOfGroup, rules)
+            self.__states[name] = state
+            return state
+
+    def __combine(self, rules):
+        """
+        Combines the rules of a state into one regex. Returns (match method,
+        dict group index -> rule), (None, None) if the rules cannot be
+        combined.
+        """
+        parts = []
+        ruleOfGroup = {}
+        group = 1
+        flags = None
+        for i, rule in enumerate(rules):
+            regex = getattr(rule[0], "__self__", None)
+            if regex is None or _UNSUPPORTED.search(regex.pattern):
+                return None, None
+            unscopedFlags = _unscopedFlags(regex)
+            if flags is None:
+                flags = unscopedFlags
+            elif flags != unscopedFlags:
+                return None, None
+            parts.append("(%s)" % _scoped(regex))
+            ruleOfGroup[group] = rule
+            group += 1 + regex.groups
+        if not parts:
+            return None, None
+        try:
+            return re.compile("|".join(parts), flags).match, ruleOfGroup
+        except (re.error, OverflowError, AssertionError):
+            return None, None
+
+    def isResumable(self, lexer):
+        """
+        Checks if lexRange can stop and resume in the middle of a text for
+        a lexer (no post processing and no filters).
+        """
+        return not self.postProcessed and not lexer.filters
+
+    def preprocess(self, lexer, text):
+        """
+        Applies the pygments input preprocessing, only if it changes
+        something for a block of text (newlines, BOM, tabs expansion).
+        """
+        if (u'\n' in text or u'\r' in text or text.startswith(u'\ufeff') or
+                lexer.stripall or lexer.tabsize > 0):
+            return lexer._preprocess_lexer_input(text)
+        if lexer.ensurenl:
+            return text + u'\n'
+        return text
+
+    def lex(self, lexer, text, stack=('root',)):
+        """
+        Lexes a text.
+
+        :param lexer: The lexer instance (used by rule callbacks)
+        :param text: The text to lex
+        :param stack: The lexer state stack at the start of the text
+
+        :return: tuple(tokens, stack): tokens is a list of (token type,
+                 value) and stack is the state stack at the end of the text.
+        """
+        tokens, stack, pos = self.lexRange(lexer, self.preprocess(lexer, text),
+                                           stack)
+        return tokens, stack
+
+    def lexRange(self, lexer, text, stack=('root',), start=0, stop=None,
+                 deadline=None):
+        """
+        Lexes a preprocessed text (see preprocess) from a start position
+        until a stop position or a deadline is reached. Lexing stops at a
+        token boundary and can be resumed from the returned position and
+        stack.
+
+        :param lexer: The lexer instance (used by rule callbacks)
+        :param text: The preprocessed text
+        :param stack: The lexer state stack at the start position
+        :param start: The start position
+        :param stop: Lexing stops once this position is reached (None to lex
+                     the whole text)
+        :param deadline: Lexing stops once this time (time.time()) is
+                         reached (None for no time limit)
+
+        :return: tuple(tokens, stack, position): tokens is a list of (token
+                 type, value), stack and position are the state stack and
+                 the position where lexing stopped (len(text) if the whole
+                 text has been lexed)
+        """
+        tokens = []
+        append = tokens.append
+        statestack = list(stack)
+        match, ruleOfGroup, rules = self.__state(statestack[-1])
+        pos = start
+        end = len(text)
+        if stop is None:
+            stop = end
+        count = 0
+        while 1:
+            if pos < end:
+                if pos >= stop:
+                    break
+                count += 1
+                if deadline is not None and not count & 63 and \
+                        time.time() > deadline:
+                    break
+            rule = None
+            if match is not None:
+                m = match(text, pos)
+                if m:
+                    rule = ruleOfGroup[m.lastindex]
+                    rexmatch, action, newState = rule
+                    if action is not None and type(action) is not _TokenType:
+                        # callbacks need the groups of their own regex
+                        m = rexmatch(text, pos)
+            else:
+                for rexmatch, action, newState in rules:
+                    m = rexmatch(text, pos)
+                    if m:
+                        rule = rexmatch, action, newState
+                        break
+            if rule is not None:
+                if action is not None:
+                    if type(action) is _TokenType:
+                        append((action, m.group()))
+                    else:
+                        for item in action(lexer, m):
+                            append((item[1], item[2]))
+                pos = m.end()
+                if newState is not None:
+                    # state transition
+                    if isinstance(newState, tuple):
+                        for state in newState:
+                            if state == '#pop':
+                                if len(statestack) > 1:
+                                    statestack.pop()
+                            elif state == '#push':
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(state)
+                    elif isinstance(newState, int):
+                        # pop, but keep at least one state on the stack
+                        if abs(newState) >= len(statestack):
+                            del statestack[1:]
+                        else:
+                            del statestack[newState:]
+                    elif newState == '#push':
+                        statestack.append(statestack[-1])
+                    else:
+                        assert False, "wrong state def: %r" % newState
+                    match, ruleOfGroup, rules = self.__state(statestack[-1])
+            elif pos < end:
+                if text[pos] == u'\n':
+                    # at EOL, reset state to "root"
+                    statestack = ['root']
+                    match, ruleOfGroup, rules = self.__state('root')
+                    append((Whitespace, u'\n'))
+                else:
+                    append((Error, text[pos]))
+                pos += 1
+            else:
+                break
+        return tokens, tuple(statestack), pos
+
+
+#: Block state of the blocks that have not been lexed until their end (see
+#: lex_block): the next block starts from the root state
+UNKNOWN_STATE = -2
+
+
+def is_resumable(lexer):
+    """
+    Checks if lex_block can resume the lexing of a block from a position and
+    a stack (compiled lexers without post processing nor filters). Other
+    lexers resume from the token stream of the block (see _TokenStream).
+
+    :param lexer: The pygments lexer
+    """
+    compiled = CompiledLexer.forLexer(lexer)
+    return compiled is not None and compiled.isResumable(lexer)
+
+
+class _TokenStream(object):
+    """
+    Lazy token stream of a block lexed by a lexer that cannot resume from a
+    position (see is_resumable): the pygments token generator is kept between
+    the lex_block calls. The stack at the end of the block is computed by the
+    compiled lexer, in step with the tokens.
+    """
+
+    #: Number of characters lexed at once by the compiled lexer
+    CHUNK = 4096
+
+    def __init__(self, lexer, text, stack):
+        self.__lexer = lexer
+        self.__compiled = CompiledLexer.forLexer(lexer)
+        self.__done = False
+        #: Number of characters of the tokens yielded so far
+        self.__end = 0
+        if self.__compiled is None:
+            # stateless lexer: the stack is always the root stack
+            self.__text = text
+            self.__stack, self.__pos = ('root',), len(text)
+            self.__tokens = lexer.get_tokens(text)
+            return
+        self.__text = text = self.__compiled.preprocess(lexer, text)
+        self.__stack, self.__pos = stack, 0
+        if self.__compiled.postProcessed:
+            tokens = ((token, value) for _, token, value in
+                      lexer.get_tokens_unprocessed(text, stack))
+        else:
+            tokens = self.__ruleTokens()
+        if lexer.filters:
+            tokens = apply_filters(tokens, lexer.filters, lexer)
+        self.__tokens = tokens
+
+    def __ruleTokens(self):
+        """ Yields the tokens of the compiled lexer, by chunks """
+        while self.__pos < len(self.__text):
+            tokens, self.__stack, self.__pos = self.__compiled.lexRange(
+                self.__lexer, self.__text, self.__stack, self.__pos,
+                self.__pos + self.CHUNK)
+            for token in tokens:
+                yield token
+
+    def lex(self, runs, stop, deadline):
+        """
+        Appends the next token runs of the block until stop characters or the
+        deadline is reached.
+
+        :return: tuple(stack, end, done): the stack is only meaningful once
+                 the whole block has been lexed (done)
+        """
+        count = 0
+        if not self.__done:
+            for token, value in self.__tokens:
+                runs.append((len(value), token))
+                self.__end += len(value)
+                count += 1
+                if ((stop is not None and self.__end >= stop) or
+                        (deadline is not None and not count & 63 and
+                         time.time() > deadline)):
+                    break
+            else:
+                self.__done = True
+        if self.__pos < len(self.__text):
+            # post processed lexer: move the compiled lexer to the same
+            # position, or to the end of the block once the tokens are done
+            tokens, self.__stack, self.__pos = self.__compiled.lexRange(
+                self.__lexer, self.__text, self.__stack, self.__pos,
+                None if self.__done else self.__end, deadline)
+        done = self.__done and self.__pos >= len(self.__text)
+        return self.__stack, min(self.__end, self.__pos), done
+
+
+def lex_block(lexer, text, stack, stop=None, deadline=None, resume=None):
+    """
+    Lexes a block of text (a line) starting from the given lexer state stack.
+
+    Lexing can be bounded by a number of characters and a deadline and resumed
+    later. Resumable lexers (see is_resumable) resume from the stop position
+    and stack, other lexers from the token stream of the block.
+
+    :param lexer: The pygments lexer
+    :param text: The block text
+    :param stack: The lexer state stack at the start of the block
+    :param stop: Number of characters after which lexing stops (None to lex
+                 the whole block)
+    :param deadline: time.time() value after which lexing stops (None for no
+                     time limit)
+    :param resume: The resume value of a call that stopped before the end of
+                   the block
+
+    :return: tuple(runs, stack, end, resume): runs is a list of tuple(length,
+             token type) from the start of the block, end is the position
+             where lexing stopped, stack is the lexer state stack at the end
+             of the block and resume is the value to pass to resume lexing.
+             resume is None once the whole block has been lexed, the stack is
+             meaningless until then.
+    """
+    runs = []
+    if resume is not None:
+        runs = list(resume[0])
+    if is_resumable(lexer):
+        compiled = CompiledLexer.forLexer(lexer)
+        start = 0
+        if resume is not None:
+            stack, start = resume[1], resume[2]
+        text = compiled.preprocess(lexer, text)
+        tokens, stack, end = compiled.lexRange(lexer, text, stack, start,
+                                               stop, deadline)
+        runs.extend((len(value), token) for token, value in tokens)
+        stream = None
+        done = end >= len(text)
+    else:
+        stream = (resume[3] if resume is not None else
+                  _TokenStream(lexer, text, stack))
+        stack, end, done = stream.lex(runs, stop, deadline)
+    if done:
+        return runs, stack, end, None
+    return runs, stack, end, (runs, stack, end, stream)
+
+
+class RuleScanner(object):
+    """
+    Compiles an ordered list of (regex, key) rules into one scanner regex
+    (at a given position, the first rule that matches wins) for simple
+    formats (logs, config files,...) that do not need a full pygments lexer.
+
+    Optional line rules give a key to the whole line: the first line rule
+    that matches anywhere in the line wins.
+
+    Patterns may be strings or compiled regex but must not use group
+    references (the rules groups are renumbered when they are combined).
+
+    Rules compiled with different flags are combined with scoped inline flags
+    (python >= 3.6), older pythons and rules that differ by a flag that cannot
+    be scoped (ascii, locale) are scanned rule by rule.
+    """
+
+    def __init__(self, rules, lineRules=(), flags=0):
+        """
+        :param rules: list of tuple(pattern, key)
+        :param lineRules: list of tuple(pattern, key)
+        :param flags: re flags used to compile the string patterns
+        """
+        self.__scanner, self.__keys, self.__rules = self.__combine(
+            rules, flags)
+        self.__lineScanner, self.__lineKeys, self.__lineRules = \
+            self.__combine(lineRules, flags)
+        #: The rule keys, in rules order (line rules first)
+        self.keys = []
+        for pattern, key in list(lineRules) + list(rules):
+            if key not in self.keys:
+                self.keys.append(key)
+
+    @staticmethod
+    def __combine(rules, flags):
+        """
+        Combines rules into one regex. Returns (regex, dict group index ->
+        key, list of (regex, key)), regex is None if the rules cannot be
+        combined.
+        """
+        compiled = []
+        keys = {}
+        group = 1
+        for pattern, key in rules:
+            if not hasattr(pattern, "pattern"):
+                pattern = re.compile(pattern, flags)
+            if _UNSUPPORTED.search(pattern.pattern):
+                raise ValueError("group references are not supported: %r" %
+                                 pattern.pattern)
+            compiled.append((pattern, key))
+            keys[group] = key
+            group += 1 + pattern.groups
+        if not compiled:
+            return None, keys, compiled
+        first = compiled[0][0]
+        if (not first.flags & re.VERBOSE and
+                all(regex.flags == first.flags and
+                    not _GLOBAL_FLAGS.match(regex.pattern)
+                    for regex, key in compiled)):
+            # same flags: no need to scope them
+            parts = ["(%s)" % regex.pattern for regex, key in compiled]
+            return re.compile("|".join(parts), first.flags), keys, compiled
+        flags = _unscopedFlags(first)
+        if any(_unscopedFlags(regex) != flags for regex, key in compiled):
+            # e.g. an ascii rule among unicode rules
+            return None, keys, compiled
+        try:
+            parts = ["(%s)" % _scoped(regex) for regex, key in compiled]
+            return re.compile("|".join(parts), flags), keys, compiled
+        except re.error:
+            # scoped inline flags are not supported (python < 3.6)
+            return None, keys, compiled
+
+    @staticmethod
+    def __searchRules(rules, text, pos, matches):
+        """
+        Searches the next match of a list of rules that were not combined:
+        the leftmost match, the first rule wins at a given position.
+
+        :param matches: The next match of each rule (updated)
+        :return: tuple(match, key) or (None, None)
+        """
+        best = None
+        bestKey = None
+        for i, (regex, key) in enumerate(rules):
+            m = matches[i]
+            if m is not False and (m is None or m.start() < pos):
+                # the next match of the rule moved past pos
+                m = regex.search(text, pos) or False
+                matches[i] = m
+            if m and (best is None or m.start() < best.start()):
+                best = m
+                bestKey = key
+        return best, bestKey
+
+    def scan(self, text):
+        """
+        Scans a line of text.
+
+        :param text: The line text
+
+        :return: tuple(line key, ranges): line key is the key of the first
+                 line rule that matches (None if no line rule matches), ranges
+                 is a list of (start, end, key).
+        """
+        lineKey = None
+        if self.__lineScanner is not None:
+            m = self.__lineScanner.search(text)
+            if m:
+                lineKey = self.__lineKeys[m.lastindex]
+        elif self.__lineRules:
+            m, lineKey = self.__searchRules(
+                self.__lineRules, text, 0, [None] * len(self.__lineRules))
+        ranges = []
+        if self.__scanner is not None:
+            keys = self.__keys
+            for m in self.__scanner.finditer(text):
+                start, end = m.span()
+                if end > start:
+                    ranges.append((start, end, keys[m.lastindex]))
+        elif self.__rules:
+            matches = [None] * len(self.__rules)
+            pos = 0
+            while pos <= len(text):
+                m, key = self.__searchRules(self.__rules, text, pos, matches)
+                if m is None:
+                    break
+                start, end = m.span()
+                if end > start:
+                    ranges.append((start, end, key))
+                    pos = end
+                else:
+                    pos = start + 1
+        return lineKey, ranges
+
+
+#: Whitespace runs, highlighted with the Whitespace token format
+_WHITESPACE = re.compile(r'\s+')
+
+
+def format_ranges(text, runs, getFormat):
+    """
+    Merges the token runs and the whitespace runs of a block (whitespace is
+    highlighted with the Whitespace token format) and coalesces the adjacent
+    ranges that share the same format, so that a block is formatted with as
+    few setFormat calls as possible.
+
+    :param text: The block text
+    :param runs: The token runs: list of tuple(length, token type)
+    :param getFormat: Function that returns the format of a token type
+                      (formats are compared by identity)
+
+    :return: list of [start, end, format]
+    """
+    whitespaceFormat = getFormat(Whitespace)
+    ranges = []
+
+    def add(start, end, format):
+        if ranges and ranges[-1][2] is format and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end, format])
+
+    textLength = len(text)
+    covered = min(sum(length for length, token in runs), textLength)
+    # whitespace is only formatted where the text has been lexed
+    spaces = _WHITESPACE.finditer(text, 0, covered)
+    space = next(spaces, None)
+    pos = 0
+    for length, token in runs:
+        if pos >= textLength:
+            break
+        start = pos
+        end = pos = min(pos + length, textLength)
+        format = getFormat(token)
+        while start < end:
+            while space is not None and space.end() <= start:
+                space = next(spaces, None)
+            if space is None or space.start() >= end:
+                add(start, end, format)
+                break
+            if space.start() > start:
+                add(start, space.start(), format)
+                start = space.start()
+            spaceEnd = min(space.end(), end)
+            add(start, spaceEnd, whitespaceFormat)
+            start = spaceEnd
+    return ranges
+
+
+def options_key(lexer):
+    """
+    Returns a string key of the options of a lexer (option values may not be
+    hashable, e.g. filters: they are compared by repr)
+    """
+    return repr(sorted(
+        (name, repr(value)) for name, value in lexer.options.items()))
+
+
+class TokenCache(object):
+    """
+    Bounded LRU cache that maps (line text, entry state id) to (token runs,
+    exit state id).
+
+    Source files repeat a lot of identical lines (blank lines, closing braces,
+    decorators, license headers,...) and undo/redo re-highlights the same
+    content again and again: a cache hit skips lexing entirely.
+
+    There is one cache per lexer class, token table and options (e.g. the
+    startinline option of the PHP lexer changes its tokens, the C lexers
+    created by pcef have a comment state), shared by every highlighter (see
+    :meth:`forLexer`). The hits and misses counters can be used to size the
+    cache.
+    """
+    #: Default maximum number of lines per cache
+    DEFAULT_SIZE = 20000
+
+    #: (cache, token table) per lexer class, token table id and options
+    __caches = {}
+
+    @classmethod
+    def forLexer(cls, lexer):
+        """
+        Returns the cache shared by the lexers of the same class that have the
+        same token table and the same options.
+
+        :param lexer: pygments lexer instance
+        """
+        # the cache keeps a reference to the table so its id is not reused
+        tokendefs = getattr(lexer, "_tokens", None)
+        key = (type(lexer), id(tokendefs), options_key(lexer))
+        try:
+            return cls.__caches[key][0]
+        except KeyError:
+            cache = cls()
+            cls.__caches[key] = (cache, tokendefs)
+            return cache
+
+    def __init__(self, maxSize=DEFAULT_SIZE):
+        #: Maximum number of entries
+        self.maxSize = maxSize
+        #: Number of lookups that found an entry
+        self.hits = 0
+        #: Number of lookups that did not find an entry
+        self.misses = 0
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        """
+        Returns the entry of a key (and marks it as recently used) or None.
+
+        :param key: tuple(line text, entry state id)
+        """
+        try:
+            value = self.__entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.__entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Adds an entry, the least recently used entry is evicted when the cache
+        is full.
+
+        :param key: tuple(line text, entry state id)
+        :param value: tuple(token runs, exit state id)
+        """
+        self.__entries[key] = value
+        while len(self.__entries) > self.maxSize:
+            self.__entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all the entries and resets the counters.
+        """
+        self.__entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class FormatDescriptions(object):
+    """
+    Token type -> format description table, the Qt free part of
+    :class:`pcef.core.modes.syntax_highlighter.FormatTable`.
+
+    A format description is a dict with the pygments style keys (color,
+    bgcolor, bold, italic, underline, sans, roman, mono). Tables can be saved
+    to/loaded from a JSON file (see save and load).
+    """
+    #: The pygments style keys kept in the descriptions
+    KEYS = ('color', 'bgcolor', 'bold', 'italic', 'underline', 'sans',
+            'roman', 'mono')
+
+    @classmethod
+    def describeStyle(cls, style):
+        """
+        Returns the format descriptions of a pygments style: the relevant,
+        non empty keys of the style of each token type.
+
+        :param style: pygments style class
+        :return: dict token type -> format description
+        """
+        return dict((token, dict((key, value)
+                                 for key, value in description.items()
+                                 if value and key in cls.KEYS))
+                    for token, description in style)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a table saved with :meth:`save`.
+
+        :param path: JSON file path
+        """
+        with open(path, "r") as f:
+            descriptions = json.load(f)
+        return cls(dict((string_to_tokentype(token), description)
+                        for token, description in descriptions.items()))
+
+    def __init__(self, descriptions=None):
+        """
+        :param descriptions: dict token type -> format description
+        """
+        self._descriptions = dict(descriptions or {})
+        self._descriptions.setdefault(Token, {})
+
+    def description(self, token):
+        """
+        Returns the format description of a token type (None if the token
+        type has no format of its own).
+        """
+        description = self._descriptions.get(token)
+        return dict(description) if description is not None else None
+
+    def save(self, path):
+        """
+        Saves the table to a JSON file.
+
+        :param path: JSON file path
+        """
+        with open(path, "w") as f:
+            json.dump(dict((str(token), description) for token, description
+                           in self._descriptions.items()), f, indent=1,
+                      sort_keys=True)
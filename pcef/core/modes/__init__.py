@@ -16,5 +16,6 @@ from pcef.core.modes.right_margin import RightMarginMode
 from pcef.core.modes.zoom import ZoomMode
 from pcef.core.modes.syntax_highlighter import PygmentsHighlighterMode
 from pcef.core.modes.indenter import AutoIndentMode
+from pcef.core.modes.rule_highlighter import RuleHighlighterMode
 __all__ = ["CaretLineHighlighterMode", "RightMarginMode", "ZoomMode",
-           "PygmentsHighlighterMode", "AutoIndentMode"]
+           "PygmentsHighlighterMode", "AutoIndentMode", "RuleHighlighterMode"]
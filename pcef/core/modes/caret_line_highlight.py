@@ -27,7 +27,7 @@ class CaretLineHighlighterMode(Mode):
 
     def __init__(self):
         Mode.__init__(self)
-        self.__decoration = None
+        self.__layer = None
         self.__brush = None
         self.__pos = -1
 
@@ -48,6 +48,7 @@ class CaretLineHighlighterMode(Mode):
         Installs the mode on the editor and add a style property:
             - caretLineBackground
         """
+        self.__layer = editor.decorations.layer(self.IDENTIFIER)
         Mode.install(self, editor)
         color = self.editor.style.addProperty("caretLineBackground",
                                               constants.CARET_LINE_BACKGROUND)
@@ -63,15 +64,13 @@ class CaretLineHighlighterMode(Mode):
             self.__updateHighlight()
 
     def clearDeco(self):
-        if self.__decoration:
-            self.editor.removeDecoration(self.__decoration)
+        self.__layer.clear()
 
     def __updateHighlight(self):
         """
         Updates the current line decoration
         """
-        self.clearDeco()
-        self.__decoration = TextDecoration(self.editor.textCursor())
-        self.__decoration.setBackground(self.__brush)
-        self.__decoration.setFullWidth()
-        self.editor.addDecoration(self.__decoration)
+        decoration = TextDecoration(self.editor.textCursor())
+        decoration.setBackground(self.__brush)
+        decoration.setFullWidth()
+        self.__layer.setDecorations([decoration])
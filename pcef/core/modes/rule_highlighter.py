@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCEF - Python/Qt Code Editing Framework
+# Copyright 2013, Colin Duquesnoy <colin.duquesnoy@gmail.com>
+#
+# This software is released under the LGPLv3 license.
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+This module contains a lightweight rule based syntax highlighter (and its
+mode) for large logs and simple formats that do not need a pygments lexer.
+"""
+from pcef.core import constants
+from pcef.core.lexing import RuleScanner
+from pcef.core.mode import Mode
+from pcef.core.modes.syntax_highlighter import HighlightingScheduler
+from pcef.core.system import TextStyle
+from pcef.qt import QtGui
+from pcef.qt.QtGui import QSyntaxHighlighter
+
+
+class RuleHighlighter(QSyntaxHighlighter):
+    """
+    Syntax highlighter that formats blocks with a :class:`RuleScanner`: one
+    regex scan per block, no lexer state.
+
+    The formats are given per rule key (see setFormats). Like the
+    QPygmentsHighlighter, full document highlighting is done by a
+    :class:`pcef.core.modes.syntax_highlighter.HighlightingScheduler`.
+    """
+
+    def __init__(self, parent, scanner=None):
+        """
+        :param parent: The document to highlight
+        :param scanner: The rule scanner
+        :type scanner: pcef.core.lexing.RuleScanner
+        """
+        QSyntaxHighlighter.__init__(self, parent)
+        self.enabled = True
+        #: Number of setFormat calls
+        self.formatCalls = 0
+        #: Number of highlighted blocks
+        self.highlightedBlocks = 0
+        self.__scanner = scanner
+        self.__formats = {}
+        #: Schedules full document highlighting
+        self.scheduler = HighlightingScheduler(self)
+
+    def __get_scanner(self):
+        return self.__scanner
+
+    def __set_scanner(self, scanner):
+        self.__scanner = scanner
+        self.rehighlight()
+
+    #: gets/sets the rule scanner
+    scanner = property(__get_scanner, __set_scanner)
+
+    def setFormats(self, formats):
+        """
+        Sets the formats of the rule keys and rehighlights the document.
+
+        :param formats: dict rule key -> QTextCharFormat
+        """
+        self.__formats = dict(formats)
+        self.rehighlight()
+
+    def highlightBlock(self, text):
+        """ Highlight a block of text """
+        if self.enabled is False or self.__scanner is None:
+            return
+        blockNumber = self.currentBlock().blockNumber()
+        if not self.scheduler.isBlockAllowed(blockNumber):
+            return
+        formats = self.__formats
+        lineKey, ranges = self.__scanner.scan(text)
+        if lineKey in formats:
+            self.setFormat(0, len(text), formats[lineKey])
+            self.formatCalls += 1
+        pending = None
+        for start, end, key in ranges:
+            format = formats.get(key)
+            if format is None:
+                continue
+            if pending and pending[2] is format and pending[1] == start:
+                pending[1] = end
+                continue
+            if pending:
+                self.setFormat(pending[0], pending[1] - pending[0], pending[2])
+                self.formatCalls += 1
+            pending = [start, end, format]
+        if pending:
+            self.setFormat(pending[0], pending[1] - pending[0], pending[2])
+            self.formatCalls += 1
+        self.highlightedBlocks += 1
+
+    def rehighlight(self):
+        """
+        Rehighlights the whole document (visible blocks first, see
+        :class:`pcef.core.modes.syntax_highlighter.HighlightingScheduler`).
+        """
+        self.scheduler.start()
+
+
+class RuleHighlighterMode(Mode):
+    """
+    This mode applies syntax highlighting using an ordered list of (regex,
+    style key) rules. It keeps no lexer state between blocks and is meant for
+    large logs and simple config formats.
+
+    Each style key is a style property of the editor (a TextStyle, see
+    :attr:`pcef.core.constants.DEFAULT_STYLES`, or
+    :attr:`pcef.core.constants.DEFAULT_DARK_STYLES` when the editor
+    background is dark). The default rules highlight log files.
+    """
+    #: Mode identifier
+    IDENTIFIER = "ruleHighlighter"
+    #: Mode description
+    DESCRIPTION = "Apply syntax highlighting to the editor using a list of " \
+                  "regex rules"
+
+    #: Default rules: log files
+    LOG_RULES = [
+        (r'\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(?:[.,]\d+)?|'
+         r'\d\d:\d\d:\d\d(?:[.,]\d+)?', 'logTimestamp'),
+        (r'\b(?:ERROR|CRITICAL|FATAL|Traceback)\b', 'logError'),
+        (r'\b(?:WARNING|WARN)\b', 'logWarning'),
+        (r'\bINFO\b', 'logInfo'),
+        (r'\b(?:DEBUG|TRACE)\b', 'logDebug'),
+        (r'"[^"]*"|\'[^\']*\'', 'string'),
+        (r'\b(?:0x[0-9a-fA-F]+|\d+(?:\.\d+)?)\b', 'numbers')]
+    #: Default line rules: log files
+    LOG_LINE_RULES = [(r'^\s+File "', 'logError')]
+
+    def __init__(self, rules=None, lineRules=None):
+        """
+        :param rules: list of tuple(pattern, style key), LOG_RULES by default
+        :param lineRules: list of tuple(pattern, style key) applied to the
+                          whole line, LOG_LINE_RULES by default
+        """
+        Mode.__init__(self)
+        if rules is None:
+            rules = self.LOG_RULES
+            if lineRules is None:
+                lineRules = self.LOG_LINE_RULES
+        #: The rule scanner
+        self.scanner = RuleScanner(rules, lineRules or ())
+        #: The rule highlighter
+        self.highlighter = None
+
+    def install(self, editor):
+        """
+        Installs the mode and adds a style property for each rule key.
+        """
+        self.highlighter = RuleHighlighter(editor.document(), self.scanner)
+        defaults = self.defaultStyles(editor)
+        for key in self.scanner.keys:
+            editor.style.addProperty(key, defaults.get(key, TextStyle(
+                "#000000 nbold nitalic nunderlined")))
+        self.__updateFormats(editor)
+        self.highlighter.scheduler.formatStarted.connect(
+            editor.decorations.beginFormatChange)
+        self.highlighter.scheduler.formatFinished.connect(
+            editor.decorations.endFormatChange)
+        Mode.install(self, editor)
+
+    @staticmethod
+    def defaultStyles(editor):
+        """
+        Returns the default rule styles that suit the editor background:
+        :attr:`pcef.core.constants.DEFAULT_DARK_STYLES` on a dark background,
+        :attr:`pcef.core.constants.DEFAULT_STYLES` otherwise.
+        """
+        background = QtGui.QColor(editor.style.value("background"))
+        if background.lightness() < 128:
+            return constants.DEFAULT_DARK_STYLES
+        return constants.DEFAULT_STYLES
+
+    def onStateChanged(self, state):
+        self.highlighter.enabled = state
+        if state is True:
+            self.editor.painted.connect(self.__updateViewport)
+        else:
+            self.editor.painted.disconnect(self.__updateViewport)
+        self.highlighter.rehighlight()
+
+    def onStyleChanged(self, section, key, value):
+        """ Updates the formats when a rule style changed """
+        if key in self.scanner.keys and self.highlighter is not None:
+            self.__updateFormats(self.editor)
+
+    def __updateFormats(self, editor):
+        formats = {}
+        for key in self.scanner.keys:
+            style = editor.style.value(key)
+            if not isinstance(style, TextStyle):
+                style = TextStyle(style)
+            format = QtGui.QTextCharFormat()
+            format.setForeground(QtGui.QBrush(style.color))
+            if style.bold:
+                format.setFontWeight(QtGui.QFont.Bold)
+            if style.italic:
+                format.setFontItalic(True)
+            if style.underlined:
+                format.setUnderlineStyle(QtGui.QTextCharFormat.SingleUnderline)
+            formats[key] = format
+        self.highlighter.setFormats(formats)
+
+    def __updateViewport(self, event):
+        """ Tells the highlighting scheduler which blocks are visible """
+        blocks = self.editor.visibleBlocks
+        if blocks:
+            self.highlighter.scheduler.setViewport(blocks[0][1] - 1,
+                                                   blocks[-1][1] - 1)
@@ -14,85 +14,31 @@ on pygments.
 
 .. note: This code is taken and adapted from the IPython project.
 """
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+import weakref
+from pcef.core.lexing import format_ranges, options_key, TokenCache
+from pcef.core.lexing import FormatDescriptions
+from pcef.core.lexing import lex_block, UNKNOWN_STATE
 from pcef.core.mode import Mode
+from pcef.core.system import JobRunner
+from pcef.core.system import findSettingsDirectory
 from pcef.qt import QtGui, QtCore
-from pcef.qt.QtCore import QRegExp
 from pcef.qt.QtGui import QSyntaxHighlighter
 
-from pygments.formatters.html import HtmlFormatter
-from pygments.lexer import Error
-from pygments.lexer import RegexLexer
-from pygments.lexer import Text
-from pygments.lexer import _TokenType
-from pygments.lexers.compiled import CLexer, CppLexer
-from pygments.lexers import get_lexer_for_filename
-from pygments.lexers.agile import PythonLexer
 from pygments.styles import get_style_by_name
-from pygments.token import Whitespace, Comment
-from pygments.util import ClassNotFound
+from pygments.token import Comment
+from pygments.token import string_to_tokentype, Token, STANDARD_TYPES
 
 
-def get_tokens_unprocessed(self, text, stack=('root',)):
-    """ Split ``text`` into (tokentype, text) pairs.
-
-        Monkeypatched to store the final stack on the object itself.
-    """
-    pos = 0
-    tokendefs = self._tokens
-    if hasattr(self, '_saved_state_stack'):
-        statestack = list(self._saved_state_stack)
-    else:
-        statestack = list(stack)
-    statetokens = tokendefs[statestack[-1]]
-    while 1:
-        for rexmatch, action, new_state in statetokens:
-            m = rexmatch(text, pos)
-            if m:
-                if type(action) is _TokenType:
-                    yield pos, action, m.group()
-                else:
-                    for item in action(self, m):
-                        yield item
-                pos = m.end()
-                if new_state is not None:
-                    # state transition
-                    if isinstance(new_state, tuple):
-                        for state in new_state:
-                            if state == '#pop':
-                                statestack.pop()
-                            elif state == '#push':
-                                statestack.append(statestack[-1])
-                            else:
-                                statestack.append(state)
-                    elif isinstance(new_state, int):
-                        # pop
-                        del statestack[new_state:]
-                    elif new_state == '#push':
-                        statestack.append(statestack[-1])
-                    else:
-                        assert False, "wrong state def: %r" % new_state
-                    statetokens = tokendefs[statestack[-1]]
-                break
-        else:
-            try:
-                if text[pos] == '\n':
-                    # at EOL, reset state to "root"
-                    pos += 1
-                    statestack = ['root']
-                    statetokens = tokendefs['root']
-                    yield pos, Text, '\n'
-                    continue
-                yield pos, Error, text[pos]
-                pos += 1
-            except IndexError:
-                break
-    self._saved_state_stack = list(statestack)
-
-# Monkeypatch!
-RegexLexer.get_tokens_unprocessed = get_tokens_unprocessed
-
-
-# Even with the above monkey patch to store state, multiline comments do not
+# Even with a lexer state kept per block, multiline comments do not
 # work since they are stateless (Pygments uses a single multiline regex for
 # these comments, but Qt lexes by line). So we need to add a state for comments
 # to the C and C++ lexers. This means that nested multiline comments will appear
@@ -107,112 +53,1342 @@ def replace_pattern(tokens, new_pattern):
             if isinstance(pattern, tuple) and pattern[1] == new_pattern[1]:
                 state[index] = new_pattern
 
-# More monkeypatching!
 comment_start = (r'/\*', Comment.Multiline, 'comment')
 comment_state = [(r'[^*/]', Comment.Multiline),
                  (r'/\*', Comment.Multiline, '#push'),
                  (r'\*/', Comment.Multiline, '#pop'),
                  (r'[*/]', Comment.Multiline)]
-replace_pattern(CLexer.tokens, comment_start)
-replace_pattern(CppLexer.tokens, comment_start)
-CLexer.tokens['comment'] = comment_state
-CppLexer.tokens['comment'] = comment_state
+
+
+#: Processed token tables of the C and C++ lexers with a comment state, per
+#: lexer class (see _commentTokens)
+_COMMENT_TOKENS = {}
+
+#: Protects _COMMENT_TOKENS (lexers are created by the background lexing
+#: threads too)
+_COMMENT_TOKENS_LOCK = threading.Lock()
+
+
+def _commentTokens(lexerClass):
+    """
+    Returns the processed token table of the C or C++ lexer with a comment
+    state (see above). The table is built once per class, from a copy of the
+    class tokens: the pygments class and its token tables are not modified.
+    """
+    with _COMMENT_TOKENS_LOCK:
+        try:
+            return _COMMENT_TOKENS[lexerClass]
+        except KeyError:
+            pass
+        tokens = dict((state, list(items)) for state, items in
+                      lexerClass.get_tokendefs().items())
+        replace_pattern(tokens, comment_start)
+        tokens['comment'] = comment_state
+        processed = {}
+        for state in list(tokens):
+            lexerClass._process_state(tokens, processed, state)
+        _COMMENT_TOKENS[lexerClass] = processed
+        return processed
+
+
+def create_lexer(lexerClass, **options):
+    """
+    Creates a lexer. The C and C++ lexers get a token table with a comment
+    state (see above), set on the instance: the other instances of the class
+    (e.g. the lexers of the host application) are not affected.
+
+    :param lexerClass: The pygments lexer class
+    :param options: The lexer options
+    :return: The lexer instance
+    """
+    lexer = lexerClass(**options)
+    if lexerClass.__name__ in ("CLexer", "CppLexer"):
+        from pygments.lexers import CLexer, CppLexer
+        if lexerClass in (CLexer, CppLexer):
+            lexer._tokens = _commentTokens(lexerClass)
+    return lexer
+
+
+#: Lexer classes, per file extension (or per file name for the names that
+#: have their own pygments patterns, e.g. "CMakeLists.txt")
+_LEXER_CLASSES = {}
+
+#: Pygments filename patterns that are not simple extensions ("*.ext")
+_SPECIAL_FILENAMES = None
+
+#: A simple extension pattern: a single extension without wildcards (multi
+#: extension patterns like "*.html.j2" are special filenames)
+_EXTENSION_PATTERN = re.compile(r'\*\.[^*?\[\].]+\Z')
+
+
+def lexer_class_for_filename(filename):
+    """
+    Returns the pygments lexer class of a file name. Pygments scans the
+    filename patterns of every lexer: the result is cached per extension.
+
+    The python lexer is returned if no lexer matches.
+
+    :param filename: Filename or extension
+    """
+    global _SPECIAL_FILENAMES
+    name = os.path.basename(filename)
+    extension = os.path.splitext(name)[1]
+    if _SPECIAL_FILENAMES is None:
+        from pygments.lexers._mapping import LEXERS
+        _SPECIAL_FILENAMES = re.compile("|".join(
+            fnmatch.translate(pattern) for lexer in LEXERS.values()
+            for pattern in lexer[3]
+            if not _EXTENSION_PATTERN.match(pattern)))
+    key = extension
+    if not extension or _SPECIAL_FILENAMES.match(name):
+        key = name
+    try:
+        return _LEXER_CLASSES[key]
+    except KeyError:
+        from pygments.lexers import find_lexer_class_for_filename
+        lexerClass = find_lexer_class_for_filename(name)
+        if lexerClass is None:
+            from pygments.lexers import PythonLexer
+            lexerClass = PythonLexer
+        _LEXER_CLASSES[key] = lexerClass
+        return lexerClass
+
+
+def lex_lines(lexerClass, options, lines, stack):
+    """
+    Lexes a list of lines in sequence. This is the entry point of the
+    background lexer workers: a private lexer instance is created so that this
+    function can be run in any thread or process.
+
+    :param lexerClass: The pygments lexer class
+    :param options: The lexer options
+    :param lines: The list of lines to lex
+    :param stack: The lexer state stack at the start of the first line
+
+    :return: A list of tuple(entry stack, runs, exit stack), one per line, or
+             None if lexing failed.
+    """
+    try:
+        lexer = create_lexer(lexerClass, **options)
+        results = []
+        for line in lines:
+            runs, exitStack, end, resume = lex_block(lexer, line, stack)
+            results.append((stack, runs, exitStack))
+            stack = exitStack
+        return results
+    except Exception:
+        logging.getLogger("pcef").exception("Failed to lex lines")
+        return None
+
+
+def _lexLinesInProcess(lexerClass, options, lines, stack):
+    """
+    Process pool variant of lex_lines: token types are sent back as strings
+    (unpickled token types would not be the pygments singletons).
+    """
+    results = lex_lines(lexerClass, options, lines, stack)
+    if results is not None:
+        results = [(entry, [(length, str(token)) for length, token in runs],
+                    exit) for entry, runs, exit in results]
+    return results
+
+
+#: The process pool used to lex very large documents, created on demand
+_PROCESS_POOL = None
+
+
+def _processPool():
+    global _PROCESS_POOL
+    if _PROCESS_POOL is None:
+        import multiprocessing
+        # forking the Qt process (GUI and worker threads) is not safe, the
+        # workers are spawned when possible
+        context = multiprocessing
+        if hasattr(multiprocessing, "get_context"):
+            context = multiprocessing.get_context("spawn")
+        _PROCESS_POOL = context.Pool(max(1, multiprocessing.cpu_count() - 1))
+        app = QtCore.QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(_shutdownProcessPool)
+    return _PROCESS_POOL
+
+
+def _shutdownProcessPool():
+    """
+    Stops the workers of the process pool (when the application quits).
+    """
+    global _PROCESS_POOL
+    if _PROCESS_POOL is not None:
+        pool = _PROCESS_POOL
+        _PROCESS_POOL = None
+        pool.close()
+        pool.join()
+
+
+class BackgroundLexer(QtCore.QObject):
+    """
+    Lexes a snapshot of the text of the document blocks outside of the GUI
+    thread and streams the results back to the GUI thread, by chunks of
+    blocks (see the chunkReady signal).
+
+    Documents are lexed in a thread (using a
+    :class:`pcef.core.system.JobRunner`). Processes are opt-in: when
+    processThreshold is set, documents larger than processThreshold
+    characters are lexed in a worker process so that lexing runs on a spare
+    core and does not compete for the GIL with key handling and painting.
+
+    .. warning:: The worker processes are spawned: each worker imports the
+        __main__ module of the application again, which must guard its entry
+        point with ``if __name__ == "__main__":``. Frozen applications must
+        call multiprocessing.freeze_support(). The workers run until the
+        application quits.
+    """
+    #: Value of processThreshold used when processes are enabled (see the
+    #: "lexInProcesses" editor setting)
+    PROCESS_THRESHOLD = 4 * 1024 * 1024
+
+    #: Signal emitted when a chunk of blocks has been lexed. Parameters are
+    #: the job id, the number of the first block of the chunk and the list
+    #: of lex_lines results (None if lexing failed)
+    chunkReady = QtCore.Signal(int, int, object)
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        #: Number of blocks lexed per chunk
+        self.chunkSize = 500
+        #: Documents larger than this number of characters are lexed in a
+        #: worker process instead of a thread, None (default) to never use
+        #: processes
+        self.processThreshold = None
+        self.__jobId = 0
+        self.__jobRunner = JobRunner(self, nbThreadsMax=2)
+
+    def start(self, lexer, lines, fromBlock, stack):
+        """
+        Starts lexing a snapshot of the document blocks (any job in progress
+        is cancelled).
+
+        :param lexer: The lexer to use (only its class and options are used,
+                      the instance is never shared with the worker)
+        :param lines: The text of the blocks to lex (QTextBlock.text, not
+                      the lines of QTextDocument.toPlainText: a line
+                      separator (U+2028) does not start a new block)
+        :param fromBlock: The number of the first block to lex
+        :param stack: The lexer state stack at the start of fromBlock
+
+        :return: The job id or None if the job could not be started.
+        """
+        self.__jobId += 1
+        args = (self.__jobId, type(lexer), dict(lexer.options), lines,
+                fromBlock, tuple(stack))
+        if (self.processThreshold is not None and
+                sum(len(line) for line in lines) > self.processThreshold):
+            self.__lexInProcess(*args)
+        elif not self.__jobRunner.startJob(self.__lexInThread, False, *args):
+            return None
+        return self.__jobId
+
+    def cancel(self):
+        """
+        Cancels the job in progress (its remaining chunks are discarded).
+        """
+        self.__jobId += 1
+
+    def __lexInThread(self, jobId, lexerClass, options, lines, fromBlock,
+                      stack):
+        for start in range(0, len(lines), self.chunkSize):
+            if jobId != self.__jobId:
+                return
+            results = lex_lines(lexerClass, options,
+                                lines[start:start + self.chunkSize], stack)
+            self.chunkReady.emit(jobId, fromBlock + start, results)
+            if results is None:
+                return
+            stack = results[-1][2]
+
+    def __lexInProcess(self, jobId, lexerClass, options, lines, fromBlock,
+                       stack, start=0):
+        if jobId != self.__jobId or start >= len(lines):
+            return
+        chunk = lines[start:start + self.chunkSize]
+
+        def onResults(results):
+            if results is not None:
+                results = [(entry, [(length, string_to_tokentype(token))
+                                    for length, token in runs], exit)
+                           for entry, runs, exit in results]
+            self.chunkReady.emit(jobId, fromBlock + start, results)
+            if results:
+                self.__lexInProcess(jobId, lexerClass, options, lines,
+                                    fromBlock, results[-1][2],
+                                    start + len(chunk))
+
+        _processPool().apply_async(_lexLinesInProcess,
+                                   (lexerClass, options, chunk, stack),
+                                   callback=onResults)
+
+
+class LexerStateTable(object):
+    """
+    Interns lexer state stacks to small integer ids.
+
+    The id of the lexer state stack at the end of a block is stored as the
+    block state (QSyntaxHighlighter.setCurrentBlockState). This lets Qt stop
+    propagating a rehighlight as soon as the end state of a block matches its
+    previous value.
+
+    Ids are shared by all highlighters (the table only grows with the number
+    of distinct stacks, which is small in practice).
+    """
+
+    def __init__(self):
+        self.__ids = {}
+        self.__stacks = []
+
+    def stateId(self, stack):
+        """
+        Returns the id of a state stack (the stack is interned if needed)
+
+        :param stack: The lexer state stack
+        :type stack: list or tuple of str
+
+        :rtype: int
+        """
+        stack = tuple(stack)
+        try:
+            return self.__ids[stack]
+        except KeyError:
+            self.__stacks.append(stack)
+            stateId = len(self.__stacks) - 1
+            self.__ids[stack] = stateId
+            return stateId
+
+    def stack(self, stateId):
+        """
+        Returns the state stack of a state id
+
+        :param stateId: The state id (a negative value means no state, the
+                        root stack is returned)
+
+        :rtype: tuple of str
+        """
+        if stateId < 0:
+            return ('root',)
+        return self.__stacks[stateId]
+
+
+#: The lexer state table shared by every highlighter
+LEXER_STATES = LexerStateTable()
+
+
+class HighlightingScheduler(QtCore.QObject):
+    """
+    Schedules the highlighting of a document so that the UI is never blocked
+    by a full document highlight.
+
+    The visible blocks are highlighted first, then the rest of the document
+    is highlighted in sequence, by small time budgets per event loop tick.
+
+    The scheduler kicks in when the highlighter is asked to rehighlight the
+    whole document (style or lexer change) and when a large chunk of text is
+    inserted at once (e.g. opening a file). Other changes are highlighted
+    synchronously by Qt, as usual.
+
+    The highlighter must ask the scheduler if it is allowed to highlight a
+    block (isBlockAllowed) at the start of its highlightBlock method.
+
+    Highlighters that prepare blocks ahead of time (e.g. in a worker thread)
+    may implement an isBlockReady(blockNumber) method: the sequential pass
+    then waits for the block to be ready and must be resumed (see resume).
+
+    Qt reports the formatting of a block as a change of its content (of the
+    same length): the scheduler emits formatStarted and formatFinished
+    around the blocks it highlights so that the content change listeners can
+    ignore them even if the document has no undo stack (see
+    :meth:`pcef.core.DecorationManager.isFormatChange`).
+    """
+    #: Signal emitted when a background highlighting pass started. Parameter
+    #: is the number of the first block to highlight
+    started = QtCore.Signal(int)
+
+    #: Signal emitted when a background highlighting pass finished
+    finished = QtCore.Signal()
+
+    #: Signal emitted before the scheduler highlights blocks (only the text
+    #: formats change until formatFinished)
+    formatStarted = QtCore.Signal()
+
+    #: Signal emitted after the scheduler highlighted blocks
+    formatFinished = QtCore.Signal()
+
+    def __init__(self, highlighter):
+        """
+        :param highlighter: The highlighter to schedule.
+        :type highlighter: QtGui.QSyntaxHighlighter
+        """
+        QtCore.QObject.__init__(self, highlighter)
+        self.__highlighter = weakref.ref(highlighter)
+        #: Time budget (in ms) spent highlighting blocks per event loop tick
+        self.budget = 20
+        #: Number of inserted blocks above which the new blocks are
+        #: highlighted in the background
+        self.syncLimit = 1000
+        #: Blocks before the frontier have been highlighted in sequence
+        self.__frontier = 0
+        self.__running = False
+        #: True while Qt highlights a large insertion that we will highlight
+        #: in the background: every block is skipped
+        self.__suspended = False
+        #: Block number currently highlighted by the scheduler
+        self.__forced = -1
+        #: Visible block range (first, last)
+        self.__viewport = (0, -1)
+        #: Blocks after the frontier that have already been highlighted
+        self.__ahead = set()
+        self.__blockCount = highlighter.document().blockCount()
+        self.__timer = QtCore.QTimer(self)
+        self.__timer.setInterval(0)
+        self.__timer.timeout.connect(self.__tick)
+        highlighter.document().contentsChange.connect(
+            self.__onContentsChange)
+
+    @property
+    def running(self):
+        """
+        True if a background highlighting pass is in progress
+        """
+        return self.__running
+
+    @property
+    def frontier(self):
+        """
+        Number of the next block highlighted in sequence (the blocks before
+        it have been highlighted)
+        """
+        return self.__frontier
+
+    def start(self, fromBlock=0):
+        """
+        Starts (or restarts) a background highlighting pass.
+
+        :param fromBlock: The block number from which the document must be
+                          highlighted
+        """
+        if self.__running:
+            fromBlock = min(fromBlock, self.__frontier)
+        self.__frontier = fromBlock
+        self.__running = True
+        self.__ahead.clear()
+        self.__timer.start()
+        self.started.emit(fromBlock)
+
+    def resume(self):
+        """
+        Resumes a pass that was waiting for the next block to be ready.
+        """
+        if self.__running:
+            self.__timer.start()
+
+    def setViewport(self, first, last):
+        """
+        Sets the visible block range, visible blocks are highlighted first.
+
+        :param first: First visible block number
+        :param last: Last visible block number
+        """
+        if (first, last) != self.__viewport:
+            self.__viewport = (first, last)
+            if self.__running:
+                self.__timer.start()
+
+    def isBlockAllowed(self, blockNumber):
+        """
+        Checks if a block can be highlighted now.
+
+        :param blockNumber: The block number
+        """
+        if self.__running:
+            if self.__suspended:
+                return False
+            if blockNumber < self.__frontier or blockNumber == self.__forced:
+                return True
+            first, last = self.__viewport
+            if first <= blockNumber <= last:
+                self.__ahead.add(blockNumber)
+                return True
+            return False
+        highlighter = self.__highlighter()
+        inserted = highlighter.document().blockCount() - self.__blockCount
+        if inserted > self.syncLimit:
+            # Qt is about to highlight a large insertion synchronously, skip
+            # it and highlight it in the background instead
+            self.start(blockNumber)
+            self.__suspended = True
+            return False
+        return True
+
+    def highlightBlocks(self, blocks):
+        """
+        Highlights blocks right now (e.g. blocks whose lexing was deferred).
+
+        :param blocks: list of QTextBlock
+        """
+        if not blocks:
+            return
+        self.formatStarted.emit()
+        try:
+            for block in blocks:
+                self.__highlightBlock(block)
+        finally:
+            self.formatFinished.emit()
+
+    def __highlightBlock(self, block):
+        self.__forced = block.blockNumber()
+        self.__highlighter().rehighlightBlock(block)
+        self.__forced = -1
+
+    def __tick(self):
+        """
+        Highlights the visible blocks then the next blocks after the frontier
+        until the time budget is exhausted.
+        """
+        self.formatStarted.emit()
+        try:
+            self.__highlightPending()
+        finally:
+            self.formatFinished.emit()
+
+    def __highlightPending(self):
+        self.__suspended = False
+        highlighter = self.__highlighter()
+        isBlockReady = getattr(highlighter, "isBlockReady", None)
+        doc = highlighter.document()
+        deadline = time.time() + self.budget / 1000.0
+        first, last = self.__viewport
+        for blockNumber in range(max(first, self.__frontier), last + 1):
+            if blockNumber not in self.__ahead:
+                block = doc.findBlockByNumber(blockNumber)
+                if not block.isValid():
+                    break
+                self.__highlightBlock(block)
+                self.__ahead.add(blockNumber)
+        block = doc.findBlockByNumber(self.__frontier)
+        while block.isValid() and time.time() < deadline:
+            if isBlockReady and not isBlockReady(self.__frontier):
+                # wait for the block to be ready, see resume
+                self.__timer.stop()
+                return
+            self.__highlightBlock(block)
+            self.__ahead.discard(self.__frontier)
+            self.__frontier += 1
+            block = block.next()
+        if not block.isValid():
+            self.__running = False
+            self.__ahead.clear()
+            self.__timer.stop()
+            self.finished.emit()
+
+    def __onContentsChange(self, position, charsRemoved, charsAdded):
+        """
+        Keeps the frontier in sync when lines are inserted/removed.
+        """
+        doc = self.__highlighter().document()
+        count = doc.blockCount()
+        delta = count - self.__blockCount
+        self.__blockCount = count
+        if delta and self.__running:
+            self.__ahead.clear()
+            blockNumber = doc.findBlock(position).blockNumber()
+            if blockNumber < self.__frontier:
+                self.__frontier = max(blockNumber, self.__frontier + delta)
+
+
+class FormatTable(FormatDescriptions):
+    """
+    Immutable token type -> QTextCharFormat table, compiled once from a
+    pygments style (or a CSS stylesheet) by walking its whole token
+    hierarchy, so that no format is created while highlighting.
+
+    Tables are shared: fromStyle and fromStyleSheet return the same table for
+    the same style, and the formats are shared by every highlighter using it
+    (they must not be modified). Tokens without a format use the format of
+    their closest parent.
+
+    Tables can be saved to/loaded from a JSON file (see
+    :class:`pcef.core.lexing.FormatDescriptions`).
+    """
+    #: Compiled tables, per style class or stylesheet
+    __tables = {}
+
+    @classmethod
+    def fromStyle(cls, style):
+        """
+        Returns the format table of a pygments style class.
+
+        :param style: pygments style class
+        """
+        try:
+            return cls.__tables[style]
+        except KeyError:
+            table = cls(cls.describeStyle(style))
+            cls.__tables[style] = table
+            return table
+
+    @classmethod
+    def fromStyleSheet(cls, stylesheet):
+        """
+        Returns the format table of a CSS stylesheet. The classes in the
+        stylesheet should correspond to those generated by:
+
+            pygmentize -S <style> -f html
+
+        :param stylesheet: CSS stylesheet
+        """
+        try:
+            return cls.__tables[stylesheet]
+        except KeyError:
+            from pygments.formatters.html import HtmlFormatter
+            formatter = HtmlFormatter(nowrap=True)
+            document = QtGui.QTextDocument()
+            document.setDefaultStyleSheet(stylesheet)
+            descriptions = {}
+            for token in STANDARD_TYPES:
+                code, html = next(formatter._format_lines([(token, 'dummy')]))
+                document.setHtml(html)
+                descriptions[token] = cls.__describeFormat(
+                    QtGui.QTextCursor(document).charFormat())
+            table = cls(descriptions)
+            cls.__tables[stylesheet] = table
+            return table
+
+    def __init__(self, descriptions=None):
+        """
+        :param descriptions: dict token type -> format description (see
+                             :class:`pcef.core.lexing.FormatDescriptions`)
+        """
+        FormatDescriptions.__init__(self, descriptions)
+        self.__formats = {}
+        formats = {}
+        brushes = {}
+        for token, description in self._descriptions.items():
+            key = tuple(sorted(description.items()))
+            if key not in formats:
+                formats[key] = self.__createFormat(description, brushes)
+            self.__formats[token] = formats[key]
+
+    def format(self, token):
+        """
+        Returns the format of a token type.
+
+        :param token: pygments token type
+        :rtype: QtGui.QTextCharFormat
+        """
+        formats = self.__formats
+        while token not in formats:
+            token = token.parent
+            if token is None:
+                return formats[Token]
+        return formats[token]
+
+    @staticmethod
+    def __describeFormat(format):
+        """
+        Describes a QTextCharFormat with the pygments style keys.
+        """
+        description = {}
+        if format.hasProperty(QtGui.QTextFormat.ForegroundBrush):
+            description['color'] = format.foreground().color().name()[1:]
+        if format.hasProperty(QtGui.QTextFormat.BackgroundBrush):
+            description['bgcolor'] = format.background().color().name()[1:]
+        if format.fontWeight() >= QtGui.QFont.Bold:
+            description['bold'] = True
+        if format.fontItalic():
+            description['italic'] = True
+        if format.fontUnderline():
+            description['underline'] = True
+        return description
+
+    @staticmethod
+    def __createFormat(description, brushes):
+        """
+        Creates the QTextCharFormat of a format description.
+        """
+        def brush(color):
+            if color not in brushes:
+                rgb = str(color).replace("#", "")
+                qcolor = QtGui.QColor()
+                qcolor.setRgb(int(rgb[:2], base=16),
+                              int(rgb[2:4], base=16),
+                              int(rgb[4:6], base=16))
+                brushes[color] = QtGui.QBrush(qcolor)
+            return brushes[color]
+
+        result = QtGui.QTextCharFormat()
+        for key, value in description.items():
+            if value:
+                if key == 'color':
+                    result.setForeground(brush(value))
+                elif key == 'bgcolor':
+                    result.setBackground(brush(value))
+                elif key == 'bold':
+                    result.setFontWeight(QtGui.QFont.Bold)
+                elif key == 'italic':
+                    result.setFontItalic(True)
+                elif key == 'underline':
+                    result.setUnderlineStyle(
+                        QtGui.QTextCharFormat.SingleUnderline)
+                elif key == 'sans':
+                    result.setFontStyleHint(QtGui.QFont.SansSerif)
+                elif key == 'roman':
+                    result.setFontStyleHint(QtGui.QFont.Times)
+                elif key == 'mono':
+                    result.setFontStyleHint(QtGui.QFont.TypeWriter)
+        return result
 
 
 class PygmentsBlockUserData(QtGui.QTextBlockUserData):
     """ Storage for the user data associated with each line.
+
+    Keeps the token runs of the block so that the formats can be re-applied
+    without lexing (e.g. when the style changed). The data is kept by the
+    highlighter (see QPygmentsHighlighter.blockData), not set on the block.
+    The runs are only valid for the lexer class, the text (hash) and the
+    entry state they were lexed from.
+    The runs list is shared with the token cache.
     """
 
-    syntax_stack = ('root',)
+    lexerClass = None
+    textHash = None
+    entryState = -1
+    runs = ()
+    exitState = -1
+    #: lex_block resume value of a block that has not been lexed until its
+    #: end, None if the block has been fully lexed
+    resume = None
+    #: Number of characters of the block that must be lexed
+    wanted = 0
 
     def __init__(self, **kwds):
         for key, value in kwds.items():
             setattr(self, key, value)
         QtGui.QTextBlockUserData.__init__(self)
 
+    def isValid(self, lexerClass, textHash, entryState):
+        """
+        Checks if the stored runs can be used for the current block content.
+        """
+        return (self.lexerClass is lexerClass and
+                self.textHash == textHash and self.entryState == entryState)
+
     def __repr__(self):
-        attrs = ['syntax_stack']
-        kwds = ', '.join(['%s=%r' % (attr, getattr(self, attr)) for attr in attrs])
+        attrs = ['lexerClass', 'entryState', 'runs', 'exitState']
+        kwds = ', '.join(['%s=%r' % (attr, getattr(self, attr))
+                          for attr in attrs])
         return 'PygmentsBlockUserData(%s)' % kwds
 
 
+class HighlightCache(object):
+    """
+    Persistent, on-disk cache of the highlighting results of files (lexer
+    states and token runs of every block), so that reopening a big file does
+    not lex it again.
+
+    Entries are keyed by the file path and validated with the lexer class
+    and options, the file size, mtime and content hash: if they match, the
+    cached blocks are restored as is. Otherwise, blocks are matched by their
+    text checksum and length and the blocks that differ are lexed as usual.
+
+    The cache size is capped, the least recently used entries are evicted.
+
+    The cache is ignored if the cache directory or the file cannot be
+    accessed (e.g. read-only directory, file deleted or renamed).
+
+    .. note:: The cache is restored once the text is set: documents that have
+              fewer blocks than the scheduler syncLimit have already been
+              highlighted synchronously by then, so the cache only spares
+              the lexing of larger documents (see
+              :attr:`HighlightingScheduler.syncLimit`).
+    """
+    #: Cache entries format version
+    VERSION = 3
+    #: Default maximum size of the cache directory (in bytes)
+    DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, directory=None, maxSize=DEFAULT_MAX_SIZE):
+        """
+        :param directory: The cache directory, by default a "highlightCache"
+                          directory in the settings directory (see
+                          :func:`pcef.core.system.findSettingsDirectory`)
+        :param maxSize: Maximum size of the cache directory (in bytes)
+        """
+        self.__directory = directory
+        #: Maximum size of the cache directory (in bytes)
+        self.maxSize = maxSize
+        #: file path -> key of the last saved/restored entry
+        self.__keys = {}
+
+    @property
+    def directory(self):
+        """
+        The cache directory (created on demand)
+
+        :raise OSError: if the directory cannot be created
+        """
+        if self.__directory is None:
+            self.__directory = os.path.join(findSettingsDirectory(),
+                                            "highlightCache")
+        if not os.path.exists(self.__directory):
+            os.makedirs(self.__directory)
+        return self.__directory
+
+    def fileKey(self, filePath, text):
+        """
+        Returns the key of a file: [path, size, mtime, content hash]
+
+        :raise OSError: if the file does not exist anymore
+        """
+        stat = os.stat(filePath)
+        return [os.path.abspath(filePath), stat.st_size, stat.st_mtime,
+                hashlib.md5(_utf8(text)).hexdigest()]
+
+    def restore(self, highlighter, filePath):
+        """
+        Restores the cached highlighting results of a file in the blocks of
+        the highlighter document and re-applies the formats.
+
+        :param highlighter: The highlighter
+        :type highlighter: QPygmentsHighlighter
+        :param filePath: The file path
+
+        :return: The number of restored blocks
+        """
+        try:
+            entryPath = self.__entryPath(filePath)
+            with open(entryPath, "rb") as f:
+                entry = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+            # mark the entry as recently used
+            os.utime(entryPath, None)
+        except (IOError, OSError, ValueError, zlib.error):
+            return 0
+        lexerClass = type(highlighter._lexer)
+        if (entry.get("version") != self.VERSION or
+                entry.get("lexer") != _className(lexerClass) or
+                entry.get("options") != options_key(highlighter._lexer) or
+                entry.get("key", [None])[0] != os.path.abspath(filePath)):
+            return 0
+        document = highlighter.document()
+        try:
+            key = self.fileKey(filePath, document.toPlainText())
+        except (IOError, OSError):
+            return 0
+        identical = entry["key"] == key
+        states = [LEXER_STATES.stateId(stack) for stack in entry["stacks"]]
+        tokens = [string_to_tokentype(token) for token in entry["tokens"]]
+        blocks = entry["blocks"]
+        blocksByChecksum = None
+        restored = 0
+        block = document.firstBlock()
+        blockNumber = 0
+        while block.isValid():
+            text = block.text()
+            if identical:
+                cached = (blocks[blockNumber] if blockNumber < len(blocks)
+                          else None)
+            else:
+                checksum = (zlib.crc32(_utf8(text)), len(text))
+                if blockNumber < len(blocks) and \
+                        tuple(blocks[blockNumber][:2]) == checksum:
+                    cached = blocks[blockNumber]
+                else:
+                    if blocksByChecksum is None:
+                        blocksByChecksum = dict(
+                            (tuple(cached[:2]), cached)
+                            for cached in reversed(blocks))
+                    cached = blocksByChecksum.get(checksum)
+            if cached is not None:
+                crc, length, entryIndex, exitIndex, flatRuns = cached
+                data = highlighter.blockData(block, create=True)
+                data.lexerClass = lexerClass
+                data.textHash = hash(text)
+                data.entryState = states[entryIndex]
+                data.runs = [(flatRuns[i], tokens[flatRuns[i + 1]])
+                             for i in range(0, len(flatRuns), 2)]
+                data.exitState = states[exitIndex]
+                restored += 1
+            block = block.next()
+            blockNumber += 1
+        if identical:
+            self.__keys[key[0]] = key
+        if restored:
+            highlighter.reformat()
+        return restored
+
+    def save(self, highlighter, filePath):
+        """
+        Saves the highlighting results of a file. Nothing is saved if a block
+        has not been highlighted yet or if the entry is up to date.
+
+        :param highlighter: The highlighter
+        :type highlighter: QPygmentsHighlighter
+        :param filePath: The file path
+
+        :return: True if the entry has been written
+        """
+        document = highlighter.document()
+        try:
+            key = self.fileKey(filePath, document.toPlainText())
+        except (IOError, OSError):
+            # the file has been deleted or renamed
+            return False
+        if self.__keys.get(key[0]) == key:
+            return False
+        lexerClass = type(highlighter._lexer)
+        stacks = {}
+        tokens = {}
+        blocks = []
+        block = document.firstBlock()
+        # the entry state of a block is the exit state of the previous block
+        previousState = -1
+        while block.isValid():
+            text = block.text()
+            data = highlighter.blockData(block)
+            entryState = LEXER_STATES.stateId(
+                highlighter._stackFromState(previousState))
+            # blocks that have not been lexed until their end are not saved
+            if (data is None or data.exitState == UNKNOWN_STATE or
+                    not data.isValid(lexerClass, hash(text), entryState)):
+                return False
+            previousState = block.userState()
+            flatRuns = []
+            for length, token in data.runs:
+                flatRuns.append(length)
+                flatRuns.append(tokens.setdefault(token, len(tokens)))
+            blocks.append([zlib.crc32(_utf8(text)), len(text),
+                           stacks.setdefault(data.entryState, len(stacks)),
+                           stacks.setdefault(data.exitState, len(stacks)),
+                           flatRuns])
+            block = block.next()
+        entry = {
+            "version": self.VERSION, "key": key,
+            "lexer": _className(lexerClass),
+            "options": options_key(highlighter._lexer),
+            "stacks": [LEXER_STATES.stack(state) for state in
+                       sorted(stacks, key=stacks.get)],
+            "tokens": [str(token) for token in sorted(tokens,
+                                                      key=tokens.get)],
+            "blocks": blocks}
+        try:
+            entryPath = self.__entryPath(filePath)
+            with open(entryPath + ".tmp", "wb") as f:
+                f.write(zlib.compress(json.dumps(entry).encode("utf-8")))
+            if os.path.exists(entryPath):
+                os.remove(entryPath)
+            os.rename(entryPath + ".tmp", entryPath)
+        except (IOError, OSError):
+            logging.getLogger("pcef").exception(
+                "Failed to save the highlight cache of %s" % filePath)
+            return False
+        self.__keys[key[0]] = key
+        self.__evict()
+        return True
+
+    def __entryPath(self, filePath):
+        name = hashlib.sha1(_utf8(os.path.abspath(filePath))).hexdigest()
+        return os.path.join(self.directory, name + ".json.z")
+
+    def __evict(self):
+        """
+        Removes the least recently used entries until the cache size is below
+        maxSize.
+        """
+        entries = []
+        total = 0
+        try:
+            directory = self.directory
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed meanwhile
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        while total > self.maxSize and entries:
+            mtime, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+def _className(cls):
+    return "%s.%s" % (cls.__module__, cls.__name__)
+
+
+def _utf8(text):
+    """
+    Encodes text to utf-8, lone surrogates included (they are valid in a
+    QString and in the file names decoded with surrogateescape).
+    """
+    return text.encode("utf-8", "surrogatepass")
+
+
 class QPygmentsHighlighter(QSyntaxHighlighter):
     """ Syntax highlighter that uses Pygments for parsing.
     """
 
     hilighlightingBlock = QtCore.Signal(str, QSyntaxHighlighter)
 
-    #---------------------------------------------------------------------------
+    # -------------------------------------------------------------------------
     # 'QSyntaxHighlighter' interface
-    #---------------------------------------------------------------------------
+    # -------------------------------------------------------------------------
 
     def __init__(self, parent, lexer=None):
         super(QPygmentsHighlighter, self).__init__(parent)
 
-        self._document = QtGui.QTextDocument()
-        self._formatter = HtmlFormatter(nowrap=True)
-        self._lexer = lexer if lexer else PythonLexer()
+        self._style = None
+        self._formatTable = FormatTable()
+        if lexer is None:
+            lexer = create_lexer(lexer_class_for_filename("file.py"))
+        self._lexer = lexer
+        #: Per line token cache, shared with the highlighters that use the
+        #: same lexer class
+        self.tokenCache = TokenCache.forLexer(self._lexer)
+        #: Number of setFormat calls (divide by highlightedBlocks to get the
+        #: number of calls per block)
+        self.formatCalls = 0
+        #: Number of highlighted blocks
+        self.highlightedBlocks = 0
+        #: Number of characters of a block that are lexed at once, the rest
+        #: of a longer block is left unformatted and lexed lazily (see
+        #: ensureColumnLexed)
+        self.maxBlockLength = 10000
+        #: Time budget (in ms) to lex a block, 0 to disable
+        self.blockTimeBudget = 50
+        #: Last visible column and block range (see ensureColumnLexed)
+        self.__column = 0
+        self.__columnRange = (0, -1)
+        self.__columnTimer = QtCore.QTimer(self)
+        self.__columnTimer.setSingleShot(True)
+        self.__columnTimer.setInterval(0)
+        self.__columnTimer.timeout.connect(self.__onColumnTimer)
         self.enabled = True
-        # QTextBlockUserData is buggy on PyQt 4.9; so we implement our own way
-        # keeping user data foreach line.
-        self.user_datas = {}  # line_nbr: user_data
+        # QTextBlockUserData is buggy on PyQt 4.9 (the data is garbage
+        # collected while Qt still uses it), so we keep the block data in our
+        # own table. Blocks are keyed by their fragment index, which does not
+        # change when lines are inserted above them. The index of a deleted
+        # block may be reused: its data is then rejected by
+        # PygmentsBlockUserData.isValid (other text hash or entry state).
+        self.__blockDatas = {}
+        #: Schedules full document highlighting (visible blocks first, then
+        #: the rest of the document in the background)
+        self.scheduler = HighlightingScheduler(self)
+        self.scheduler.started.connect(self.__startBackgroundLexing)
+        #: Lexes the document outside of the GUI thread during the scheduler
+        #: passes
+        self.backgroundLexer = BackgroundLexer(self)
+        self.backgroundLexer.chunkReady.connect(self.__onChunkReady)
+        #: Minimum number of blocks to highlight for the lexing to be done
+        #: by the background lexer
+        self.backgroundThreshold = 2000
+        #: Background lexer results: block number -> (entry stack, runs,
+        #: exit stack)
+        self.__precomputed = {}
+        self.__jobId = None
+        self.__relex = True
+        self.__jobRevision = -1
+        self.__jobStart = 0
+        self.__jobEnd = 0
 
     def setLexerFromFilename(self, filename):
         """
         Change the lexer based on the filename (actually only the extension is
         needed)
 
+        The document is rehighlighted if the lexer changed (block states of
+        the previous lexer are meaningless for the new one).
+
         :param filename: Filename or extension
         """
-        try:
-            self._lexer = get_lexer_for_filename(filename)
-        except ClassNotFound:
-            self._lexer = PythonLexer()
+        lexerClass = lexer_class_for_filename(filename)
+        if lexerClass is not type(self._lexer):
+            self._lexer = create_lexer(lexerClass)
+            self.tokenCache = TokenCache.forLexer(self._lexer)
+            # the data of the previous lexer is meaningless
+            self.__blockDatas.clear()
+            self.rehighlight()
+
+    def blockData(self, block, create=False):
+        """
+        Returns the data (token runs, states) of a block, None if the block
+        has not been highlighted yet.
+
+        :param block: The QTextBlock
+        :param create: True to create the data of a block that has none
+        :rtype: PygmentsBlockUserData
+        """
+        index = block.fragmentIndex()
+        data = self.__blockDatas.get(index)
+        if data is None and create:
+            data = PygmentsBlockUserData()
+            self.__blockDatas[index] = data
+        return data
 
     def highlightBlock(self, text):
         """ Highlight a block of text """
         if self.enabled is False:
             return
+        blockNumber = self.currentBlock().blockNumber()
+        if not self.scheduler.isBlockAllowed(blockNumber):
+            return
         original_text = text
-        line_nbr = self.currentBlock().previous().blockNumber()
-        prev_data = None
-        if line_nbr in self.user_datas:
-            prev_data = self.user_datas[line_nbr]
-        if prev_data is not None and hasattr(prev_data, "syntax_stack"):
-            self._lexer._saved_state_stack = prev_data.syntax_stack
-        elif hasattr(self._lexer, '_saved_state_stack'):
-            del self._lexer._saved_state_stack
-
-        # Lex the text using Pygments
-        index = 0
-        for token, text in self._lexer.get_tokens(text):
-            length = len(text)
-            self.setFormat(index, length, self._get_format(token))
-            index += length
-
-        if hasattr(self._lexer, '_saved_state_stack'):
-            data = PygmentsBlockUserData(
-                syntax_stack=self._lexer._saved_state_stack)
-            self.user_datas[self.currentBlock().blockNumber()] = data
-            # self.currentBlock().setUserData(data)
-            # print type(data)
-            # Clean up for the next go-round.
-            del self._lexer._saved_state_stack
-
-        #Spaces
-        expression = QRegExp('\s+')
-        index = expression.indexIn(original_text, 0)
-        while index >= 0:
-            index = expression.pos(0)
-            length = len(expression.cap(0))
-            self.setFormat(index, length, self._get_format(Whitespace))
-            index = expression.indexIn(original_text, index + length)
+        stack = self._entryStack()
+        entryState = LEXER_STATES.stateId(stack)
+        lexerClass = type(self._lexer)
+        textHash = hash(text)
+        result = self.__takePrecomputed(stack)
+        data = self.blockData(self.currentBlock(), create=True)
+        if data.isValid(lexerClass, textHash, entryState):
+            if data.resume is not None and data.wanted > data.resume[2]:
+                # a long block scrolled into view horizontally: lex the
+                # next chunk
+                self.__lexLongBlock(data, text, stack)
+            # else only the formats changed (e.g. style change), no need to
+            # lex
+        else:
+            data.lexerClass = lexerClass
+            data.textHash = textHash
+            data.entryState = entryState
+            data.resume = None
+            key = (text, entryState)
+            cached = None
+            if len(text) <= self.maxBlockLength:
+                cached = self.tokenCache.get(key)
+            if cached is not None:
+                data.runs, data.exitState = cached
+            elif result is not None:
+                data.runs, data.exitState = result[0], LEXER_STATES.stateId(
+                    result[1])
+            else:
+                data.wanted = self.__column + self.maxBlockLength
+                data.runs = []
+                self.__lexLongBlock(data, text, stack)
+            if data.resume is None and len(text) <= self.maxBlockLength:
+                self.tokenCache.put(key, (data.runs, data.exitState))
+        runs = data.runs
+        exitState = data.exitState
+        for start, end, format in self._formatRanges(text, runs):
+            if format.propertyCount():
+                self.setFormat(start, end - start, format)
+                self.formatCalls += 1
+        self.highlightedBlocks += 1
+
+        # store the end state, Qt will highlight the next block only if it
+        # changed.
+        self.setCurrentBlockState(exitState)
 
         self.hilighlightingBlock.emit(original_text, self)
 
-    #---------------------------------------------------------------------------
+    def __lexLongBlock(self, data, text, stack):
+        """
+        Lexes a block until data.wanted characters or the time budget
+        (blockTimeBudget) is reached. The exit state of a block that has not
+        been lexed until its end is UNKNOWN_STATE, the lexing is resumed when
+        more characters are wanted (see ensureColumnLexed).
+        """
+        deadline = None
+        if self.blockTimeBudget:
+            deadline = time.time() + self.blockTimeBudget / 1000.0
+        data.runs, stack, end, data.resume = lex_block(
+            self._lexer, text, stack, stop=data.wanted, deadline=deadline,
+            resume=data.resume)
+        if data.resume is None:
+            data.exitState = LEXER_STATES.stateId(stack)
+        else:
+            data.exitState = UNKNOWN_STATE
+
+    def ensureColumnLexed(self, firstBlock, lastBlock, column):
+        """
+        Makes sure the blocks of a range are lexed (at least) until a column,
+        the long blocks that have been partially lexed (see maxBlockLength)
+        are lexed lazily, by chunks, when they scroll into view horizontally.
+
+        The blocks are lexed within the time budget (blockTimeBudget), the
+        blocks that did not reach the column are lexed further by the next
+        event loop ticks.
+
+        :param firstBlock: First block number
+        :param lastBlock: Last block number
+        :param column: The last visible column
+        """
+        self.__column = column
+        self.__columnRange = (firstBlock, lastBlock)
+        datas = []
+        blocks = []
+        block = self.document().findBlockByNumber(firstBlock)
+        while block.isValid() and block.blockNumber() <= lastBlock:
+            data = self.blockData(block)
+            if data is not None and data.resume is not None:
+                if data.resume[2] <= column:
+                    data.wanted = max(data.wanted,
+                                      column + self.maxBlockLength)
+                if data.resume[2] < data.wanted:
+                    datas.append(data)
+                    blocks.append(block)
+            block = block.next()
+        self.scheduler.highlightBlocks(blocks)
+        if any(data.resume is not None and data.resume[2] < data.wanted
+               for data in datas):
+            self.__columnTimer.start()
+
+    def __onColumnTimer(self):
+        self.ensureColumnLexed(self.__columnRange[0], self.__columnRange[1],
+                               self.__column)
+
+    def rehighlight(self):
+        """
+        Rehighlights the whole document. The visible blocks are highlighted
+        first, the rest of the document is highlighted in the background
+        (see :class:`HighlightingScheduler`).
+        """
+        self.scheduler.start()
+
+    def reformat(self):
+        """
+        Re-applies the formats to the whole document without lexing it again
+        (the token runs kept in the blocks data are reused). Use this
+        when only the style changed.
+        """
+        self.__relex = False
+        try:
+            self.scheduler.start()
+        finally:
+            self.__relex = True
+
+    def _formatRanges(self, text, runs):
+        """
+        Returns the coalesced format ranges of a block (see
+        :func:`pcef.core.lexing.format_ranges`).
+
+        :param text: The block text
+        :param runs: The token runs: list of tuple(length, token type)
+
+        :return: list of [start, end, QTextCharFormat]
+        """
+        return format_ranges(text, runs, self._get_format)
+
+    def _entryStack(self):
+        """
+        Returns the lexer state stack at the start of the current block (the
+        end state of the previous block).
+
+        States that are unknown to the current lexer (e.g. the lexer changed)
+        fallback to the root state.
+        """
+        return self._stackFromState(self.previousBlockState())
+
+    def _stackFromState(self, stateId):
+        """
+        Returns the lexer state stack of a block state (root if the state is
+        unknown to the current lexer or if the lexer has no states, e.g. the
+        TextLexer).
+        """
+        stack = LEXER_STATES.stack(stateId)
+        tokendefs = getattr(self._lexer, "_tokens", None)
+        if tokendefs is None:
+            return ['root']
+        for state in stack:
+            if state not in tokendefs:
+                return ['root']
+        return list(stack)
+
+    def isBlockReady(self, blockNumber):
+        """
+        Checks if the background lexer results are available for a block
+        (always True when no background lexing is in progress).
+
+        :param blockNumber: The block number
+        """
+        if self.__jobId is None:
+            return True
+        if self.document().revision() != self.__jobRevision:
+            # the snapshot is outdated, lex synchronously
+            self.__stopBackgroundLexing()
+            return True
+        return (blockNumber in self.__precomputed or
+                not self.__jobStart <= blockNumber < self.__jobEnd)
+
+    def __startBackgroundLexing(self, fromBlock):
+        self.__stopBackgroundLexing()
+        if not self.__relex:
+            return
+        doc = self.document()
+        if doc.blockCount() - fromBlock < self.backgroundThreshold:
+            return
+        stack = ['root']
+        if fromBlock:
+            stack = self._stackFromState(
+                doc.findBlockByNumber(fromBlock - 1).userState())
+        lines = []
+        block = doc.findBlockByNumber(fromBlock)
+        while block.isValid():
+            lines.append(block.text())
+            block = block.next()
+        self.__jobId = self.backgroundLexer.start(
+            self._lexer, lines, fromBlock, stack)
+        self.__jobRevision = doc.revision()
+        self.__jobStart = fromBlock
+        self.__jobEnd = doc.blockCount()
+
+    def __stopBackgroundLexing(self):
+        if self.__jobId is not None:
+            self.backgroundLexer.cancel()
+        self.__jobId = None
+        self.__precomputed.clear()
+
+    def __onChunkReady(self, jobId, firstBlock, results):
+        if jobId != self.__jobId:
+            return
+        if results is None:
+            self.__stopBackgroundLexing()
+        else:
+            for i, result in enumerate(results):
+                self.__precomputed[firstBlock + i] = result
+        self.scheduler.resume()
+
+    def __takePrecomputed(self, stack):
+        """
+        Returns the background lexer result (runs, exit stack) for the current
+        block if it is still valid (same document revision and same entry
+        state), None otherwise.
+
+        The result is only consumed when the scheduler frontier reaches the
+        block: a block highlighted ahead of it (e.g. a visible block) leaves
+        the result for the frontier, see isBlockReady.
+        """
+        if not self.__precomputed:
+            return None
+        if self.document().revision() != self.__jobRevision:
+            self.__stopBackgroundLexing()
+            return None
+        blockNumber = self.currentBlock().blockNumber()
+        if blockNumber == self.scheduler.frontier:
+            result = self.__precomputed.pop(blockNumber, None)
+        else:
+            result = self.__precomputed.get(blockNumber)
+        if result is None or list(result[0]) != stack:
+            return None
+        return result[1], result[2]
+
+    # -------------------------------------------------------------------------
     # 'PygmentsHighlighter' interface
-    #---------------------------------------------------------------------------
+    # -------------------------------------------------------------------------
     def __set_style(self, style):
         """ Sets the style to the specified Pygments style.
         """
@@ -220,7 +1396,7 @@ class QPygmentsHighlighter(QSyntaxHighlighter):
                 isinstance(style, unicode)):
             style = get_style_by_name(style)
         self._style = style
-        self._clear_caches()
+        self._formatTable = FormatTable.fromStyle(style)
 
     def set_style_sheet(self, stylesheet):
         """ Sets a CSS stylesheet. The classes in the stylesheet should
@@ -231,9 +1407,8 @@ class QPygmentsHighlighter(QSyntaxHighlighter):
         Note that 'set_style' and 'set_style_sheet' completely override each
         other, i.e. they cannot be used in conjunction.
         """
-        self._document.setDefaultStyleSheet(stylesheet)
         self._style = None
-        self._clear_caches()
+        self._formatTable = FormatTable.fromStyleSheet(stylesheet)
 
     def __get_style(self):
         return self._style
@@ -241,96 +1416,47 @@ class QPygmentsHighlighter(QSyntaxHighlighter):
     #: gets/sets the **pygments** style.
     style = property(__get_style, __set_style)
 
-    #---------------------------------------------------------------------------
-    # Protected interface
-    #---------------------------------------------------------------------------
+    def __get_formatTable(self):
+        return self._formatTable
 
-    def _clear_caches(self):
-        """ Clear caches for brushes and formats.
-        """
-        self._brushes = {}
-        self._formats = {}
+    def __set_formatTable(self, table):
+        self._formatTable = table
 
-    def _get_format(self, token):
-        """ Returns a QTextCharFormat for token or None.
-        """
-        if token in self._formats:
-            return self._formats[token]
+    #: gets/sets the :class:`FormatTable` (e.g. loaded from disk with
+    #: FormatTable.load)
+    formatTable = property(__get_formatTable, __set_formatTable)
 
-        if self._style is None:
-            result = self._get_format_from_document(token, self._document)
-        else:
-            result = self._get_format_from_style(token, self._style)
-
-        self._formats[token] = result
-        return result
+    # -------------------------------------------------------------------------
+    # Protected interface
+    # -------------------------------------------------------------------------
 
-    def _get_format_from_document(self, token, document):
-        """ Returns a QTextCharFormat for token by
+    def _get_format(self, token):
+        """ Returns the QTextCharFormat of a token (see
+        :class:`FormatTable`).
         """
-        code, html = next(self._formatter._format_lines([(token, 'dummy')]))
-        self._document.setHtml(html)
-        return QtGui.QTextCursor(self._document).charFormat()
+        return self._formatTable.format(token)
 
-    def _get_format_from_style(self, token, style):
-        """ Returns a QTextCharFormat for token by reading a Pygments style.
-        """
-        result = QtGui.QTextCharFormat()
-        for key, value in list(style.style_for_token(token).items()):
-            if value:
-                if key == 'color':
-                    result.setForeground(self._get_brush(value))
-                elif key == 'bgcolor':
-                    result.setBackground(self._get_brush(value))
-                elif key == 'bold':
-                    result.setFontWeight(QtGui.QFont.Bold)
-                elif key == 'italic':
-                    result.setFontItalic(True)
-                elif key == 'underline':
-                    result.setUnderlineStyle(
-                        QtGui.QTextCharFormat.SingleUnderline)
-                elif key == 'sans':
-                    result.setFontStyleHint(QtGui.QFont.SansSerif)
-                elif key == 'roman':
-                    result.setFontStyleHint(QtGui.QFont.Times)
-                elif key == 'mono':
-                    result.setFontStyleHint(QtGui.QFont.TypeWriter)
-        return result
 
-    def _get_brush(self, color):
-        """ Returns a brush for the color.
-        """
-        result = self._brushes.get(color)
-        if result is None:
-            qcolor = self._get_color(color)
-            result = QtGui.QBrush(qcolor)
-            self._brushes[color] = result
-        return result
+#: The highlight cache shared by the highlighter modes
+_HIGHLIGHT_CACHE = None
 
-    def _get_color(self, color):
-        """ Returns a QColor built from a Pygments color string.
-        """
-        color = str(color).replace("#", "")
-        qcolor = QtGui.QColor()
-        qcolor.setRgb(int(color[:2], base=16),
-                      int(color[2:4], base=16),
-                      int(color[4:6], base=16))
-        return qcolor
+
+def _defaultHighlightCache():
+    global _HIGHLIGHT_CACHE
+    if _HIGHLIGHT_CACHE is None:
+        _HIGHLIGHT_CACHE = HighlightCache()
+    return _HIGHLIGHT_CACHE
 
 
 class PygmentsHighlighterMode(Mode):
     """
     This mode enable syntax highlighting (using the QPygmentsHighlighter).
-
-    .. warnings: There are some issues with multiline comments, they are not
-                 properly hilighted until a full rehighlight is triggered.
-                 The text is automatically rehighlighted on save.
     """
     #: Mode identifier
     IDENTIFIER = "pygmentsHighlighter"
     #: Mode description
     DESCRIPTION = "Apply syntax highlighting to the editor using pygments " \
-                   "lexer"
+                  "lexer"
 
     def install(self, editor):
         """
@@ -338,28 +1464,77 @@ class PygmentsHighlighterMode(Mode):
         """
         self.triggers = ["*", '**', '"', "'", "/"]
         self.highlighter = QPygmentsHighlighter(editor.document())
-        self.highlighter._clear_caches()
         self.prev_txt = ""
         style = editor.style.addProperty("pygmentsStyle", "default")
         self.highlighter.style = style
+        editor.settings.addProperty("highlightCache", False)
+        #: The on-disk highlight cache (None if disabled)
+        self.highlightCache = None
+        if editor.settings.value("highlightCache"):
+            self.highlightCache = _defaultHighlightCache()
+        # lexing very large documents in worker processes is opt-in (see
+        # BackgroundLexer)
+        editor.settings.addProperty("lexInProcesses", False)
+        if editor.settings.value("lexInProcesses"):
+            self.highlighter.backgroundLexer.processThreshold = \
+                BackgroundLexer.PROCESS_THRESHOLD
+        self.highlighter.scheduler.formatStarted.connect(
+            editor.decorations.beginFormatChange)
+        self.highlighter.scheduler.formatFinished.connect(
+            editor.decorations.endFormatChange)
         Mode.install(self, editor)
 
-
     def onStateChanged(self, state):
         self.highlighter.enabled = state
         if state is True:
-            self.editor.textSaved.connect(self.__onTextSaved)
             self.editor.newTextSet.connect(self.__updateLexer)
+            self.editor.painted.connect(self.__updateViewport)
+            scrollBar = self.editor.horizontalScrollBar()
+            scrollBar.valueChanged.connect(self.__updateColumns)
+            scrollBar.rangeChanged.connect(self.__updateColumns)
+            self.highlighter.scheduler.finished.connect(self.__saveToCache)
         else:
-            self.editor.textSaved.disconnect(self.__onTextSaved)
             self.editor.newTextSet.disconnect(self.__updateLexer)
+            self.editor.painted.disconnect(self.__updateViewport)
+            scrollBar = self.editor.horizontalScrollBar()
+            scrollBar.valueChanged.disconnect(self.__updateColumns)
+            scrollBar.rangeChanged.disconnect(self.__updateColumns)
+            self.highlighter.scheduler.finished.disconnect(
+                self.__saveToCache)
         self.highlighter.rehighlight()
 
+    def __updateViewport(self, event):
+        """ Tells the highlighting scheduler which blocks are visible """
+        blocks = self.editor.visibleBlocks
+        if blocks:
+            self.highlighter.scheduler.setViewport(blocks[0][1] - 1,
+                                                   blocks[-1][1] - 1)
+
+    def __updateColumns(self, *args):
+        """
+        Lexes the visible part of the long blocks when the editor scrolls
+        horizontally or its width changes (not from the paint event: lexing
+        rehighlights the blocks).
+        """
+        editor = self.editor
+        blocks = editor.visibleBlocks
+        if blocks:
+            column = ((editor.horizontalScrollBar().value() +
+                       editor.viewport().width()) //
+                      max(1, editor.fontMetrics().width(" ")))
+            self.highlighter.ensureColumnLexed(
+                blocks[0][1] - 1, blocks[-1][1] - 1, column)
+
     def __updateLexer(self):
         self.setLexerFromFilename(self.editor.fileName)
+        if self.highlightCache is not None and self.editor.filePath:
+            self.highlightCache.restore(self.highlighter, self.editor.filePath)
 
-    def __onTextSaved(self):
-        self.highlighter.rehighlight()
+    def __saveToCache(self):
+        """ Saves the highlighting results once the document is highlighted """
+        if (self.highlightCache is not None and self.editor.filePath and
+                not self.editor.dirty):
+            self.highlightCache.save(self.highlighter, self.editor.filePath)
 
     def onStyleChanged(self, section, key, value):
         """ Updates the pygments style """
@@ -367,7 +1542,7 @@ class PygmentsHighlighterMode(Mode):
             if self.highlighter is not None:
                 self.highlighter.style = self.editor.style.value(
                     "pygmentsStyle")
-                self.highlighter.rehighlight()
+                self.highlighter.reformat()
 
     def setLexerFromFilename(self, fn="file.py"):
         """
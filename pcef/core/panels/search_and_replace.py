@@ -11,29 +11,48 @@
 """
 This module contains the search and replace panel
 """
+import re
+from array import array
+from bisect import bisect_left, bisect_right
 from pcef.qt import QtCore, QtGui
 from pcef.core import constants
-from pcef.core.decoration import TextDecoration
 from pcef.core.panel import Panel
+from pcef.core.search import SearchEngine, CASE_SENSITIVE, WHOLE_WORDS, \
+    REGEX
 from pcef.core.system import DelayJobRunner
 from pcef.core.ui import loadUi
 
 
+#: Translates the text of a QTextCursor selection to plain text (see
+#: QTextDocument.toPlainText)
+_PLAIN_TEXT = {0x2029: u"\n", 0x2028: u"\n", 0xa0: u" "}
+
+
 class SearchAndReplacePanel(Panel, DelayJobRunner):
     """
     This panel allow the user to search and replace some text in the current
     editor.
 
-    It uses the QTextDocument API to search for some text. Search operation is
-    performed in a background thread.
-
-    The search panel can also be used pragmatically. To do that, the client code
-    must first request a search (**requestSearch**) and connect to the
-    searchFinished signal. The results of the search can then be retrieved using
-    the cptOccurrences attribute and the getOccurrences method. The client code
-    may now navigates through occurrences (**selectNext**/**selectionPrevious**)
-    or replace the occurences with their own text (
-    **replaceOccurrence**/**replaceAll**).
+    It searches a plain text snapshot of the document using a
+    :class:`pcef.core.search.SearchEngine`. Search operation is performed in a
+    background thread, except when the query extends the previous one
+    (type-ahead search): the previous results are refined immediately. When
+    the document is edited, the occurrences after the edit are shifted and
+    only the text around the edit is searched again (the lines of the edit
+    for regular expressions). The searches started by an edit never move the
+    text cursor. The snapshot is rebuilt lazily, by the next search.
+
+    In regular expression mode, the replacement text may contain group
+    references (\\1, \\g<name>) and a search stops when its time budget
+    (timeBudget) is exhausted, the occurrences found so far are reported.
+
+    The search panel can also be used pragmatically. To do that, the client
+    code must first request a search (**requestSearch**) and connect to the
+    searchFinished signal. The results of the search can then be retrieved
+    using the cptOccurrences attribute and the getOccurrences method. The
+    client code may now navigates through occurrences
+    (**selectNext**/**selectionPrevious**) or replace the occurences with
+    their own text (**replaceOccurrence**/**replaceAll**).
     """
     IDENTIFIER = "searchPanel"
     DESCRIPTION = "Search and replace text in the editor"
@@ -114,16 +133,47 @@ class SearchAndReplacePanel(Panel, DelayJobRunner):
         loadUi("search_panel.ui", self)
         #: Occurrences counter
         self.cptOccurrences = 0
+        #: Time budget of a regular expression search, in ms
+        self.timeBudget = 1000
         self.__separator = None
-        self.__decorations = []
+        self.__layer = None
         self.__mutex = QtCore.QMutex()
-        self.__occurrences = []
+        self.__starts = array("l")
+        self.__ends = array("l")
+        #: tuple(query, flags) of the current occurrences
+        self.__query = (u"", 0)
         self.__current_occurrence = -1
+        #: Search engine of the current occurrences, keeps the last results
+        #: for type-ahead search. Background searches use their own engine
+        #: (see __execSearch), so this one is only used by the GUI thread.
+        self.__engine = SearchEngine()
+        #: Plain text snapshot of the document, None if it has to be rebuilt
+        #: (dropped on document changes)
+        self.__snapshot = None
+        #: True while the panel replaces occurrences: document changes only
+        #: drop the snapshot
+        self.__replacing = False
+        #: Id of the last search request, results of older requests are
+        #: discarded
+        self.__searchId = 0
+        #: Id of the search whose results are the current occurrences
+        self.__resultsId = 0
+        #: True if the last search request selects the first occurrence once
+        #: it finished (not requested by an edit)
+        self.__selectRequested = True
+        #: True if the current occurrences come from a search that selects
+        #: the first occurrence
+        self.__selectResults = True
+        #: False if the last search stopped before the end of the document
+        self.__complete = True
+        #: Error message of the last search (invalid regular expression)
+        self.__error = None
         self.__updateButtons(txt="")
         self.lineEditSearch.installEventFilter(self)
         self.lineEditReplace.installEventFilter(self)
 
     def install(self, editor):
+        self.__layer = editor.decorations.layer(self.IDENTIFIER, drawOrder=1)
         Panel.install(self, editor)
         self.__resetStylesheet()
         self.on_pushButtonClose_clicked()
@@ -141,14 +191,17 @@ class SearchAndReplacePanel(Panel, DelayJobRunner):
             # add menus
             self.__separator = self.editor.contextMenu.addSeparator()
             self.editor.contextMenu.addAction(self.actionSearch)
-            self.editor.contextMenu.addAction(self.actionActionSearchAndReplace)
+            self.editor.contextMenu.addAction(
+                self.actionActionSearchAndReplace)
             self.editor.contextMenu.addAction(self.actionFindNext)
             self.editor.contextMenu.addAction(self.actionFindPrevious)
             # requestSearch slot
-            self.editor.textChanged.connect(self.requestSearch)
+            self.editor.document().contentsChange.connect(
+                self.__onContentsChange)
             self.lineEditSearch.textChanged.connect(self.requestSearch)
             self.checkBoxCase.stateChanged.connect(self.requestSearch)
             self.checkBoxWholeWords.stateChanged.connect(self.requestSearch)
+            self.checkBoxRegex.stateChanged.connect(self.requestSearch)
             # navigation slots
             self.pushButtonNext.clicked.connect(self.selectNext)
             self.actionFindNext.triggered.connect(self.selectNext)
@@ -170,10 +223,12 @@ class SearchAndReplacePanel(Panel, DelayJobRunner):
             self.editor.contextMenu.removeAction(self.actionFindNext)
             self.editor.contextMenu.removeAction(self.actionFindPrevious)
             # requestSearch slot
-            self.editor.textChanged.disconnect(self.requestSearch)
+            self.editor.document().contentsChange.disconnect(
+                self.__onContentsChange)
             self.lineEditSearch.textChanged.disconnect(self.requestSearch)
             self.checkBoxCase.stateChanged.disconnect(self.requestSearch)
             self.checkBoxWholeWords.stateChanged.disconnect(self.requestSearch)
+            self.checkBoxRegex.stateChanged.disconnect(self.requestSearch)
             # navigation slots
             self.pushButtonNext.clicked.disconnect(self.selectNext)
             self.actionFindNext.triggered.disconnect(self.selectNext)
@@ -237,24 +292,43 @@ class SearchAndReplacePanel(Panel, DelayJobRunner):
         self.cancelRequests()
         Panel.focusOutEvent(self, event)
 
-    def requestSearch(self, txt=None):
+    def requestSearch(self, txt=None, edit=False):
         """
         Request a search operation.
 
         :param txt: The text to replace. If None, the content of lineEditSearch
         is used instead.
+
+        :param edit: True if the search is requested by a document change: the
+                     first occurrence is not selected once the search
+                     finished (unless a pending user search selects it).
         """
         if txt is None or isinstance(txt, int):
             txt = self.lineEditSearch.text()
+        pending = self.__resultsId != self.__searchId
+        self.__selectRequested = select = not edit or (
+            pending and self.__selectRequested)
+        self.__searchId += 1
         if txt:
-            self.requestJob(self.__execSearch, True,
-                            txt, self.editor.document().clone(),
-                            self.editor.textCursor(),
-                            self.__getUserSearchFlag())
+            if self.__snapshot is None:
+                self.__snapshot = self.editor.toPlainText()
+            tc = self.editor.textCursor()
+            flags = self.__getUserSearchFlag()
+            args = (self.__searchId, txt, self.__snapshot,
+                    tc.selectionStart(), tc.selectionEnd(), flags, select)
+            if self.__engine.isRefinement(txt, flags, self.__snapshot):
+                # only the previous results need to be checked
+                self.cancelRequests()
+                self.__execSearch(self.__engine, *args)
+            else:
+                self.requestJob(self.__execSearch, True, None, *args)
         else:
             self.cancelRequests()
             self.stopJob()
             self.__clearOccurrences()
+            self.__resultsId = self.__searchId
+            self.__complete = True
+            self.__error = None
             self.__onSearchFinished()
 
     def getOccurrences(self):
@@ -266,9 +340,7 @@ class SearchAndReplacePanel(Panel, DelayJobRunner):
         :return: List of tuple(int, int)
         """
         self.__mutex.lock()
-        retval = []
-        for occ in self.__occurrences:
-            retval.append(occ)
+        retval = list(zip(self.__starts, self.__ends))
         self.__mutex.unlock()
         return retval
 
@@ -337,11 +409,14 @@ class SearchAndReplacePanel(Panel, DelayJobRunner):
         if cr == -1:
             self.selectNext()
         try:
-            try:
-                self.editor.textChanged.disconnect(self.requestSearch)
-            except RuntimeError:
-                pass
             occ = occurrences[cr]
+            try:
+                text = self.__replacement(text, occ[0])
+            except re.error as e:
+                self.__showError(e)
+                return False
+            # the occurrences are updated below, not by __onContentsChange
+            self.__replacing = True
             tc = self.editor.textCursor()
             tc.setPosition(occ[0])
             tc.setPosition(occ[1], tc.KeepAnchor)
@@ -350,14 +425,13 @@ class SearchAndReplacePanel(Panel, DelayJobRunner):
             offset = len_replacement - len_to_replace
             tc.insertText(text)
             self.editor.setTextCursor(tc)
-            self.editor.textChanged.connect(self.requestSearch)
-            # prevent search request due to editor textChanged
+            self.__replacing = False
             self.__removeOccurrence(cr, offset)
             cr -= 1
             self.__setCurrentOccurrence(cr)
             self.selectNext()
-            self.cptOccurrences = len(self.getOccurrences())
-            self.__updateLabels()
+            # the layer dropped the replaced occurrence, refresh the others
+            self.__updateOccurrences()
             self.__updateButtons()
             return True
         except IndexError:
@@ -367,12 +441,44 @@ class SearchAndReplacePanel(Panel, DelayJobRunner):
         """
         Replaces all occurrences in the editor's document.
 
+        The occurrences are replaced back to front (no offset needs to be
+        shifted) in a single edit block: the document emits its change
+        signals once and the whole operation is one undo step.
+
         :param text: The replacement text. If None, the content of the lineEdit
                      replace will be used instead
         """
-        remains = self.replaceCurrent(text=text)
-        while remains:
-            remains = self.replaceCurrent(text=text)
+        if text is None or isinstance(text, bool):
+            text = self.lineEditReplace.text()
+        self.__mutex.lock()
+        starts, ends = self.__starts, self.__ends
+        self.__mutex.unlock()
+        if not len(starts):
+            return
+        texts = None
+        if self.__query[1] & REGEX:
+            try:
+                texts = [self.__replacement(text, start) for start in starts]
+            except re.error as e:
+                self.__showError(e)
+                return
+        # the occurrences are cleared below, not updated by __onContentsChange
+        self.__replacing = True
+        tc = QtGui.QTextCursor(self.editor.document())
+        tc.beginEditBlock()
+        for i in range(len(starts) - 1, -1, -1):
+            tc.setPosition(starts[i])
+            tc.setPosition(ends[i], tc.KeepAnchor)
+            tc.insertText(text if texts is None else texts[i])
+        tc.endEditBlock()
+        self.__replacing = False
+        # discard the results of a pending search
+        self.cancelRequests()
+        self.__searchId += 1
+        self.__resultsId = self.__searchId
+        self.__clearOccurrences()
+        self.__setCurrentOccurrence(-1)
+        self.__updateOccurrences()
 
     def eventFilter(self, obj, event):
         if event.type() == QtCore.QEvent.KeyPress:
@@ -394,34 +500,251 @@ class SearchAndReplacePanel(Panel, DelayJobRunner):
         return Panel.eventFilter(self, obj, event)
 
     def __getUserSearchFlag(self):
-        """ Returns the user search flag """
-        searchFlag = QtGui.QTextDocument.FindFlags(0)
+        """ Returns the user search flag (see pcef.core.search) """
+        searchFlag = 0
         if self.checkBoxCase.isChecked():
-            searchFlag |= QtGui.QTextDocument.FindCaseSensitively
+            searchFlag |= CASE_SENSITIVE
         if self.checkBoxWholeWords.isChecked():
-            searchFlag |= QtGui.QTextDocument.FindWholeWords
+            searchFlag |= WHOLE_WORDS
+        if self.checkBoxRegex.isChecked():
+            searchFlag |= REGEX
         return searchFlag
 
-    def __execSearch(self, text, doc, originalCursor, flags):
+    def __replacement(self, text, start):
+        """
+        Returns the replacement text of the occurrence that starts at start
+        (group references are expanded in regular expression mode, with the
+        query that found the occurrences, not the edited one).
+
+        :raise re.error: if text references an unknown group
+        """
+        query, flags = self.__query
+        if not flags & REGEX:
+            return text
+        if self.__snapshot is None:
+            self.__snapshot = self.editor.toPlainText()
+        return SearchEngine(self.__snapshot).expand(query, flags, text, start)
+
+    def __showError(self, error):
+        """ Shows an error (e.g. invalid regular expression) in the labels """
+        self.labelMatches.setText(str(error))
+        self.labelMatches.setStyleSheet("color: #DD0000")
+
+    def __plainText(self, start, end):
+        """ Returns the plain text of a range of the document """
+        tc = QtGui.QTextCursor(self.editor.document())
+        tc.setPosition(start)
+        tc.setPosition(end, tc.KeepAnchor)
+        return tc.selectedText().translate(_PLAIN_TEXT)
+
+    def __onContentsChange(self, position, charsRemoved, charsAdded):
+        """
+        Updates the occurrences after a document change: occurrences after
+        the change are shifted, the ones that touch the changed text are
+        dropped and the text around the change is searched again (see
+        __searchAround and __searchLines). When the time budget of a regular
+        expression runs out, the whole snapshot is searched again in the
+        background instead.
+
+        The searches started by a change do not select an occurrence.
+
+        The snapshot is not patched: it is dropped and rebuilt by the next
+        search that needs it.
+        """
+        if self.editor.decorations.isFormatChange(position, charsRemoved,
+                                                  charsAdded):
+            # only the formats changed (syntax highlighting)
+            return
+        self.__snapshot = None
+        if self.__replacing or not self.lineEditSearch.text():
+            return
+        length = self.editor.document().characterCount() - 1
+        delta = charsAdded - charsRemoved
+        txt, flags = self.__query
+        if (position + charsRemoved > length - delta or
+                self.__error is not None or
+                self.__resultsId != self.__searchId):
+            # the whole document has been replaced (setPlainText) or a search
+            # is pending: search the whole document
+            self.requestSearch(edit=True)
+            return
+        self.__mutex.lock()
+        starts, ends = self.__starts, self.__ends
+        current = self.__current_occurrence
+        complete = True
+        if flags & REGEX:
+            first, last, newStarts, newEnds, complete = self.__searchLines(
+                txt, flags, position, charsRemoved, charsAdded, length)
+        else:
+            first, last, newStarts, newEnds = self.__searchAround(
+                txt, flags, position, charsRemoved, charsAdded, length)
+        lower = ends[first - 1] if first else 0
+        upper = starts[last] + delta if last < len(starts) else length
+        count = len(newStarts)
+        # only the occurrences after the change move
+        starts[first:last] = newStarts
+        ends[first:last] = newEnds
+        if delta:
+            tail = first + count
+            starts[tail:] = array("l", [s + delta for s in starts[tail:]])
+            ends[tail:] = array("l", [e + delta for e in ends[tail:]])
+        if current >= last:
+            current += count - (last - first)
+        elif current >= first:
+            current = -1
+        self.__current_occurrence = current
+        self.__mutex.unlock()
+        # the decorations have been shifted by the decoration manager
+        self.__layer.replaceRanges(lower, upper, newStarts, newEnds,
+                                   self.__occurrenceFormatId())
+        self.__updateCount()
+        if not complete:
+            self.requestSearch(edit=True)
+
+    def __searchLines(self, txt, flags, position, charsRemoved, charsAdded,
+                      length):
+        """
+        Searches the occurrences of a regular expression in the lines of a
+        change (a match cannot span two lines, see SearchEngine), within the
+        time budget.
+
+        :return: tuple(first, last, starts, ends, complete): the new
+                 occurrences replace the occurrences [first, last[, complete
+                 is False if the time budget ran out
+        """
+        starts = self.__starts
+        delta = charsAdded - charsRemoved
+        document = self.editor.document()
+        lineStart = document.findBlock(position).position()
+        block = document.findBlock(position + charsAdded)
+        lineEnd = block.position() + block.length() - 1
+        # occurrences [first, last[ were found in the changed lines
+        first = bisect_left(starts, lineStart)
+        last = bisect_right(starts, lineEnd - delta)
+        # with the previous line break, for ^ and lookbehinds
+        offset = max(0, lineStart - 1)
+        engine = SearchEngine(self.__plainText(
+            offset, min(length, lineEnd + 1)))
+        engine.timeBudget = self.timeBudget
+        newStarts, newEnds = engine.searchRange(
+            txt, flags, lineStart - offset, lineEnd - offset)
+        if offset:
+            newStarts = array("l", [s + offset for s in newStarts])
+            newEnds = array("l", [e + offset for e in newEnds])
+        return first, last, newStarts, newEnds, engine.complete
+
+    def __searchAround(self, txt, flags, position, charsRemoved, charsAdded,
+                       length):
+        """
+        Searches the occurrences of a literal query around a change.
+
+        The occurrences that touch the removed text are dropped and the text
+        around the change is searched again, greedily from the last kept
+        occurrence, as SearchEngine.search does. When the query can overlap
+        itself (e.g. "aa" or "test"), a new occurrence may overlap the next
+        kept ones: they are dropped too and the search goes on after them,
+        until the new occurrences line up with the kept ones.
+
+        :return: tuple(first, last, starts, ends): the new occurrences replace
+                 the occurrences [first, last[
+        """
+        starts, ends = self.__starts, self.__ends
+        delta = charsAdded - charsRemoved
+        # occurrences [first, last[ touch the removed text (adjacent
+        # occurrences too: they may not be whole words anymore)
+        first = bisect_left(ends, position)
+        last = bisect_right(starts, position + charsRemoved)
+        # dropped occurrences may have hidden overlapping ones
+        end = position + charsAdded
+        if last > first:
+            end = max(end, ends[last - 1] + delta)
+        # an occurrence that starts between the last kept one and the changed
+        # text would have been kept
+        lower = ends[first - 1] if first else 0
+        pos = max(lower, position - len(txt))
+        newStarts, newEnds = array("l"), array("l")
+        while pos <= end:
+            upper = starts[last] + delta if last < len(starts) else length
+            # the occurrences that start after end were found before the
+            # change: search up to end only, with one more character on both
+            # sides for whole words
+            stop = min(length, end + len(txt))
+            offset = max(0, pos - 1)
+            engine = SearchEngine(self.__plainText(
+                offset, min(length, stop + 1)))
+            found = engine.searchRange(txt, flags, pos - offset,
+                                       stop - offset)
+            pos = end + 1
+            for s, e in zip(*found):
+                s += offset
+                e += offset
+                if s == upper:
+                    # the first kept occurrence, the next ones are unchanged
+                    break
+                newStarts.append(s)
+                newEnds.append(e)
+                if e > upper:
+                    # the occurrence overlaps kept occurrences: drop them and
+                    # search again after it
+                    while last < len(starts) and starts[last] + delta < e:
+                        end = max(end, ends[last] + delta)
+                        last += 1
+                    pos = e
+                    break
+        return first, last, newStarts, newEnds
+
+    def __execSearch(self, engine, searchId, text, snapshot, selectionStart,
+                     selectionEnd, flags, select):
+        """
+        Runs a search and makes its results the current occurrences (unless
+        a newer search has been requested).
+
+        :param engine: The engine to search with, None for a new engine
+                       (background searches, the current engine may be
+                       refining results in the GUI thread)
+        :param select: True to select the first occurrence once the search
+                       finished (see requestSearch)
+        """
+        if engine is None:
+            engine = SearchEngine()
+        engine.setText(snapshot)
+        engine.timeBudget = self.timeBudget
+        error = None
+        try:
+            starts, ends = engine.search(text, flags)
+        except re.error as e:
+            starts, ends = array("l"), array("l")
+            error = str(e)
+        # the occurrence that is selected in the editor is the current one
+        current = bisect_left(starts, selectionStart)
+        if (current == len(starts) or starts[current] != selectionStart or
+                ends[current] != selectionEnd):
+            current = -1
         self.__mutex.lock()
-        self.__occurrences[:] = []
-        self.__current_occurrence = -1
-        if text:
-            cptMatches = 0
-            cursor = doc.find(text, 0, flags)
-            while not cursor.isNull():
-                if self.__compareCursors(cursor, originalCursor):
-                    self.__current_occurrence = cptMatches
-                self.__occurrences.append((cursor.selectionStart(),
-                                          cursor.selectionEnd()))
-                cursor.setPosition(cursor.position() + 1)
-                cursor = doc.find(text, cursor, flags)
-                cptMatches += 1
+        outdated = searchId != self.__searchId
+        if not outdated:
+            self.__starts = starts
+            self.__ends = ends
+            self.__query = (text, flags)
+            self.__current_occurrence = current
+            self.__resultsId = searchId
+            self.__complete = engine.complete
+            self.__error = error
+            self.__engine = engine
+            self.__selectResults = select
         self.__mutex.unlock()
-        self.searchFinished.emit()
+        if not outdated:
+            self.searchFinished.emit()
 
     def __updateLabels(self):
-        self.labelMatches.setText("{0} matches".format(self.cptOccurrences))
+        if self.__error is not None:
+            self.__showError(self.__error)
+            return
+        text = "{0} matches".format(self.cptOccurrences)
+        if not self.__complete:
+            # time budget exhausted
+            text = "{0} matches (partial)".format(self.cptOccurrences)
+        self.labelMatches.setText(text)
         color = "#DD0000"
         if self.cptOccurrences:
             color = "#00DD00"
@@ -430,18 +753,23 @@ class SearchAndReplacePanel(Panel, DelayJobRunner):
             self.labelMatches.clear()
 
     def __onSearchFinished(self):
-        self.__clearDecorations()
-        occurrences = self.getOccurrences()
-        for occurrence in occurrences:
-            deco = self.__createDecoration(occurrence[0],
-                                           occurrence[1])
-            self.__decorations.append(deco)
-            self.editor.addDecoration(deco)
-        self.cptOccurrences = len(occurrences)
+        self.__updateOccurrences()
         if not self.cptOccurrences:
             self.__current_occurrence = -1
-        elif self.__getCurrentOccurrence() == -1:
+        elif self.__getCurrentOccurrence() == -1 and self.__selectResults:
             self.selectNext()
+
+    def __updateOccurrences(self):
+        """ Updates the decorations, labels and buttons """
+        self.__mutex.lock()
+        starts, ends = self.__starts, self.__ends
+        self.__mutex.unlock()
+        self.__layer.setRanges(starts, ends, self.__occurrenceFormatId())
+        self.__updateCount()
+
+    def __updateCount(self):
+        """ Updates the occurrences counter, labels and buttons """
+        self.cptOccurrences = len(self.__starts)
         self.__updateLabels()
         self.__updateButtons(txt=self.lineEditReplace.text())
 
@@ -461,47 +789,32 @@ class SearchAndReplacePanel(Panel, DelayJobRunner):
 
     def __clearOccurrences(self):
         self.__mutex.lock()
-        self.__occurrences[:] = []
+        self.__starts = array("l")
+        self.__ends = array("l")
+        self.__query = (u"", 0)
         self.__mutex.unlock()
 
-    def __createDecoration(self, selection_start, selection_end):
-        """ Creates the text occurences decoration """
-        deco = TextDecoration(self.editor.document(), selection_start,
-                              selection_end)
-        deco.setBackground(QtGui.QBrush(self.background))
-        deco.setForeground(QtGui.QBrush(self.foreground))
-        deco.draw_order = 1
-        return deco
-
-    def __clearDecorations(self):
-        """ Remove all decorations """
-        for deco in self.__decorations:
-            self.editor.removeDecoration(deco)
-        self.__decorations[:] = []
+    def __occurrenceFormatId(self):
+        """ Registers the text occurrences format and returns its id """
+        fmt = QtGui.QTextCharFormat()
+        fmt.setBackground(QtGui.QBrush(self.background))
+        fmt.setForeground(QtGui.QBrush(self.foreground))
+        return self.editor.decorations.registerFormat(fmt)
 
     def __setCurrentOccurrence(self, cr):
         self.__mutex.lock()
         self.__current_occurrence = cr
         self.__mutex.unlock()
 
-    def __compareCursors(self, a, b):
-        assert isinstance(a, QtGui.QTextCursor)
-        assert isinstance(b, QtGui.QTextCursor)
-        return (a.selectionStart() == b.selectionStart() and
-                a.selectionEnd() == b.selectionEnd())
-
     def __removeOccurrence(self, i, offset=0):
         self.__mutex.lock()
-        self.__occurrences.pop(i)
+        starts, ends = self.__starts, self.__ends
+        del starts[i]
+        del ends[i]
         if offset:
-            updated_occurences = []
-            for j, occ in enumerate(self.__occurrences):
-                if j >= i:
-                    updated_occurences.append(
-                        (occ[0] + offset, occ[1] + offset))
-                else:
-                    updated_occurences.append((occ[0], occ[1]))
-            self.__occurrences = updated_occurences
+            for j in range(i, len(starts)):
+                starts[j] += offset
+                ends[j] += offset
         self.__mutex.unlock()
 
     def __updateButtons(self, txt=""):
@@ -510,6 +823,7 @@ class SearchAndReplacePanel(Panel, DelayJobRunner):
         self.pushButtonPrevious.setEnabled(enable)
         self.actionFindNext.setEnabled(enable)
         self.actionFindPrevious.setEnabled(enable)
-        enable = txt != self.lineEditSearch.text() and bool(self.cptOccurrences)
+        enable = (txt != self.lineEditSearch.text() and
+                  bool(self.cptOccurrences))
         self.pushButtonReplace.setEnabled(enable)
         self.pushButtonReplaceAll.setEnabled(enable)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCEF - Python/Qt Code Editing Framework
+# Copyright 2013, Colin Duquesnoy <colin.duquesnoy@gmail.com>
+#
+# This software is released under the LGPLv3 license.
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+This module contains the text search engine used by the search and replace
+panel.
+
+The engine searches a plain text snapshot of the document (see
+QTextDocument.toPlainText, each character is one document position) instead
+of a clone of the document and returns the occurrences as offset arrays.
+
+This module does not depend on Qt so it can be used from worker threads.
+"""
+import re
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+
+#: Search flag: match case
+CASE_SENSITIVE = 0x1
+#: Search flag: match whole words only (a word boundary is a character that is
+#: not a letter or a digit, like QTextDocument.FindWholeWords)
+WHOLE_WORDS = 0x2
+#: Search flag: the query is a regular expression (^ and $ match at line
+#: boundaries, a match cannot span two lines, like QTextDocument.find)
+REGEX = 0x4
+
+#: Maximum number of compiled patterns kept by compilePattern
+PATTERN_CACHE_SIZE = 32
+
+#: Compiled patterns, per (query, flags), least recently used first
+_PATTERNS = OrderedDict()
+
+#: Guards _PATTERNS, patterns are compiled by the GUI thread and by the search
+#: threads
+_PATTERNS_LOCK = threading.Lock()
+
+
+def compilePattern(query, flags=0):
+    """
+    Compiles the regex that matches a query. The last compiled patterns are
+    cached so that type-ahead search does not compile the same pattern again.
+
+    :param query: The searched text (a regular expression with REGEX)
+    :param flags: Search flags (CASE_SENSITIVE, WHOLE_WORDS, REGEX)
+
+    :rtype: re.RegexObject
+
+    :raise re.error: if the query is not a valid regular expression
+    """
+    key = (query, flags)
+    with _PATTERNS_LOCK:
+        regex = _PATTERNS.pop(key, None)
+        if regex is not None:
+            _PATTERNS[key] = regex
+            return regex
+    if flags & REGEX:
+        pattern = u"(?:%s)" % query
+    else:
+        pattern = re.escape(query)
+    if flags & WHOLE_WORDS:
+        pattern = r"(?<![^\W_])%s(?![^\W_])" % pattern
+    reFlags = re.UNICODE | re.MULTILINE
+    if not flags & CASE_SENSITIVE:
+        reFlags |= re.IGNORECASE
+    # compiled outside of the lock, another thread may compile it too
+    regex = re.compile(pattern, reFlags)
+    with _PATTERNS_LOCK:
+        _PATTERNS.pop(key, None)
+        while len(_PATTERNS) >= PATTERN_CACHE_SIZE:
+            _PATTERNS.popitem(last=False)
+        _PATTERNS[key] = regex
+    return regex
+
+
+def isLocal(query, flags=0):
+    """
+    Checks if the occurrences of a query only depend on the text around them,
+    i.e. if searching the text around an edit (see SearchEngine.searchRange)
+    gives the same occurrences as searching the whole text again.
+
+    This is not the case of regular expressions (a match may span any number
+    of lines) and of the queries whose occurrences may overlap (e.g. "aa"):
+    which of the overlapping matches is an occurrence depends on the
+    previous occurrences.
+
+    :param query: The searched text
+    :param flags: Search flags (CASE_SENSITIVE, WHOLE_WORDS, REGEX)
+    """
+    if flags & REGEX:
+        return False
+    if not flags & CASE_SENSITIVE:
+        query = query.lower()
+    # a prefix that is also a suffix lets two occurrences overlap
+    for size in range(1, len(query)):
+        if query.endswith(query[:size]):
+            return False
+    return True
+
+
+class SearchEngine(object):
+    """
+    Searches the occurrences of a query in an immutable plain text snapshot.
+
+    Literal case sensitive queries are searched with str.find, the other
+    variants with a compiled regex. Occurrences do not overlap and are
+    returned as two arrays of start and end offsets.
+
+    The engine keeps the positions of the last query (overlapping, whole
+    words or not): when the next query extends it with the same case
+    sensitivity (type-ahead search), only these positions are checked instead
+    of rescanning the text.
+
+    Regular expressions are searched line by line (a match cannot span two
+    lines) so that the search can stop when its time budget (timeBudget) is
+    exhausted and report partial results (see complete).
+
+    Usage
+    ------------
+    engine = SearchEngine(editor.toPlainText())
+    starts, ends = engine.search("foo", CASE_SENSITIVE)
+    """
+    def __init__(self, text=u""):
+        """
+        :param text: The text snapshot
+        """
+        self.__text = text
+        #: tuple(text, query, case sensitive, candidates) of the last search
+        self.__last = None
+        #: Time budget of a regular expression search, in ms (0 to disable)
+        self.timeBudget = 0
+        #: False if the last search (or range search) stopped before the end
+        #: of the text (time budget exhausted)
+        self.complete = True
+
+    @property
+    def text(self):
+        """ Returns the text snapshot """
+        return self.__text
+
+    def setText(self, text):
+        """
+        Replaces the text snapshot
+
+        :param text: The new text snapshot
+        """
+        if text is not self.__text:
+            self.__text = text
+            self.__last = None
+
+    def isRefinement(self, query, flags=0, text=None):
+        """
+        Checks if searching a query only needs to check the positions of the
+        last search (see search).
+
+        :param query: The searched text
+        :param flags: Search flags (CASE_SENSITIVE, WHOLE_WORDS)
+        :param text: The text snapshot that will be searched (None for the
+                     current snapshot)
+        """
+        last = self.__last
+        if text is None:
+            text = self.__text
+        return (not flags & REGEX and last is not None and last[0] is text and
+                last[2] == bool(flags & CASE_SENSITIVE) and
+                query.startswith(last[1]))
+
+    def __candidates(self, query, caseSensitive):
+        """
+        Returns the start offsets of all the (possibly overlapping) matches of
+        a query, refining the last result when possible.
+        """
+        text = self.__text
+        last = self.__last
+        candidates = array("l")
+        append = candidates.append
+        if (last is not None and last[0] is text and
+                last[2] == caseSensitive and query.startswith(last[1])):
+            if query == last[1]:
+                return last[3]
+            if caseSensitive:
+                startswith = text.startswith
+                for start in last[3]:
+                    if startswith(query, start):
+                        append(start)
+            else:
+                match = compilePattern(query).match
+                for start in last[3]:
+                    if match(text, start):
+                        append(start)
+        elif caseSensitive:
+            find = text.find
+            pos = find(query)
+            while pos != -1:
+                append(pos)
+                pos = find(query, pos + 1)
+        else:
+            search = compilePattern(query).search
+            m = search(text)
+            while m:
+                append(m.start())
+                m = search(text, m.start() + 1)
+        self.__last = (text, query, caseSensitive, candidates)
+        return candidates
+
+    def search(self, query, flags=0):
+        """
+        Searches the occurrences of a query.
+
+        :param query: The searched text (a regular expression with REGEX)
+        :param flags: Search flags (CASE_SENSITIVE, WHOLE_WORDS, REGEX)
+
+        :return: tuple(starts, ends): arrays of offsets
+
+        :raise re.error: if the query is not a valid regular expression
+        """
+        starts = array("l")
+        ends = array("l")
+        self.complete = True
+        if not query:
+            return starts, ends
+        if flags & REGEX:
+            return self.__searchRegex(compilePattern(query, flags))
+        text = self.__text
+        length = len(query)
+        candidates = self.__candidates(query, bool(flags & CASE_SENSITIVE))
+        match = None
+        if flags & WHOLE_WORDS:
+            match = compilePattern(query, flags).match
+        append = starts.append
+        end = 0
+        for start in candidates:
+            # occurrences do not overlap
+            if start >= end and (match is None or match(text, start)):
+                append(start)
+                end = start + length
+        ends.extend(start + length for start in starts)
+        return starts, ends
+
+    def __deadline(self):
+        """ Returns the time at which a regex search stops (or None) """
+        if self.timeBudget:
+            return time.time() + self.timeBudget / 1000.0
+        return None
+
+    def __searchRegex(self, regex, start=0, end=None):
+        """
+        Searches the (non empty) matches of a regex that lie in [start, end],
+        line by line, until the end of the range or the time budget is
+        exhausted (the deadline is checked after each line).
+        """
+        starts = array("l")
+        ends = array("l")
+        text = self.__text
+        length = len(text)
+        if end is None:
+            end = length
+        deadline = self.__deadline()
+        search = regex.search
+        pos = start
+        while pos < end:
+            lineEnd = text.find(u"\n", pos, end)
+            if lineEnd == -1:
+                # one more character so that lookaheads see it
+                lineEnd = min(length, end + 1)
+            m = search(text, pos, lineEnd)
+            while m:
+                matchStart, matchEnd = m.span()
+                if matchEnd > end:
+                    break
+                if matchStart != matchEnd:
+                    starts.append(matchStart)
+                    ends.append(matchEnd)
+                    m = search(text, matchEnd, lineEnd)
+                elif matchEnd < lineEnd:
+                    m = search(text, matchEnd + 1, lineEnd)
+                else:
+                    # re clamps pos to the end of the line
+                    break
+            pos = lineEnd + 1
+            if deadline is not None and time.time() > deadline:
+                self.complete = pos >= end
+                break
+        return starts, ends
+
+    def expand(self, query, flags, template, start):
+        """
+        Returns the replacement of the regex match found at an offset,
+        with its group references (\\1, \\g<name>) expanded.
+
+        :param query: The regular expression
+        :param flags: Search flags (CASE_SENSITIVE, WHOLE_WORDS, REGEX)
+        :param template: The replacement template
+        :param start: Offset of the match (see search)
+
+        :raise re.error: if the template references an unknown group
+        """
+        text = self.__text
+        # a match cannot span two lines (see search)
+        lineEnd = text.find(u"\n", start)
+        if lineEnd == -1:
+            lineEnd = len(text)
+        m = compilePattern(query, flags).match(text, start, lineEnd)
+        if m is None:
+            return template
+        return m.expand(template)
+
+    def searchRange(self, query, flags, start, end):
+        """
+        Searches the occurrences of a query that lie in a range of the text
+        (the characters around the range are taken into account for whole
+        words), without using nor changing the last results.
+
+        Regular expressions are searched within the time budget (see
+        complete).
+
+        :param query: The searched text
+        :param flags: Search flags (CASE_SENSITIVE, WHOLE_WORDS, REGEX)
+        :param start: Start offset of the range
+        :param end: End offset of the range
+
+        :return: tuple(starts, ends): arrays of offsets
+
+        :raise re.error: if the query is not a valid regular expression
+        """
+        starts = array("l")
+        ends = array("l")
+        self.complete = True
+        if not query:
+            return starts, ends
+        if flags & REGEX:
+            return self.__searchRegex(compilePattern(query, flags), start, end)
+        # one more character so that the whole words lookahead sees it
+        endpos = min(len(self.__text), end + 1)
+        for m in compilePattern(query, flags).finditer(
+                self.__text, start, endpos):
+            if m.end() > end:
+                break
+            if m.start() == m.end():
+                continue
+            starts.append(m.start())
+            ends.append(m.end())
+        return starts, ends
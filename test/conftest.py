@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCEF - Python/Qt Code Editing Framework
+# Copyright 2013, Colin Duquesnoy <colin.duquesnoy@gmail.com>
+#
+# This software is released under the LGPLv3 license.
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Test helpers shared by the test modules.
+"""
+import importlib.util
+import os
+
+
+#: Root directory of the repository
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def importCoreModule(name):
+    """
+    Imports a Qt free module of pcef.core from its file, so that the tests of
+    the module do not need the pcef.core package (which requires PySide or
+    PyQt4).
+    """
+    path = os.path.join(ROOT, "pcef", "core", name + ".py")
+    spec = importlib.util.spec_from_file_location("pcef_core_" + name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
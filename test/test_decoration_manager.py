@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCEF - Python/Qt Code Editing Framework
+# Copyright 2013, Colin Duquesnoy <colin.duquesnoy@gmail.com>
+#
+# This software is released under the LGPLv3 license.
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests of the decoration layers (requires PySide or PyQt4).
+"""
+import importlib.util
+import pytest
+
+if not any(importlib.util.find_spec(name) for name in ("PySide", "PyQt4")):
+    pytest.skip("requires PySide or PyQt4", allow_module_level=True)
+
+from pcef.qt import QtGui
+from pcef.core.decoration_manager import DecorationLayer
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QtGui.QApplication.instance() or QtGui.QApplication([])
+
+
+class Manager(object):
+    """ Stands for the DecorationManager of a layer """
+    def requestCommit(self):
+        pass
+
+
+def ranges(layer):
+    return [(start, end) for start, end, formatId, tooltip in layer]
+
+
+def test_shift():
+    manager = Manager()
+    layer = DecorationLayer(manager, "test")
+    layer.setRanges([0, 4, 10], [3, 7, 13], 0)
+    layer.shift(8, 0, 2)
+    assert ranges(layer) == [(0, 3), (4, 7), (12, 15)]
+    layer.shift(3, 5, 0)
+    assert ranges(layer) == [(0, 3), (7, 10)]
+
+
+def test_same_length_replacement():
+    """
+    A replacement of the same length (e.g. typing over a selection) drops
+    the decorations of the replaced text.
+    """
+    manager = Manager()
+    layer = DecorationLayer(manager, "test")
+    layer.setRanges([0, 4, 10], [3, 7, 13], 0)
+    layer.shift(4, 3, 3)
+    assert ranges(layer) == [(0, 3), (10, 13)]
+    layer.shift(1, 1, 1)
+    assert ranges(layer) == [(0, 3), (10, 13)]
+
+
+def test_replace_ranges():
+    manager = Manager()
+    layer = DecorationLayer(manager, "test")
+    layer.setRanges([0, 4, 10, 20], [3, 7, 13, 23], 0)
+    layer.replaceRanges(4, 20, [5, 15], [6, 16], 1)
+    assert ranges(layer) == [(0, 3), (5, 6), (15, 16), (20, 23)]
+    assert [formatId for start, end, formatId, tooltip in layer] == \
+        [0, 1, 1, 0]
+    layer.replaceRanges(0, 10, [], [], 1)
+    assert ranges(layer) == [(15, 16), (20, 23)]
+
+
+def test_format_changes(app):
+    """
+    Highlighting passes run outside of the highlighting scheduler (Qt
+    highlighting the typed text, rehighlightBlock) do not move nor drop the
+    decorations, typing over a decorated range drops it.
+    """
+    from pcef.core.editor import QCodeEdit
+    from pcef.core.modes.syntax_highlighter import QPygmentsHighlighter
+    editor = QCodeEdit()
+    editor.setPlainText(u"def f(x):\n    return x  # x\n")
+    doc = editor.document()
+    highlighter = QPygmentsHighlighter(doc)
+    layer = editor.decorations.layer("test")
+    layer.setRanges([4, 21], [5, 22], editor.decorations.registerFormat(
+        QtGui.QTextCharFormat()))
+    highlighter.rehighlightBlock(doc.firstBlock())
+    highlighter.rehighlightBlock(doc.lastBlock().previous())
+    assert ranges(layer) == [(4, 5), (21, 22)]
+    cursor = QtGui.QTextCursor(doc)
+    cursor.setPosition(14)
+    cursor.insertText(u"'")
+    cursor.setPosition(26)
+    cursor.insertText(u"'")
+    assert ranges(layer) == [(4, 5), (22, 23)]
+    # a replacement of the same length
+    cursor.setPosition(4)
+    cursor.setPosition(5, QtGui.QTextCursor.KeepAnchor)
+    cursor.insertText(u"g")
+    assert ranges(layer) == [(22, 23)]
+    # undo is a change of the text too
+    layer.addRange(4, 5, 0)
+    doc.undo()
+    assert ranges(layer) == [(22, 23)]
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCEF - Python/Qt Code Editing Framework
+# Copyright 2013, Colin Duquesnoy <colin.duquesnoy@gmail.com>
+#
+# This software is released under the LGPLv3 license.
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests of the compiled lexing engine: the tokens must be identical to the
+tokens of stock pygments.
+
+pcef.core.lexing does not depend on Qt, it is imported from its file so that
+the tests do not need the pcef.core package (which requires PySide or
+PyQt4).
+"""
+import glob
+import os
+import pytest
+
+from pygments.lexer import RegexLexer
+from pygments.lexers import get_lexer_by_name
+from pygments.token import Keyword, Name, Operator, Text, Whitespace
+
+from conftest import importCoreModule, ROOT
+
+
+lexing = importCoreModule("lexing")
+CompiledLexer = lexing.CompiledLexer
+lex = lexing.lex
+lex_block = lexing.lex_block
+is_resumable = lexing.is_resumable
+RuleScanner = lexing.RuleScanner
+TokenCache = lexing.TokenCache
+format_ranges = lexing.format_ranges
+FormatDescriptions = lexing.FormatDescriptions
+
+#: Files lexed by the equivalence tests, per lexer name
+CORPUS = {
+    "python": glob.glob(os.path.join(ROOT, "pcef", "core", "*.py")) +
+    glob.glob(os.path.join(ROOT, "pcef", "core", "*", "*.py")),
+    "xml": glob.glob(os.path.join(ROOT, "pcef", "core", "ui", "*.ui")),
+    "rst": glob.glob(os.path.join(ROOT, "*.rst")),
+    "ini": glob.glob(os.path.join(ROOT, "*.cfg"))}
+
+#: Samples lexed by the equivalence tests, per lexer name
+SAMPLES = {
+    "javascript": u'var a = /re[/]gex/g; // c\n/* multi\nline */ '
+                  u'function f(x) { return `t${x}` + "s\\"q"; }\n',
+    "css": u'@media screen { a:hover > b { color: #fff !important; } }\n'
+           u'/* comment */ .x::before { content: "\\201C"; }\n',
+    "bash": u'#!/bin/sh\nfor f in $(ls *.py); do echo "${f%.py}" '
+            u'>> out; done\ncat <<EOF\nheredoc $x\nEOF\n',
+    "c": u'#include <stdio.h>\n/* multi\nline */ size_t f(int8_t x) '
+         u'{ return sizeof(x); } // c\n',
+    "cpp": u'template<class T> std::vector<T> v; auto s = R"(raw)";\n'
+           u'class A : public B { int x = 0x1f; };\n',
+    "csharp": u'class A { /* c */ string s = @"v""q"; int é = 1; }'
+              u'\n#region r\n',
+    "diff": u'--- a\n+++ b\n@@ -1,2 +1,2 @@\n-old\n+new\n context\n',
+    "python": u'x = r"""multi\nline""" + f"{a!r:>{w}}" # c\n'
+              u'@decorator\nasync def f(*a, **k) -> None: ...\n\ty=1\r\n',
+    "xml": u'<?xml version="1.0"?>\n<a b="c"><!-- multi\nline --></a>\n',
+    "rst": u'Title\n=====\n\n.. note:: *emphasis* ``code``\n',
+    "ini": u'[section]\nkey = value ; c\n'}
+
+#: Samples of the lexers whose get_tokens_unprocessed override does not
+#: accept a stack, with constructs that span several lines
+CARRIED = {
+    "swift": u'let a = 1 /* block\ncomment */ let b = "s"\n',
+    "postgresql": u'SELECT 1; /* block\ncomment */ SELECT 2;\n',
+    "plpgsql": u'BEGIN /* block\ncomment */ RETURN 1; END;\n',
+    "php": u'<p><?php\n$a = "s"; // c\n?></p>\n',
+    "lua": u'local s = "a\\\nb" -- c\nlocal t = 1\n',
+    "elixir": u'x = """\nheredoc #{y}\n"""\n',
+    "scheme": u'(define s "multi\nline") #| block\ncomment |# (f x)\n',
+    "vim": u'let s = "x" " c\nfunction! F()\nendfunction\n',
+    "common-lisp": u'(defun f (x) #| block\ncomment |# (+ x 1))\n',
+    "emacs-lisp": u'(defun f (x) "doc\nstring" (+ x 1))\n',
+    "dylan": u'define method f () /* block\ncomment */ end;\n'}
+
+
+def texts(name):
+    """ Returns the sample and the corpus files of a lexer """
+    result = [SAMPLES[name]]
+    for path in CORPUS.get(name, []):
+        with open(path, "rb") as f:
+            result.append(f.read().decode("utf-8"))
+    return result
+
+
+def merged(tokens):
+    """ Merges the adjacent tokens of the same type """
+    result = []
+    for token, value in tokens:
+        if result and result[-1][0] == token:
+            result[-1] = (token, result[-1][1] + value)
+        else:
+            result.append((token, value))
+    return result
+
+
+@pytest.mark.parametrize("name", sorted(SAMPLES))
+def test_text(name):
+    """ A whole text is lexed as pygments does """
+    lexer = get_lexer_by_name(name)
+    assert CompiledLexer.forLexer(lexer) is not None
+    for text in texts(name):
+        assert lex(lexer, text)[0] == list(lexer.get_tokens(text))
+
+
+@pytest.mark.parametrize("name", sorted(SAMPLES))
+def test_lines(name):
+    """
+    Lines are lexed as pygments does (as the highlighter lexes them),
+    starting from the same entry stacks.
+    """
+    lexer = get_lexer_by_name(name)
+    for text in texts(name):
+        stack = ('root',)
+        for line in text.splitlines():
+            tokens, exitStack = lex(lexer, line, stack)
+            expected = [(token, value) for _, token, value in
+                        lexer.get_tokens_unprocessed(
+                            lexer._preprocess_lexer_input(line), stack)]
+            assert tokens == expected, line
+            stack = exitStack
+
+
+@pytest.mark.parametrize("name", sorted(CARRIED))
+def test_carried_state(name):
+    """
+    The lexers whose override does not accept a stack are lexed with their
+    rules only, their state is carried from line to line.
+    """
+    lexer = get_lexer_by_name(name)
+    compiled = CompiledLexer.forLexer(lexer)
+    assert compiled is not None and not compiled.postProcessed
+    text = CARRIED[name]
+    expected = [(token, value) for _, token, value in
+                RegexLexer.get_tokens_unprocessed(lexer, text)]
+    assert lex(lexer, text)[0] == expected
+    tokens = []
+    stack = ('root',)
+    for line in text.splitlines(True):
+        lineTokens, stack = lex(lexer, line.rstrip(u"\n"), stack)
+        tokens += lineTokens
+    assert merged(tokens) == merged(expected)
+
+
+#: Long lines lexed by chunks, per lexer name and filters: (text, resumable)
+LONG_LINES = {
+    ("python", ()): (u"x = [" + u", ".join(
+        u"'%d'" % i for i in range(2000)) + u"]  # done", True),
+    ("python", ("keywordcase",)): (u"if x: " + u" or ".join(
+        u"not a%d" % i for i in range(2000)), False),
+    ("c", ()): (u"int a[] = {" + u", ".join(
+        u"0x%x" % i for i in range(2000)) + u"}; /* comment", False),
+    ("json", ()): (u'{"a": [' + u", ".join(
+        u'{"b%d": %d}' % (i, i) for i in range(2000)) + u"]}", False)}
+
+
+@pytest.mark.parametrize("name, filters", sorted(LONG_LINES))
+def test_lex_block_chunks(name, filters):
+    """
+    A long block lexed by chunks, resumable lexer or not, gives the runs and
+    the exit stack of the block lexed at once.
+    """
+    lexer = get_lexer_by_name(name)
+    for filter in filters:
+        lexer.add_filter(filter)
+    text, resumable = LONG_LINES[name, filters]
+    assert is_resumable(lexer) is resumable
+    runs, stack, end, resume = lex_block(lexer, text, ('root',))
+    assert resume is None and end >= len(text)
+    assert sum(length for length, token in runs) >= len(text)
+    resume = None
+    stop = 0
+    while True:
+        stop += 1000
+        chunkRuns, chunkStack, chunkEnd, resume = lex_block(
+            lexer, text, ('root',), stop=stop, resume=resume)
+        if resume is None:
+            break
+        assert stop <= chunkEnd < len(text)
+    assert stop > 1000
+    assert chunkRuns == runs and chunkStack == stack
+
+
+@pytest.mark.parametrize("name, filters", sorted(LONG_LINES))
+def test_lex_block_deadline(name, filters):
+    """ Lexing stops at the deadline and resumes where it stopped """
+    lexer = get_lexer_by_name(name)
+    for filter in filters:
+        lexer.add_filter(filter)
+    text = LONG_LINES[name, filters][0]
+    runs, stack, end, resume = lex_block(lexer, text, ('root',))
+    partRuns, partStack, partEnd, resume = lex_block(
+        lexer, text, ('root',), deadline=0)
+    assert resume is not None and partEnd < len(text)
+    assert partRuns == runs[:len(partRuns)]
+    partRuns, partStack, partEnd, resume = lex_block(
+        lexer, text, ('root',), resume=resume)
+    assert resume is None
+    assert partRuns == runs and partStack == stack
+
+
+def test_rule_scanner_flags():
+    """
+    Rules that differ by an ascii flag keep their own flags: an ascii rule
+    does not match non ascii word characters.
+    """
+    scanner = RuleScanner([(r"(?a)\w+", "word"), (r"(?i)-", "dash")])
+    ranges = [(1, 2, "word"), (3, 4, "dash")]
+    assert scanner.scan(u"\xe9t\xe9-")[1] == ranges
+    scanner = RuleScanner([(r"(?a)\w+", "word"), (r"\w", "letter")])
+    assert scanner.scan(u"\xe9t")[1] == [(0, 1, "letter"), (1, 2, "word")]
+
+
+def test_token_cache():
+    """
+    The token cache evicts the least recently used lines and counts its hits
+    and misses.
+    """
+    cache = TokenCache(maxSize=2)
+    cache.put((u"a", 0), ([(1, Name)], 0))
+    cache.put((u"b", 0), ([(1, Name)], 1))
+    assert cache.get((u"a", 0)) == ([(1, Name)], 0)
+    cache.put((u"c", 1), ([(1, Keyword)], 0))
+    assert len(cache) == 2
+    assert cache.get((u"b", 0)) is None
+    assert cache.get((u"a", 0)) is not None
+    assert cache.get((u"c", 1)) == ([(1, Keyword)], 0)
+    assert (cache.hits, cache.misses) == (3, 1)
+    cache.clear()
+    assert (len(cache), cache.hits, cache.misses) == (0, 0, 0)
+
+
+def test_token_cache_per_table():
+    """
+    Lexers share a cache only if they have the same class, token table and
+    options.
+    """
+    from pygments.lexers import CLexer
+    lexer = CLexer()
+    assert TokenCache.forLexer(CLexer()) is TokenCache.forLexer(lexer)
+    assert TokenCache.forLexer(CLexer(stripall=True)) is not \
+        TokenCache.forLexer(lexer)
+    # e.g. the C lexers of pcef, with a comment state
+    commented = CLexer()
+    commented._tokens = dict(CLexer._tokens)
+    assert TokenCache.forLexer(commented) is not TokenCache.forLexer(lexer)
+
+
+def test_format_ranges():
+    """
+    Adjacent runs that share the same format are coalesced, whitespace gets
+    the Whitespace format where the text has been lexed.
+    """
+    formats = {Name: "name", Operator: "name", Text: "text",
+               Whitespace: "space"}
+    assert format_ranges(u"a  b+c", [(1, Name), (2, Text), (1, Name),
+                                     (1, Operator), (1, Name)],
+                         formats.get) == [[0, 1, "name"], [1, 3, "space"],
+                                          [3, 6, "name"]]
+    # a block lexed until its third character only
+    assert format_ranges(u"a b c", [(2, Name)], formats.get) == [
+        [0, 1, "name"], [1, 2, "space"]]
+
+
+def test_format_descriptions(tmp_path):
+    """
+    The format descriptions of a style survive a JSON round trip.
+    """
+    from pygments.styles import get_style_by_name
+    style = get_style_by_name("default")
+    table = FormatDescriptions(FormatDescriptions.describeStyle(style))
+    assert table.description(Keyword) == {"color": "008000", "bold": True}
+    path = str(tmp_path / "default.json")
+    table.save(path)
+    loaded = FormatDescriptions.load(path)
+    for token, description in style:
+        assert loaded.description(token) == table.description(token)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCEF - Python/Qt Code Editing Framework
+# Copyright 2013, Colin Duquesnoy <colin.duquesnoy@gmail.com>
+#
+# This software is released under the LGPLv3 license.
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests of the rule based syntax highlighter (requires PySide or PyQt4).
+"""
+import importlib.util
+import pytest
+
+if not any(importlib.util.find_spec(name) for name in ("PySide", "PyQt4")):
+    pytest.skip("requires PySide or PyQt4", allow_module_level=True)
+
+from pcef.qt import QtGui
+from pcef.core import constants
+from pcef.core.lexing import RuleScanner
+from pcef.core.modes.rule_highlighter import RuleHighlighter
+from pcef.core.modes.rule_highlighter import RuleHighlighterMode
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QtGui.QApplication.instance() or QtGui.QApplication([])
+
+
+def charFormat(color):
+    format = QtGui.QTextCharFormat()
+    format.setForeground(QtGui.QBrush(QtGui.QColor(color)))
+    return format
+
+
+def highlight(highlighter, doc):
+    """ Highlights the first block of a document, returns its formats """
+    highlighter.formatCalls = highlighter.highlightedBlocks = 0
+    highlighter.rehighlightBlock(doc.firstBlock())
+    assert highlighter.highlightedBlocks == 1
+    return [(r.start, r.length, r.format.foreground().color().name())
+            for r in doc.firstBlock().layout().additionalFormats()]
+
+
+def test_coalesced_formats(app):
+    """
+    Adjacent ranges that share the same format are applied with a single
+    setFormat call.
+    """
+    doc = QtGui.QTextDocument()
+    doc.setPlainText(u"ab c")
+    highlighter = RuleHighlighter(doc, RuleScanner(
+        [(r'a', 'letter'), (r'b', 'letter'), (r'c', 'other')]))
+    highlighter.setFormats({"letter": charFormat("#ff0000"),
+                            "other": charFormat("#0000ff")})
+    formats = highlight(highlighter, doc)
+    assert highlighter.formatCalls == 2
+    assert formats == [(0, 2, "#ff0000"), (3, 1, "#0000ff")]
+
+
+def test_line_key(app):
+    """
+    A matching line rule formats the whole line, the rule ranges are applied
+    over it.
+    """
+    doc = QtGui.QTextDocument()
+    doc.setPlainText(u"ERROR 42")
+    highlighter = RuleHighlighter(doc, RuleScanner(
+        [(r'\d+', 'numbers')], [(r'^ERROR', 'logError')]))
+    highlighter.setFormats({"logError": charFormat("#ff0000"),
+                            "numbers": charFormat("#0000ff")})
+    formats = highlight(highlighter, doc)
+    assert highlighter.formatCalls == 2
+    assert formats == [(0, 6, "#ff0000"), (6, 2, "#0000ff")]
+
+
+def test_dark_default_styles(app):
+    """ The default rule styles follow the editor background """
+    from pcef.core.editor import QCodeEdit
+    for background, styles in (("#ffffff", constants.DEFAULT_STYLES),
+                               ("#2b2b2b", constants.DEFAULT_DARK_STYLES)):
+        editor = QCodeEdit()
+        editor.style.setValue("background", QtGui.QColor(background))
+        editor.installMode(RuleHighlighterMode())
+        assert str(editor.style.value("logError")) == \
+            str(styles["logError"])
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCEF - Python/Qt Code Editing Framework
+# Copyright 2013, Colin Duquesnoy <colin.duquesnoy@gmail.com>
+#
+# This software is released under the LGPLv3 license.
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests of the text search engine.
+
+pcef.core.search does not depend on Qt, it is imported from its file so that
+the tests do not need the pcef.core package (which requires PySide or
+PyQt4).
+"""
+import re
+import threading
+import pytest
+
+from conftest import importCoreModule
+
+
+search = importCoreModule("search")
+SearchEngine = search.SearchEngine
+CASE_SENSITIVE = search.CASE_SENSITIVE
+WHOLE_WORDS = search.WHOLE_WORDS
+REGEX = search.REGEX
+isLocal = search.isLocal
+compilePattern = search.compilePattern
+
+WORDS = [u"foo", u"Foo", u"food", u"_foo", u"foo_", u"éfoo", u"bar"]
+TEXT = u" ".join(WORDS[i % 7] + u"\n" * (i % 3 == 0) for i in range(20000))
+
+
+def isWholeWord(m):
+    return ((m.start() == 0 or not TEXT[m.start() - 1].isalnum()) and
+            (m.end() == len(TEXT) or not TEXT[m.end()].isalnum()))
+
+
+@pytest.mark.parametrize("query, flags, expected", [
+    (u"foo", CASE_SENSITIVE, [m.start() for m in re.finditer(u"foo", TEXT)]),
+    (u"foo", 0, [m.start() for m in re.finditer(u"(?i)foo", TEXT)]),
+    (u"foo", WHOLE_WORDS | CASE_SENSITIVE,
+     [m.start() for m in re.finditer(u"foo", TEXT) if isWholeWord(m)])])
+def test_search(query, flags, expected):
+    """ The engine finds the occurrences of a naive search """
+    starts, ends = SearchEngine(TEXT).search(query, flags)
+    assert list(starts) == expected
+    assert all(e - s == len(query) for s, e in zip(starts, ends))
+
+
+@pytest.mark.parametrize("flags", [0, CASE_SENSITIVE, WHOLE_WORDS])
+def test_refinement(flags):
+    """ Type-ahead results are the results of a full search """
+    text = u"aaab aabaab abab" * 1000
+    engine = SearchEngine(text)
+    for query in (u"a", u"aa", u"aab", u"aaab", u"aaa", u"ab", u"aba"):
+        assert engine.search(query, flags) == \
+            SearchEngine(text).search(query, flags), query
+
+
+def test_search_range():
+    engine = SearchEngine(u"foo food foo")
+    assert list(engine.searchRange(u"foo", WHOLE_WORDS, 0, 8)[0]) == [0]
+    assert list(engine.searchRange(u"foo", WHOLE_WORDS, 4, 12)[0]) == [9]
+    assert list(engine.searchRange(u"foo", 0, 1, 11)[0]) == [4]
+
+
+def test_is_local():
+    assert isLocal(u"foo") and not isLocal(u"abca", CASE_SENSITIVE)
+    assert not isLocal(u"Aa") and isLocal(u"Aa", CASE_SENSITIVE)
+
+
+def test_regex():
+    engine = SearchEngine(u"foo12 bar7\nx foo3\n" * 20000)
+    starts, ends = engine.search(u"foo(\\d+)$", REGEX)
+    assert list(starts) == [m.start() for m in re.finditer(
+        u"(?m)foo(\\d+)$", engine.text)]
+    assert engine.complete
+    assert engine.expand(u"foo(\\d+)$", REGEX, u"<\\1>", starts[0]) == u"<3>"
+    assert list(engine.search(u"^", REGEX)[0]) == []
+    # matches do not span lines
+    assert list(engine.search(u"\\d\\s+x", REGEX)[0]) == []
+    assert list(engine.searchRange(u"foo\\d+", REGEX, 6, 30)[0]) == [13, 18]
+    assert not isLocal(u"foo", REGEX)
+
+
+def test_regex_expand():
+    """ The expanded match is the occurrence, it does not span lines """
+    engine = SearchEngine(u"ab\ncd\nef")
+    starts, ends = engine.search(u"[^x]+", REGEX)
+    assert list(zip(starts, ends)) == [(0, 2), (3, 5), (6, 8)]
+    assert [engine.expand(u"[^x]+", REGEX, u"<\\g<0>>", start)
+            for start in starts] == [u"<ab>", u"<cd>", u"<ef>"]
+
+
+def test_regex_time_budget():
+    """ A search stops when its time budget is exhausted """
+    engine = SearchEngine(u"foo12 bar7\nx foo3\n" * 200000)
+    starts, ends = engine.search(u"(?:o|b)+\\d", REGEX)
+    assert engine.complete and len(starts) == 400000
+    engine.timeBudget = 1
+    partialStarts, partialEnds = engine.search(u"(?:o|b)+\\d", REGEX)
+    assert not engine.complete
+    count = len(partialStarts)
+    assert 0 < count < 400000
+    assert partialStarts == starts[:count]
+    assert partialEnds == ends[:count]
+
+
+def test_pattern_cache_threads():
+    """ The pattern cache can be used from several threads """
+    errors = []
+
+    def compileMany(seed):
+        try:
+            for i in range(2000):
+                query = u"q%d" % ((i * seed) % (search.PATTERN_CACHE_SIZE * 2))
+                regex = compilePattern(query, REGEX)
+                assert regex.pattern == u"(?:%s)" % query
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=compileMany, args=(seed,))
+               for seed in (1, 3, 5, 7)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len(search._PATTERNS) <= search.PATTERN_CACHE_SIZE
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCEF - Python/Qt Code Editing Framework
+# Copyright 2013, Colin Duquesnoy <colin.duquesnoy@gmail.com>
+#
+# This software is released under the LGPLv3 license.
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests of the search and replace panel (requires PySide or PyQt4).
+"""
+import importlib.util
+import time
+import pytest
+
+if not any(importlib.util.find_spec(name) for name in ("PySide", "PyQt4")):
+    pytest.skip("requires PySide or PyQt4", allow_module_level=True)
+
+from pcef.qt import QtGui
+from pcef.core.constants import PanelPosition
+from pcef.core.editor import QCodeEdit
+from pcef.core.panels import SearchAndReplacePanel
+from pcef.core.search import SearchEngine, REGEX
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QtGui.QApplication.instance() or QtGui.QApplication([])
+
+
+def createEditor(text):
+    editor = QCodeEdit()
+    panel = SearchAndReplacePanel()
+    editor.installPanel(panel, PanelPosition.BOTTOM)
+    editor.setPlainText(text)
+    return editor, panel
+
+
+def wait(app, panel):
+    """ Waits for the end of the pending search of a panel """
+    finished = []
+    panel.searchFinished.connect(lambda: finished.append(True))
+    deadline = time.time() + 10
+    while not finished and time.time() < deadline:
+        app.processEvents()
+    assert finished
+
+
+def insert(editor, position, text):
+    """ Inserts text without moving the text cursor of the editor """
+    cursor = QtGui.QTextCursor(editor.document())
+    cursor.setPosition(position)
+    cursor.insertText(text)
+
+
+def test_overlapping_query(app):
+    """
+    The occurrences of a query that overlaps itself are updated after an
+    edit as a new search would find them.
+    """
+    editor, panel = createEditor(u"aaaa baaa aa\naaa")
+    panel.lineEditSearch.setText(u"aa")
+    wait(app, panel)
+    for position, text in ((0, u"a"), (7, u"a"), (3, u" "), (0, u"aaa")):
+        insert(editor, position, text)
+        expected = SearchEngine(editor.toPlainText()).search(u"aa")
+        assert panel.getOccurrences() == list(zip(*expected))
+
+
+def test_regex_edits(app):
+    """
+    The occurrences of a regular expression are updated after an edit as a
+    new search would find them.
+    """
+    editor, panel = createEditor(u"foo1 bar\nfoo22\nbaz foo3\n")
+    panel.checkBoxRegex.setChecked(True)
+    panel.lineEditSearch.setText(u"^foo\\d+")
+    wait(app, panel)
+    for position, text in ((0, u"x"), (0, u"\n"), (10, u"\nfoo4 "),
+                           (3, u"x")):
+        insert(editor, position, text)
+        engine = SearchEngine(editor.toPlainText())
+        expected = engine.search(u"^foo\\d+", REGEX)
+        assert panel.getOccurrences() == list(zip(*expected))
+
+
+@pytest.mark.parametrize("regex", [False, True])
+def test_edits_keep_the_selection(app, regex):
+    """ The searches started by an edit do not move the text cursor """
+    editor, panel = createEditor(u"test that\nother test\n")
+    panel.checkBoxRegex.setChecked(regex)
+    panel.lineEditSearch.setText(u"t.*t" if regex else u"test")
+    wait(app, panel)
+    cursor = editor.textCursor()
+    cursor.setPosition(12)
+    editor.setTextCursor(cursor)
+    insert(editor, 16, u"x")
+    # let a background search finish
+    deadline = time.time() + 1
+    while time.time() < deadline:
+        app.processEvents()
+    assert editor.textCursor().position() == 12
+    assert not editor.textCursor().hasSelection()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCEF - Python/Qt Code Editing Framework
+# Copyright 2013, Colin Duquesnoy <colin.duquesnoy@gmail.com>
+#
+# This software is released under the LGPLv3 license.
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests of the pygments syntax highlighter (requires PySide or PyQt4).
+"""
+import importlib.util
+import time
+import pytest
+
+if not any(importlib.util.find_spec(name) for name in ("PySide", "PyQt4")):
+    pytest.skip("requires PySide or PyQt4", allow_module_level=True)
+
+from pcef.qt import QtGui
+from pcef.core.modes.syntax_highlighter import PygmentsBlockUserData
+from pcef.core.modes.syntax_highlighter import create_lexer
+from pcef.core.modes.syntax_highlighter import FormatTable
+from pcef.core.modes.syntax_highlighter import HighlightCache
+from pcef.core.modes.syntax_highlighter import QPygmentsHighlighter
+from pcef.core.modes.syntax_highlighter import lexer_class_for_filename
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QtGui.QApplication.instance() or QtGui.QApplication([])
+
+
+def wait(app, highlighter):
+    """ Waits for the end of the highlighting pass of a highlighter """
+    deadline = time.time() + 10
+    while highlighter.scheduler.running and time.time() < deadline:
+        app.processEvents()
+    assert not highlighter.scheduler.running
+
+
+def highlight(app, filename, text, backgroundThreshold=2000):
+    """
+    Highlights a document with the lexer of a file name and returns the user
+    data of its blocks.
+    """
+    doc = QtGui.QTextDocument()
+    highlighter = QPygmentsHighlighter(doc)
+    highlighter.backgroundThreshold = backgroundThreshold
+    highlighter.setLexerFromFilename(filename)
+    doc.setPlainText(text)
+    highlighter.rehighlight()
+    wait(app, highlighter)
+    data = []
+    block = doc.begin()
+    while block.isValid():
+        data.append(highlighter.blockData(block))
+        block = block.next()
+    return data
+
+
+@pytest.mark.parametrize("filename, text", [
+    ("notes.txt", u"first line\n\tsecond line\n\nlast line"),
+    ("data.json", u'{"a": [1, 2.5, "x", true, null],\n "b": {\n  "c": ""}}')])
+@pytest.mark.parametrize("backgroundThreshold", [2000, 1])
+def test_stateless_lexers(app, filename, text, backgroundThreshold):
+    """
+    The text and json lexers are not RegexLexers (no lexer states): every
+    block must be highlighted, from the GUI thread or in the background.
+    """
+    text = u"\n".join([text] * 10)
+    data = highlight(app, filename, text, backgroundThreshold)
+    assert len(data) == text.count(u"\n") + 1
+    for blockData in data:
+        assert isinstance(blockData, PygmentsBlockUserData)
+
+
+@pytest.mark.parametrize("filenames", [
+    ("foo.html.j2", "bar.j2"), ("foo.sql.j2", "foo.sql"),
+    ("foo.css.in", "foo.in")])
+def test_multi_extension_patterns(filenames):
+    """
+    Patterns with several extensions (e.g. "*.html.j2") must not be cached
+    as their last extension.
+    """
+    from pygments.lexers import find_lexer_class_for_filename, PythonLexer
+    for filename in filenames:
+        expected = find_lexer_class_for_filename(filename) or PythonLexer
+        assert lexer_class_for_filename(filename) is expected
+
+
+def test_comment_state_per_instance():
+    """
+    The C lexers created by pcef get a comment state, the pygments class and
+    its other instances are left untouched.
+    """
+    from pygments.lexers import CLexer
+    hostLexer = CLexer()
+    tokens = CLexer._tokens
+    lexer = create_lexer(CLexer)
+    assert "comment" in lexer._tokens
+    assert CLexer._tokens is tokens and hostLexer._tokens is tokens
+    assert "comment" not in tokens
+
+
+def test_coalesced_formats(app):
+    """
+    Adjacent tokens that share the same format are applied with a single
+    setFormat call.
+    """
+    doc = QtGui.QTextDocument()
+    highlighter = QPygmentsHighlighter(doc)
+    highlighter.style = "default"
+    doc.setPlainText(u"1+2")
+    highlighter.formatCalls = highlighter.highlightedBlocks = 0
+    highlighter.rehighlightBlock(doc.firstBlock())
+    # Number and Operator have the same format in the default style
+    assert highlighter.highlightedBlocks == 1
+    assert highlighter.formatCalls == 1
+
+
+def test_reformat(app):
+    """
+    Changing the style re-applies the formats from the token runs kept in the
+    block data: nothing is lexed again.
+    """
+    doc = QtGui.QTextDocument()
+    highlighter = QPygmentsHighlighter(doc)
+    doc.setPlainText(u"def f(x):\n    return x  # c\n" * 20)
+    highlighter.rehighlight()
+    wait(app, highlighter)
+    runs = [highlighter.blockData(doc.findBlockByNumber(i)).runs
+            for i in range(doc.blockCount())]
+    cache = highlighter.tokenCache
+    lookups = cache.hits + cache.misses
+    highlighter.style = "monokai"
+    highlighter.reformat()
+    wait(app, highlighter)
+    assert cache.hits + cache.misses == lookups
+    for i, blockRuns in enumerate(runs):
+        assert highlighter.blockData(doc.findBlockByNumber(i)).runs is \
+            blockRuns
+
+
+def test_format_table(app, tmp_path):
+    """
+    Format tables compiled from a style, loaded from a JSON file or read from
+    a stylesheet give the same formats.
+    """
+    from pygments.formatters.html import HtmlFormatter
+    from pygments.styles import get_style_by_name
+    from pygments.token import Keyword
+    style = get_style_by_name("default")
+    table = FormatTable.fromStyle(style)
+    assert FormatTable.fromStyle(style) is table
+    path = str(tmp_path / "default.json")
+    table.save(path)
+    stylesheet = HtmlFormatter(style="default").get_style_defs()
+    for other in (FormatTable.load(path),
+                  FormatTable.fromStyleSheet(stylesheet)):
+        fmt = other.format(Keyword.Constant)
+        assert fmt.foreground().color().name() == "#008000"
+        assert fmt.fontWeight() == QtGui.QFont.Bold
+
+
+def test_highlight_cache_surrogates(app, tmp_path):
+    """ Texts with lone surrogates can be keyed, saved and restored """
+    path = tmp_path / "file.py"
+    path.write_text(u"x = 1\n")
+    text = u"x = '\ud800'\n" * 3
+    cache = HighlightCache(str(tmp_path / "cache"))
+    assert cache.fileKey(str(path), text) != cache.fileKey(str(path), u"")
+    doc = QtGui.QTextDocument()
+    highlighter = QPygmentsHighlighter(doc)
+    highlighter.setLexerFromFilename(str(path))
+    doc.setPlainText(text)
+    highlighter.rehighlight()
+    wait(app, highlighter)
+    assert cache.save(highlighter, str(path))
+    doc.setPlainText(text + u"y = 2")
+    assert cache.restore(highlighter, str(path)) == 3